@@ -1,13 +1,28 @@
 import streamlit as st
-import requests
 import os
-import json
+import socket
+import time
+import uuid
 import pandas as pd
 import plotly.graph_objects as go
 import plotly.express as px
 from datetime import datetime, timezone, timedelta
-from binance.client import Client
 from dotenv import load_dotenv
+from client_pool import get_client_pool
+from ledger import ESCOPO_MES, ESCOPO_SYMBOL, STATUS_FECHANDO, STATUS_PAI_ATIVOS, STATUS_PAI_CANCELANDO, STATUS_PAI_EXECUTANDO, STATUS_PAI_PAUSADA, get_ledger
+from market_data import arredondar_step, get_exchange_index, get_market_client, get_price_snapshot
+from rate_limiter import get_rate_limiter
+from market_feed import get_market_feed, get_market_store
+from execucao import ErroExecucao, enviar_pernas, relatorio_skew, skew
+from fatiamento import LIMITE_BASIS, PAUSA_MAXIMA, TOLERANCIA_HEDGE, em_execucao, iniciar_execucao, nova_ordem_pai, progresso, retomar_execucao
+from funding_store import get_funding_store
+from historico import COLUNAS_HISTORICO, FORMATOS, exportar_historico, linha_historico
+from portfolio import avaliar_carteira, totais
+from reconciliacao import reconciliar
+from scanner import escanear_oportunidades, get_recent_funding_bulk
+from user_stream import get_user_stream
+from swr_cache import REGIAO_FUNDING, REGIAO_RECEITAS, REGIAO_SALDOS, REGIAO_SIMBOLOS, get_swr_cache
+from signals import FUNDING_BASIS_RATIO, FUNDING_THRESHOLD, calcular_sinais, vencimento_ms
 
 # Configuração da página
 st.set_page_config(
@@ -19,10 +34,12 @@ st.set_page_config(
 
 # Constantes e configurações
 ARQUIVO_OPERACOES = "operacoes_reais.json"
-FUNDING_THRESHOLD = 0.0003
-FUNDING_BASIS_RATIO = 1.5
 DEFAULT_VOLUME = 100.0
 TAXA_TRADING = 0.0004  # 0.04%
+TIMEOUT_FECHAMENTO = 120  # segundos até uma reserva de fechamento não concluída poder ser reconciliada
+TOLERANCIA_POSICAO = 0.01  # fração da quantidade da ordem aceita como diferença ao conferir posições
+ESPERA_EVENTO_ORDEM = 0.5  # segundos esperando o evento de execução no user data stream
+ORDENACOES_HISTORICO = {"Data de saída": "data_saida", "Data de entrada": "data_entrada", "Par": "symbol_perpetuo", "Volume": "volume_usd", "PnL Total": "pnl_total"}
 
 # Estilo CSS personalizado
 st.markdown("""
@@ -203,7 +220,11 @@ def load_dotenv_cached():
 def init_binance_client():
     if st.session_state.api_key and st.session_state.api_secret:
         try:
-            return Client(st.session_state.api_key, st.session_state.api_secret)
+            # Cliente compartilhado pelo processo: sem novo handshake nem round trip a cada rerun
+            client = get_client_pool().get(st.session_state.api_key, st.session_state.api_secret)
+            # Stream da conta (iniciado uma vez por conta) mantém saldos, posições e ordens em memória
+            get_user_stream(client)
+            return client
         except Exception as e:
             st.error(f"Erro ao inicializar cliente Binance: {str(e)}")
     return None
@@ -214,78 +235,78 @@ def get_user_data_path(username):
     os.makedirs(user_dir, exist_ok=True)
     return user_dir
 
-def get_operations_file(username):
-    return f"{get_user_data_path(username)}/operacoes_reais.json"
+def get_operations_ledger(username):
+    # Ledger SQLite do usuário; o operacoes_reais.json legado é importado na primeira abertura
+    return get_ledger(get_user_data_path(username))
 
-def salvar_operacoes(ops, username):
-    file_path = get_operations_file(username)
-    with open(file_path, "w") as f:
-        json.dump(ops, f, indent=2)
-
-def carregar_operacoes(username):
-    file_path = get_operations_file(username)
-    if os.path.exists(file_path):
-        with open(file_path, "r") as f:
-            return json.load(f)
-    return []
-
-@st.cache_data(ttl=60)
 def get_current_quarter_symbols():
     try:
-        info = requests.get("https://fapi.binance.com/fapi/v1/exchangeInfo").json()
-        symbols = {}
-        for s in info["symbols"]:
-            if s["contractType"] == "CURRENT_QUARTER" and s["symbol"].endswith("USDT_"):
-                base_symbol = s["symbol"].split("USDT_")[0]
-                symbols[f"{base_symbol}USDT"] = s["symbol"]
-        return symbols
+        return get_swr_cache().get(REGIAO_SIMBOLOS, "trimestrais", get_exchange_index().quarter_symbols, ttl=60)
     except Exception as e:
         st.error(f"Erro ao obter símbolos trimestrais: {str(e)}")
         return {}
 
-@st.cache_data(ttl=30)
-def get_prices(symbol_perp, symbol_quarter, client=None):
+def preco_atual(symbol):
+    # Preço do feed WebSocket quando estiver fresco; snapshot REST como fallback
+    preco = get_market_store().price(symbol)
+    if preco is None:
+        preco = get_price_snapshot().price(symbol)
+    return preco
+
+def precos_atuais(symbols):
+    # Preços de vários símbolos com uma única leitura do snapshot
+    snapshot = get_price_snapshot()
+    snapshot.ensure_fresh()
+    store = get_market_store()
+    precos = {}
+    for symbol in symbols:
+        preco = store.price(symbol)
+        precos[symbol] = preco if preco is not None else snapshot.prices.get(symbol)
+    return precos
+
+def get_prices(symbol_perp, symbol_quarter):
     try:
-        # Se não tiver cliente autenticado, usa API pública
-        if client:
-            perp_price = float(client.futures_symbol_ticker(symbol=symbol_perp)["price"])
-        else:
-            perp_price = float(requests.get(f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={symbol_perp}").json()["price"])
-        
-        fut_price = float(requests.get(f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={symbol_quarter}").json()["price"])
-        return perp_price, fut_price
+        return preco_atual(symbol_perp), preco_atual(symbol_quarter)
     except Exception as e:
         st.error(f"Erro ao obter preços: {str(e)}")
         return None, None
 
-@st.cache_data(ttl=60)
 def get_recent_funding(symbol="BTCUSDT", limit=3):
     try:
-        url = "https://fapi.binance.com/fapi/v1/fundingRate"
-        params = {"symbol": symbol, "limit": limit}
-        data = requests.get(url, params=params).json()
-        return sum([float(i["fundingRate"]) for i in data]), int(data[-1]["fundingTime"]) if data else (0.0, None)
+        return get_swr_cache().get(
+            REGIAO_FUNDING,
+            (symbol, "recente", limit),
+            lambda: get_funding_store().recent(symbol, limit),
+            ttl=60
+        )
     except Exception as e:
         st.error(f"Erro ao obter funding rate: {str(e)}")
         return 0.0, None
 
-@st.cache_data(ttl=300)
-def get_funding_history(symbol, start_time):
+def get_funding_history(symbol, dias=30):
     try:
-        url = "https://fapi.binance.com/fapi/v1/fundingRate"
-        params = {"symbol": symbol, "limit": 1000, "startTime": start_time}
-        data = requests.get(url, params=params).json()
-        return [
-            {
-                "rate": float(e["fundingRate"]), 
-                "time": datetime.fromtimestamp(int(e["fundingTime"])/1000, tz=timezone.utc)
-            } 
-            for e in data
-        ]
+        # Fatia dos últimos `dias` do histórico local; só eventos ainda não armazenados vão à Binance.
+        # A chave leva a janela, não o instante inicial: o início é calculado a cada atualização
+        def carregar():
+            start_time = int((datetime.now(timezone.utc) - timedelta(days=dias)).timestamp() * 1000)
+            return get_funding_store().history(symbol, start_time)
+        return get_swr_cache().get(REGIAO_FUNDING, (symbol, "historico", dias), carregar, ttl=300)
     except Exception as e:
         st.error(f"Erro ao obter histórico de funding: {str(e)}")
         return []
 
+def descrever_frescor(regiao, chave):
+    # Idade e estado de atualização de uma entrada do cache stale-while-revalidate
+    info = get_swr_cache().info(regiao, chave)
+    if not info:
+        return "sem dados em cache"
+    texto = f"atualizado há {info['idade']:.0f}s"
+    if info["atualizando"]:
+        texto += " (atualizando…)"
+    if info["erro"]:
+        texto += f" — última atualização falhou: {info['erro']}"
+    return texto
+
 def calcular_apr(funding_rates):
     if not funding_rates:
         return 0.0
@@ -293,17 +314,12 @@ def calcular_apr(funding_rates):
     media = sum(rates) / len(rates)
     return ((1 + media) ** (3 * 365)) - 1
 
-@st.cache_data(ttl=300)
-def get_step_size(symbol, client=None):
+def get_step_size(symbol):
     try:
-        if client:
-            info = client.futures_exchange_info()
-            for s in info['symbols']:
-                if s['symbol'] == symbol:
-                    for f in s['filters']:
-                        if f['filterType'] == 'LOT_SIZE':
-                            return float(f['stepSize'])
-        # Fallback para valores padrão se não tiver cliente ou não encontrar
+        filtros = get_exchange_index().get(symbol)
+        if filtros and filtros["step_size"]:
+            return filtros["step_size"]
+        # Fallback para valores padrão se o símbolo não estiver no índice
         if symbol.startswith("BTC"):
             return 0.001
         elif symbol.startswith("ETH"):
@@ -317,44 +333,84 @@ def get_step_size(symbol, client=None):
 def calcular_qty(volume_usd, preco, symbol):
     try:
         qty = volume_usd / preco
-        min_notional = 100
+        filtros = get_exchange_index().get(symbol) or {}
+        min_notional = filtros.get("min_notional") or 100
         if qty * preco < min_notional:
             qty = min_notional / preco
         step = get_step_size(symbol)
-        qty = qty - (qty % step)
-        return round(qty, 8)
+        qty = arredondar_step(qty, step)
+        # Arredondar para baixo pode deixar a ordem abaixo do notional mínimo
+        if qty * preco < min_notional:
+            qty = arredondar_step(qty + step, step)
+        return qty
     except Exception as e:
         st.error(f"Erro ao calcular quantidade: {str(e)}")
         return 0
 
-@st.cache_data(ttl=60)
-def get_saldos_futuros(client=None):
+def _buscar_saldos(client):
+    balance = client.futures_account_balance()
+    account_info = client.futures_account()
+    saldos = {b["asset"]: float(b["balance"]) for b in balance}
+    disponivel = {a["asset"]: float(a["availableBalance"]) for a in account_info["assets"]}
+    return saldos, disponivel
+
+def get_saldos_futuros(client=None, atualizar=False):
     try:
         if not client:
             return "API não configurada", {}
-        balance = client.futures_account_balance()
-        account_info = client.futures_account()
-        saldos = {b["asset"]: float(b["balance"]) for b in balance}
-        disponivel = {a["asset"]: float(a["availableBalance"]) for a in account_info["assets"]}
-        return saldos, disponivel
+        # Com o user data stream ativo, os saldos já estão em memória e atualizados por evento;
+        # `atualizar` (antes de enviar ordens) só relê a conta por REST se a margem disponível ainda
+        # for a estimativa de um ACCOUNT_UPDATE sem ressincronização
+        stream = get_user_stream(client)
+        if stream.pronto:
+            if atualizar and stream.state.margem_provisoria:
+                stream.sincronizar()
+            saldos, disponivel, _ = stream.state.snapshot()
+            return saldos, disponivel
+        # Sem stream: REST na região de saldos, indexada apenas pelo id da conta (hash das credenciais)
+        if atualizar:
+            get_swr_cache().invalidate(REGIAO_SALDOS, client.conta_id, hard=True)
+        return get_swr_cache().get(REGIAO_SALDOS, client.conta_id, lambda: _buscar_saldos(client), ttl=60)
     except Exception as e:
         return f"Erro: {str(e)}", {}
 
-def estimate_days_to_expiry(symbol):
+def get_realizado(client, username):
+    # Funding e comissões reais por ordem, conciliados do /fapi/v1/income (uma chamada paginada por conta)
+    if not client:
+        return {}
     try:
-        date_part = symbol.split("_")[-1]
-        expiry = datetime.strptime("20" + date_part, "%Y%m%d").replace(tzinfo=timezone.utc)
-        return max((expiry - datetime.now(timezone.utc)).days, 1)
-    except:
-        return 90
+        ledger = get_operations_ledger(username)
+        return get_swr_cache().get(REGIAO_RECEITAS, client.conta_id, lambda: reconciliar(client, ledger), ttl=300)
+    except Exception as e:
+        print(f"Erro ao conciliar receitas: {str(e)}")
+        return {}
+
+def preenchimento(perna, preco_referencia, qty_enviada, client=None):
+    # Preço médio e quantidade executados da perna (resposta RESULT); referência pré-trade como fallback.
+    # A comissão real vem do evento da ordem no user data stream, se chegar a tempo; senão é estimada
+    # Só o que falta na resposta usa o fallback: uma execução de 0 continua 0
+    preco = perna["avg_price"] if perna.get("avg_price") is not None else preco_referencia
+    qty = perna["executed_qty"] if perna.get("executed_qty") is not None else qty_enviada
+    taxa = preco * qty * TAXA_TRADING
+    stream = get_user_stream(client) if client else None
+    if stream and stream.pronto and perna.get("order_id") is not None:
+        evento = stream.state.ordem(perna["order_id"], timeout=ESPERA_EVENTO_ORDEM)
+        if evento and evento["status"] == "FILLED":
+            preco, qty = evento["avg_price"] or preco, evento["executed_qty"] or qty
+            if evento.get("comissao_asset") == "USDT":
+                taxa = evento["comissao"]
+                perna["comissao"] = taxa
+            if perna.get("fill_ms") is None:
+                perna["fill_ms"] = evento["update_ms"]
+    return preco, qty, taxa
 
 def executar_arbitragem(symbol_perp, symbol_fut, volume, client, username):
     if not client:
         return {"success": False, "error": "API não configurada"}
     
     try:
-        # Verificar saldos
-        saldos, disponivel = get_saldos_futuros(client)
+        # Verificar saldos (sempre atualizados antes de enviar ordens)
+        saldos, disponivel = get_saldos_futuros(client, atualizar=True)
         if isinstance(saldos, str):
             return {"success": False, "error": saldos}
         
@@ -362,7 +418,7 @@ def executar_arbitragem(symbol_perp, symbol_fut, volume, client, username):
             return {"success": False, "error": f"Saldo USDT insuficiente. Disponível: ${float(disponivel.get('USDT', 0)):.2f}"}
         
         # Obter preços atuais
-        preco_perp, preco_fut = get_prices(symbol_perp, symbol_fut, client)
+        preco_perp, preco_fut = get_prices(symbol_perp, symbol_fut)
         if not preco_perp or not preco_fut:
             return {"success": False, "error": "Falha ao obter preços"}
         
@@ -373,146 +429,288 @@ def executar_arbitragem(symbol_perp, symbol_fut, volume, client, username):
         if qty_perp <= 0 or qty_fut <= 0:
             return {"success": False, "error": "Quantidade calculada inválida"}
         
-        # Executar ordens
-        ordem_perp = client.futures_create_order(
-            symbol=symbol_perp, 
-            side="SELL", 
-            type="MARKET", 
-            quantity=qty_perp
-        )
-        
-        ordem_fut = client.futures_create_order(
-            symbol=symbol_fut, 
-            side="BUY", 
-            type="MARKET", 
-            quantity=qty_fut
-        )
+        # Executar as duas pernas numa única requisição (short no perpétuo, long no trimestral)
+        execucao = enviar_pernas(client, [(symbol_perp, "SELL", qty_perp), (symbol_fut, "BUY", qty_fut)])
+        preco_exec_perp, qty_exec_perp, taxa_perp = preenchimento(execucao["pernas"][0], preco_perp, qty_perp, client)
+        preco_exec_fut, qty_exec_fut, taxa_fut = preenchimento(execucao["pernas"][1], preco_fut, qty_fut, client)
+        execucao["skew_fill_ms"] = skew(execucao["pernas"], "fill_ms")
         
         # Registrar operação
-        funding_rate, funding_ts = get_recent_funding(symbol_perp)
-        nova_ordem = {
-            "data_entrada": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
-            "symbol_perpetuo": symbol_perp,
-            "symbol_futuro": symbol_fut,
-            "preco_entrada_perp": preco_perp,
-            "preco_entrada_futuro": preco_fut,
-            "volume_usd": volume,
-            "funding_rate_entrada_diario": funding_rate,
-            "funding_timestamp_entrada": funding_ts,
-            "taxa_abertura": round(volume * 2 * TAXA_TRADING, 2),
-            "status": "aberta",
-            "ordem_perp_id": ordem_perp.get("orderId"),
-            "ordem_fut_id": ordem_fut.get("orderId"),
-            "qty_perp": qty_perp,
-            "qty_fut": qty_fut
-        }
+        nova_ordem = nova_operacao(
+            symbol_perp, symbol_fut, volume, (preco_exec_perp, preco_exec_fut), (preco_perp, preco_fut),
+            (qty_exec_perp, qty_exec_fut), taxa_perp + taxa_fut, execucao
+        )
+        nova_ordem["ordem_perp_id"] = execucao["pernas"][0]["order_id"]
+        nova_ordem["ordem_fut_id"] = execucao["pernas"][1]["order_id"]
         
-        operacoes = carregar_operacoes(username)
-        operacoes.append(nova_ordem)
-        salvar_operacoes(operacoes, username)
+        get_operations_ledger(username).inserir(nova_ordem)
         
         return {"success": True, "ordem": nova_ordem}
     
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def fechar_arbitragem(ordem_idx, operacoes, client, username):
+def nova_operacao(symbol_perp, symbol_fut, volume, precos_exec, precos_ref, qtys, taxa, execucao, data_entrada=None):
+    # Registro de uma operação aberta a partir dos preços e quantidades executados
+    funding_rate, funding_ts = get_recent_funding(symbol_perp)
+    return {
+        "data_entrada": data_entrada or datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "symbol_perpetuo": symbol_perp,
+        "symbol_futuro": symbol_fut,
+        "preco_entrada_perp": precos_exec[0],
+        "preco_entrada_futuro": precos_exec[1],
+        "preco_referencia_perp": precos_ref[0],
+        "preco_referencia_futuro": precos_ref[1],
+        "volume_usd": volume,
+        "funding_rate_entrada_diario": funding_rate,
+        "funding_timestamp_entrada": funding_ts,
+        # Estimativa pela taxa taker sobre o valor executado; a conciliação de receitas traz a comissão real
+        "taxa_abertura": round(taxa, 2),
+        "status": "aberta",
+        "qty_perp": qtys[0],
+        "qty_fut": qtys[1],
+        "execucao_entrada": execucao
+    }
+
+def operacao_fatiada(pai):
+    # Operação resultante de uma execução fatiada: preços médios ponderados das ordens-filhas
+    preco_perp = pai["notional_perp"] / pai["executado_perp"] if pai["executado_perp"] else pai["preco_referencia_perp"]
+    preco_fut = pai["notional_fut"] / pai["executado_fut"] if pai["executado_fut"] else pai["preco_referencia_futuro"]
+    execucao = {campo: pai[campo] for campo in ("skew_fill_ms", "sem_hedge")}
+    execucao.update(ordem_pai_id=pai["id"], fatias=pai["fatias_enviadas"], correcoes=pai["correcoes"])
+    ordem = nova_operacao(
+        pai["symbol_perpetuo"], pai["symbol_futuro"], round(pai["notional_perp"], 2), (preco_perp, preco_fut),
+        (pai["preco_referencia_perp"], pai["preco_referencia_futuro"]), (pai["executado_perp"], pai["executado_fut"]),
+        pai["taxa"], execucao, data_entrada=pai["data_inicio"]
+    )
+    ordem["ordem_pai_id"] = pai["id"]
+    # Provisória enquanto a execução estiver ativa: quantidades parciais, fechamento bloqueado
+    ordem["provisoria"] = pai["status"] in STATUS_PAI_ATIVOS
+    return ordem
+
+def filtros_ordem(symbol):
+    # (step, notional mínimo) do símbolo, com os mesmos padrões de calcular_qty
+    filtros = get_exchange_index().get(symbol) or {}
+    return get_step_size(symbol), filtros.get("min_notional") or 100
+
+def executar_arbitragem_fatiada(symbol_perp, symbol_fut, volume, client, username, tamanho_fatia, intervalo_s,
+                                tolerancia_hedge, limite_basis, pausa_maxima_s):
     if not client:
         return {"success": False, "error": "API não configurada"}
     
     try:
-        ordem = operacoes[ordem_idx]
-        
-        # Obter preços atuais
-        preco_atual_perp = float(client.futures_symbol_ticker(symbol=ordem["symbol_perpetuo"])["price"])
-        preco_atual_fut = float(requests.get(f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={ordem['symbol_futuro']}").json()["price"])
-        
-        # Executar ordens de fechamento
-        client.futures_create_order(
-            symbol=ordem["symbol_perpetuo"], 
-            side="BUY", 
-            type="MARKET", 
-            quantity=ordem["qty_perp"]
-        )
-        
-        client.futures_create_order(
-            symbol=ordem["symbol_futuro"], 
-            side="SELL", 
-            type="MARKET", 
-            quantity=ordem["qty_fut"]
-        )
-        
-        # Atualizar registro da operação
-        ordem["status"] = "fechada"
-        ordem["data_saida"] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
-        ordem["preco_saida_perp"] = preco_atual_perp
-        ordem["preco_saida_futuro"] = preco_atual_fut
-        ordem["taxa_fechamento"] = round(ordem["volume_usd"] * 2 * TAXA_TRADING, 2)
-        
-        # Calcular PnL final
-        data_ts = int(datetime.strptime(ordem["data_entrada"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp() * 1000)
-        funding_history = get_funding_history(ordem["symbol_perpetuo"], start_time=data_ts)
-        pnl_funding = sum([item["rate"] for item in funding_history]) * ordem["volume_usd"]
+        saldos, disponivel = get_saldos_futuros(client, atualizar=True)
+        if isinstance(saldos, str):
+            return {"success": False, "error": saldos}
         
-        pnl_futuro = (preco_atual_fut - ordem["preco_entrada_futuro"]) * (ordem["volume_usd"] / ordem["preco_entrada_futuro"])
-        pnl_perp = (ordem["preco_entrada_perp"] - preco_atual_perp) * (ordem["volume_usd"] / ordem["preco_entrada_perp"])
-        pnl_basis = pnl_futuro + pnl_perp
+        if float(disponivel.get("USDT", 0)) < volume:
+            return {"success": False, "error": f"Saldo USDT insuficiente. Disponível: ${float(disponivel.get('USDT', 0)):.2f}"}
         
-        ordem["pnl_funding"] = pnl_funding
-        ordem["pnl_basis"] = pnl_basis
-        ordem["pnl_total"] = pnl_funding + pnl_basis - ordem["taxa_abertura"] - ordem["taxa_fechamento"]
+        preco_perp, preco_fut = get_prices(symbol_perp, symbol_fut)
+        if not preco_perp or not preco_fut:
+            return {"success": False, "error": "Falha ao obter preços"}
         
-        salvar_operacoes(operacoes, username)
+        qty_perp = calcular_qty(volume, preco_perp, symbol_perp)
+        qty_fut = calcular_qty(volume, preco_fut, symbol_fut)
+        if qty_perp <= 0 or qty_fut <= 0:
+            return {"success": False, "error": "Quantidade calculada inválida"}
         
-        return {"success": True, "ordem": ordem}
+        pai = nova_ordem_pai(
+            symbol_perp, symbol_fut, volume, qty_perp, qty_fut, preco_perp, preco_fut,
+            {symbol: filtros_ordem(symbol) for symbol in (symbol_perp, symbol_fut)},
+            tamanho_fatia, intervalo_s, tolerancia_hedge, limite_basis, pausa_maxima_s
+        )
+        ordem_pai_id = iniciar_execucao(client, get_operations_ledger(username), pai, **callbacks_fatiada(pai, client))
+        return {"success": True, "ordem_pai_id": ordem_pai_id, "n_fatias": pai["n_fatias"]}
     
     except Exception as e:
         return {"success": False, "error": str(e)}
 
-def calcular_pnl_atual(ordem, client=None):
+def callbacks_fatiada(pai, client):
+    # As fatias rodam numa thread: preços do feed, comissões do user data stream
+    return {
+        "precos": lambda: (preco_atual(pai["symbol_perpetuo"]), preco_atual(pai["symbol_futuro"])),
+        "preencher": lambda perna, preco, qty: preenchimento(perna, preco, qty, client),
+        "montar_operacao": operacao_fatiada,
+    }
+
+def sem_atividade(pai, agora_ms):
+    # Ativa sem thread neste processo e sem gravação recente: o processo que executava caiu
+    return (
+        pai["status"] in STATUS_PAI_ATIVOS and not em_execucao(pai["id"])
+        and agora_ms - pai["atualizado_ts"] > (pai["intervalo_s"] + 60) * 1000
+    )
+
+def dono_fechamento(username):
+    # Identifica cada tentativa de fechamento (máquina, processo, usuário e um sufixo aleatório)
+    return f"{socket.gethostname()}:{os.getpid()}:{username}:{uuid.uuid4().hex[:8]}"
+
+def concluir_fechamento(ordem, pernas_saida, precos_referencia, execucao, client, ledger, dono):
+    # Fecha o registro da ordem a partir das pernas de saída executadas; PnL aos preços executados
+    ordem["status"] = "fechada"
+    ordem.pop("fechamento", None)
+    ordem["execucao_saida"] = execucao
+    ordem["data_saida"] = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    preco_saida_perp, _, taxa_perp = preenchimento(pernas_saida[0], precos_referencia[0], ordem["qty_perp"], client)
+    preco_saida_fut, _, taxa_fut = preenchimento(pernas_saida[1], precos_referencia[1], ordem["qty_fut"], client)
+    execucao["skew_fill_ms"] = skew(pernas_saida, "fill_ms")
+    ordem["preco_saida_perp"] = preco_saida_perp
+    ordem["preco_saida_futuro"] = preco_saida_fut
+    ordem["preco_referencia_saida_perp"] = precos_referencia[0]
+    ordem["preco_referencia_saida_futuro"] = precos_referencia[1]
+    ordem["taxa_fechamento"] = round(taxa_perp + taxa_fut, 2)
+    
+    # Concilia as receitas da conta antes de fechar o PnL (funding e comissões reais, quando já disponíveis)
     try:
-        # Obter preços atuais
-        if client:
-            preco_atual_perp = float(client.futures_symbol_ticker(symbol=ordem["symbol_perpetuo"])["price"])
+        realizado = reconciliar(client, ledger)
+        get_swr_cache().invalidate(REGIAO_RECEITAS, client.conta_id)
+    except Exception as e:
+        print(f"Erro ao conciliar receitas: {str(e)}")
+        realizado = {}
+    
+    # Calcular PnL final com o mesmo motor usado na aba de operações abertas, aos preços executados
+    pnl = avaliar_carteira(
+        [ordem],
+        {ordem["symbol_perpetuo"]: preco_saida_perp, ordem["symbol_futuro"]: preco_saida_fut},
+        get_funding_store(),
+        realizado
+    ).iloc[0]
+    
+    ordem["pnl_funding"] = float(pnl["pnl_funding"])
+    ordem["pnl_basis"] = float(pnl["pnl_basis"])
+    ordem["taxa_abertura"] = float(pnl["taxa_abertura"])
+    ordem["taxa_fechamento"] = realizado.get(ordem["id"], {}).get("taxa_fechamento", ordem["taxa_fechamento"])
+    ordem["funding_realizado"] = bool(pnl["funding_realizado"])
+    ordem["pnl_total"] = ordem["pnl_funding"] + ordem["pnl_basis"] - ordem["taxa_abertura"] - ordem["taxa_fechamento"]
+    
+    ledger.atualizar(ordem, status_esperado=STATUS_FECHANDO, dono=dono)
+    return ordem
+
+def fechar_arbitragem(ordem, client, username):
+    if not client:
+        return {"success": False, "error": "API não configurada"}
+    
+    ledger = get_operations_ledger(username)
+    dono = dono_fechamento(username)
+    # Reserva o fechamento no banco: outra aba/worker que tente fechar a mesma ordem é recusada
+    if not ledger.reservar_fechamento(ordem["id"], dono):
+        return {"success": False, "error": "Ordem já está sendo fechada ou já foi fechada em outra sessão"}
+    
+    try:
+        # Preços de referência pré-trade (usados só se a resposta não trouxer o preço executado)
+        preco_atual_perp = preco_atual(ordem["symbol_perpetuo"])
+        preco_atual_fut = preco_atual(ordem["symbol_futuro"])
+    except Exception as e:
+        # Nada foi enviado à corretora: a ordem volta a ficar disponível para fechamento
+        ledger.liberar_fechamento(ordem["id"], dono)
+        return {"success": False, "error": str(e)}
+    
+    # Executar as duas pernas de fechamento numa única requisição
+    try:
+        execucao = enviar_pernas(
+            client,
+            [(ordem["symbol_perpetuo"], "BUY", ordem["qty_perp"]), (ordem["symbol_futuro"], "SELL", ordem["qty_fut"])],
+            abertura=False
+        )
+    except ErroExecucao as e:
+        # O registro do envio é gravado antes de qualquer decisão: é dele que a reconciliação parte.
+        # Perna sem hedge ou com resultado desconhecido: a reserva fica até a conferência das posições
+        if e.pernas["sem_hedge"] or e.pernas["indefinidas"]:
+            ledger.anotar_fechamento(ordem["id"], dono, erro=str(e), execucao_saida=e.pernas)
+            return {"success": False, "error": f"{str(e)}. Use \"Reconciliar fechamento\" para concluir."}
+        # Nenhuma perna ficou executada (rejeitadas ou desfeitas): a ordem continua aberta
+        ledger.liberar_fechamento(ordem["id"], dono)
+        return {"success": False, "error": str(e)}
+    except Exception as e:
+        # Resultado desconhecido: a reserva fica, marcada para reconciliação com as posições
+        ledger.anotar_fechamento(ordem["id"], dono, erro=str(e))
+        return {"success": False, "error": f"{str(e)}. Use \"Reconciliar fechamento\" para verificar as posições."}
+    
+    ledger.anotar_fechamento(ordem["id"], dono, execucao_saida=execucao)
+    try:
+        ordem = concluir_fechamento(
+            ordem, execucao["pernas"], (preco_atual_perp, preco_atual_fut), execucao, client, ledger, dono
+        )
+        return {"success": True, "ordem": ordem}
+    except Exception as e:
+        # As ordens já foram executadas; a execução salva permite concluir pela reconciliação
+        ledger.anotar_fechamento(ordem["id"], dono, erro=str(e))
+        return {"success": False, "error": f"Ordens de fechamento executadas, mas o registro falhou: {str(e)}"}
+
+def estado_pernas(ordem, posicoes, outras):
+    # Para cada perna: 'aberta' se a posição na corretora ainda inclui a ordem, 'fechada' se só cobre as demais
+    estado = {}
+    for chave, campo, sinal in (("perp", "symbol_perpetuo", -1), ("fut", "symbol_futuro", 1)):
+        symbol, qty = ordem[campo], ordem[f"qty_{chave}"]
+        demais = sum(o[f"qty_{chave}"] for o in outras if o[campo] == symbol)
+        atual = sinal * posicoes.get(symbol, 0.0)
+        tolerancia = qty * TOLERANCIA_POSICAO
+        if abs(atual - demais - qty) <= tolerancia:
+            estado[chave] = "aberta"
+        elif abs(atual - demais) <= tolerancia:
+            estado[chave] = "fechada"
         else:
-            preco_atual_perp = float(requests.get(f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={ordem['symbol_perpetuo']}").json()["price"])
-            
-        preco_atual_fut = float(requests.get(f"https://fapi.binance.com/fapi/v1/ticker/price?symbol={ordem['symbol_futuro']}").json()["price"])
-        
-        # Calcular PnL de funding
-        data_ts = int(datetime.strptime(ordem["data_entrada"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc).timestamp() * 1000)
-        funding_history = get_funding_history(ordem["symbol_perpetuo"], start_time=data_ts)
-        pnl_funding = sum([item["rate"] for item in funding_history]) * ordem["volume_usd"]
-        apr = calcular_apr(funding_history)
-        
-        # Calcular PnL de basis
-        pnl_futuro = (preco_atual_fut - ordem["preco_entrada_futuro"]) * (ordem["volume_usd"] / ordem["preco_entrada_futuro"])
-        pnl_perp = (ordem["preco_entrada_perp"] - preco_atual_perp) * (ordem["volume_usd"] / ordem["preco_entrada_perp"])
-        pnl_basis = pnl_futuro + pnl_perp
+            raise RuntimeError(
+                f"Posição em {symbol} ({atual:g}) não confere com o ledger ({demais:g} de outras ordens + {qty:g} desta)"
+            )
+    return estado
+
+def reconciliar_fechamento(ordem_id, client, username):
+    # Conclui ou libera uma reserva de fechamento abandonada conferindo as posições na corretora
+    if not client:
+        return {"success": False, "error": "API não configurada"}
+    
+    ledger = get_operations_ledger(username)
+    dono = dono_fechamento(username)
+    if not ledger.assumir_fechamento(ordem_id, dono, TIMEOUT_FECHAMENTO):
+        return {"success": False, "error": "O fechamento ainda está em andamento em outra sessão"}
+    
+    try:
+        abertas = ledger.abertas()
+        ordem = next(o for o in abertas if o["id"] == ordem_id)
+        posicoes = {
+            p["symbol"]: float(p["positionAmt"])
+            for p in client.futures_position_information()
+            if p["symbol"] in (ordem["symbol_perpetuo"], ordem["symbol_futuro"])
+        }
+        estado = estado_pernas(ordem, posicoes, [o for o in abertas if o["id"] != ordem_id])
         
-        # Calcular PnL total
-        pnl_total = pnl_funding + pnl_basis - ordem["taxa_abertura"]
+        if estado["perp"] == estado["fut"] == "aberta":
+            ledger.liberar_fechamento(ordem_id, dono)
+            return {"success": True, "liberada": True}
         
-        return {
-            "pnl_funding": pnl_funding,
-            "pnl_basis": pnl_basis,
-            "pnl_futuro": pnl_futuro,
-            "pnl_perp": pnl_perp,
-            "pnl_total": pnl_total,
-            "apr": apr,
-            "funding_history": funding_history
+        # Pernas já fechadas: preço da execução salva (perna executada e não desfeita), se houver
+        execucao = ordem.get("execucao_saida") or {"pernas": [], "sem_hedge": []}
+        executadas = {
+            p["symbol"]: p for p in execucao["pernas"]
+            if p.get("executed_qty") and "erro" not in p and ("desfeita" not in p or "erro" in p["desfeita"])
         }
+        pernas_saida = [
+            executadas.get(ordem["symbol_perpetuo"], {}) if estado["perp"] == "fechada" else None,
+            executadas.get(ordem["symbol_futuro"], {}) if estado["fut"] == "fechada" else None,
+        ]
+        pendentes = [
+            perna for perna, saida in zip(
+                [(ordem["symbol_perpetuo"], "BUY", ordem["qty_perp"]), (ordem["symbol_futuro"], "SELL", ordem["qty_fut"])],
+                pernas_saida
+            )
+            if saida is None
+        ]
+        if pendentes:
+            # Uma perna fechada e outra aberta: completa o fechamento da que ficou
+            enviadas = iter(enviar_pernas(client, pendentes, abertura=False)["pernas"])
+            pernas_saida = [next(enviadas) if saida is None else saida for saida in pernas_saida]
+        # Perna fechada sem execução registrada (processo caiu no envio): saída estimada ao preço atual
+        ordem["saida_estimada"] = any(not perna for perna in pernas_saida)
+        execucao["reconciliada"] = {"estado": estado, "pernas": pernas_saida}
+        ordem = concluir_fechamento(
+            ordem, pernas_saida, (preco_atual(ordem["symbol_perpetuo"]), preco_atual(ordem["symbol_futuro"])),
+            execucao, client, ledger, dono
+        )
+        return {"success": True, "ordem": ordem}
     except Exception as e:
-        st.error(f"Erro ao calcular PnL: {str(e)}")
-        return {
-            "pnl_funding": 0,
-            "pnl_basis": 0,
-            "pnl_futuro": 0,
-            "pnl_perp": 0,
-            "pnl_total": 0,
-            "apr": 0,
-            "funding_history": []
-        }
+        ledger.anotar_fechamento(ordem_id, dono, erro=str(e))
+        return {"success": False, "error": str(e)}
 
 def criar_grafico_funding(funding_history, symbol):
     if not funding_history:
@@ -542,28 +740,22 @@ def criar_grafico_funding(funding_history, symbol):
     
     return fig
 
-def criar_grafico_pnl(operacoes_abertas, client=None):
-    if not operacoes_abertas:
-        return None
-    
-    data = []
-    for op in operacoes_abertas:
-        try:
-            pnl = calcular_pnl_atual(op, client)
-            data.append({
-                "Ordem": f"#{operacoes_abertas.index(op)+1} {op['symbol_perpetuo']}",
-                "PnL Funding": pnl["pnl_funding"],
-                "PnL Basis": pnl["pnl_basis"],
-                "Taxas": -op["taxa_abertura"],
-                "PnL Total": pnl["pnl_total"]
-            })
-        except:
-            pass
-    
-    if not data:
+def tabela_historico(ops):
+    # Tabela de histórico da página visível
+    return pd.DataFrame([linha_historico(op) for op in ops], columns=COLUNAS_HISTORICO)
+
+def criar_grafico_pnl(carteira):
+    validas = carteira.dropna(subset=["pnl_total"])
+    if validas.empty:
         return None
     
-    df = pd.DataFrame(data)
+    df = pd.DataFrame({
+        "Ordem": [f"#{idx+1} {symbol}" for idx, symbol in zip(validas.index, validas["symbol_perpetuo"])],
+        "PnL Funding": validas["pnl_funding"],
+        "PnL Basis": validas["pnl_basis"],
+        "Taxas": -validas["taxa_abertura"],
+        "PnL Total": validas["pnl_total"]
+    })
     df_melted = pd.melt(
         df, 
         id_vars=["Ordem"], 
@@ -652,6 +844,48 @@ def main():
             st.error("Não foi possível obter os símbolos trimestrais. Verifique sua conexão.")
             return
         
+        # Ranking de todos os pares trimestrais
+        with st.expander("📋 Ranking de Oportunidades (todos os pares trimestrais)", expanded=True):
+            try:
+                inicio = time.perf_counter()
+                simbolos = list(quarter_symbols.keys()) + list(quarter_symbols.values())
+                ranking = escanear_oportunidades(
+                    quarter_symbols,
+                    precos_atuais(simbolos),
+                    get_recent_funding_bulk(quarter_symbols.keys()),
+                    FUNDING_THRESHOLD,
+                    FUNDING_BASIS_RATIO
+                )
+                duracao_ms = (time.perf_counter() - inicio) * 1000
+                
+                if ranking.empty:
+                    st.info("Sem dados suficientes para montar o ranking.")
+                else:
+                    tabela = pd.DataFrame({
+                        "Perpétuo": ranking["Perpétuo"],
+                        "Trimestral": ranking["Trimestral"],
+                        "Basis (%)": ranking["basis_pct"] * 100,
+                        "Basis Diário (%)": ranking["basis_dia"] * 100,
+                        "Funding Diário (%)": ranking["funding_diario"] * 100,
+                        "Funding/Basis": ranking["relacao_fb"],
+                        "Dias p/ Venc.": ranking["dias_venc"],
+                        "Gatilho": ranking["gatilho"]
+                    })
+                    st.dataframe(
+                        tabela,
+                        use_container_width=True,
+                        hide_index=True,
+                        column_config={
+                            "Basis (%)": st.column_config.NumberColumn(format="%.4f"),
+                            "Basis Diário (%)": st.column_config.NumberColumn(format="%.4f"),
+                            "Funding Diário (%)": st.column_config.NumberColumn(format="%.4f"),
+                            "Funding/Basis": st.column_config.NumberColumn(format="%.2f")
+                        }
+                    )
+                    st.caption(f"{len(ranking)} pares avaliados em {duracao_ms:.0f} ms")
+            except Exception as e:
+                st.error(f"Erro ao montar ranking de oportunidades: {str(e)}")
+        
         col_select, col_refresh = st.columns([5, 1])
         with col_select:
             selected_perp = st.selectbox(
@@ -662,7 +896,10 @@ def main():
         
         with col_refresh:
             if st.button("🔄 Atualizar"):
-                st.cache_data.clear()
+                # Recarrega só os dados ao vivo do par selecionado, sem afetar outros usuários
+                get_swr_cache().invalidate(REGIAO_FUNDING, prefixo=(selected_perp,), hard=True)
+                get_funding_store().invalidate(selected_perp)
+                get_price_snapshot().invalidate()
                 st.rerun()
         
         selected_fut = quarter_symbols.get(selected_perp)
@@ -673,17 +910,22 @@ def main():
         
         # Obter dados de mercado
         funding_diario, funding_ts = get_recent_funding(selected_perp)
-        preco_perp, preco_fut = get_prices(selected_perp, selected_fut, client)
+        preco_perp, preco_fut = get_prices(selected_perp, selected_fut)
         
         if not preco_perp or not preco_fut:
             st.error("Não foi possível obter os preços. Verifique sua conexão.")
             return
         
-        dias_venc = estimate_days_to_expiry(selected_fut)
-        basis_pct = (preco_fut - preco_perp) / preco_perp
-        basis_dia = basis_pct / dias_venc
-        relacao_fb = funding_diario / basis_dia if basis_dia else 0
-        gatilho = (funding_diario > FUNDING_THRESHOLD) or (funding_diario > FUNDING_BASIS_RATIO * basis_dia)
+        info_fut = get_exchange_index().get(selected_fut) or {}
+        vencimento = [info_fut["delivery_date"]] if info_fut.get("delivery_date") else vencimento_ms([selected_fut])
+        sinais = calcular_sinais([preco_perp], [preco_fut], [funding_diario], vencimento)
+        dias_venc = float(sinais["dias_venc"][0])
+        basis_pct = float(sinais["basis_pct"][0])
+        basis_dia = float(sinais["basis_dia"][0])
+        relacao_fb = float(sinais["relacao_fb"][0])
+        gatilho_funding = bool(sinais["gatilho_funding"][0])
+        gatilho_ratio = bool(sinais["gatilho_ratio"][0])
+        gatilho = bool(sinais["gatilho"][0])
         
         # Exibir cards de métricas
         st.markdown('<div class="card">', unsafe_allow_html=True)
@@ -698,7 +940,7 @@ def main():
             st.markdown(f"""
             <div class="metric-label">Preço Futuro Trimestral</div>
             <div class="metric-value">${preco_fut:,.2f}</div>
-            <div class="metric-change">Vencimento em {dias_venc} dias</div>
+            <div class="metric-change">Vencimento em {dias_venc:.1f} dias</div>
             """, unsafe_allow_html=True)
         
         with col2:
@@ -713,6 +955,12 @@ def main():
             <div class="metric-value {'positive' if funding_diario > 0 else 'negative'}">{funding_diario:.4%}</div>
             <div class="metric-change">Última atualização: {datetime.fromtimestamp(funding_ts/1000, tz=timezone.utc).strftime('%d/%m/%Y %H:%M UTC') if funding_ts else 'N/A'}</div>
             """, unsafe_allow_html=True)
+            
+            mercado_ws = get_market_store().get(selected_perp)
+            if mercado_ws and mercado_ws["funding_rate"] is not None and mercado_ws["mark_price"] and mercado_ws["next_funding_time"]:
+                st.markdown(f"""
+                <div class="metric-change">Próximo funding: {mercado_ws['funding_rate']:.4%} às {datetime.fromtimestamp(mercado_ws['next_funding_time']/1000, tz=timezone.utc).strftime('%H:%M UTC')} (mark ${mercado_ws['mark_price']:,.2f})</div>
+                """, unsafe_allow_html=True)
         
         with col3:
             st.markdown(f"""
@@ -728,6 +976,7 @@ def main():
             """, unsafe_allow_html=True)
         
         st.markdown('</div>', unsafe_allow_html=True)
+        st.caption(f"Funding recente: {descrever_frescor(REGIAO_FUNDING, (selected_perp, 'recente', 3))} · Símbolos: {descrever_frescor(REGIAO_SIMBOLOS, 'trimestrais')}")
         
         # Explicação da oportunidade
         if gatilho:
@@ -740,8 +989,8 @@ def main():
             - **Comprar** contrato trimestral {selected_fut} (long)
             
             **Razões para entrada:**
-            {'- Funding rate diário elevado: ' + str(funding_diario*100)[:5] + '% (acima do threshold de ' + str(FUNDING_THRESHOLD*100) + '%)' if funding_diario > FUNDING_THRESHOLD else ''}
-            {'- Funding rate ' + str(relacao_fb)[:4] + 'x maior que o basis diário (acima do ratio mínimo de ' + str(FUNDING_BASIS_RATIO) + 'x)' if funding_diario > FUNDING_BASIS_RATIO * basis_dia else ''}
+            {'- Funding rate diário elevado: ' + str(funding_diario*100)[:5] + '% (acima do threshold de ' + str(FUNDING_THRESHOLD*100) + '%)' if gatilho_funding else ''}
+            {'- Funding rate ' + str(relacao_fb)[:4] + 'x maior que o basis diário (acima do ratio mínimo de ' + str(FUNDING_BASIS_RATIO) + 'x)' if gatilho_ratio else ''}
             """, unsafe_allow_html=True)
             st.markdown('</div>', unsafe_allow_html=True)
         else:
@@ -761,8 +1010,7 @@ def main():
         st.markdown('<div class="sub-header">📊 Histórico de Funding Rate</div>', unsafe_allow_html=True)
         
         # Obter histórico de funding dos últimos 30 dias
-        start_time = int((datetime.now(timezone.utc) - timedelta(days=30)).timestamp() * 1000)
-        funding_history = get_funding_history(selected_perp, start_time=start_time)
+        funding_history = get_funding_history(selected_perp, dias=30)
         
         if funding_history:
             fig = criar_grafico_funding(funding_history, selected_perp)
@@ -831,6 +1079,28 @@ def main():
                 help="Volume em USD para cada lado da arbitragem (perpétuo e futuro)"
             )
             
+            with st.expander("✂️ Execução fatiada (TWAP)"):
+                fatiar = st.checkbox(
+                    "Fatiar a ordem",
+                    help="Divide o volume em ordens menores a intervalos fixos, reduzindo o impacto no book do trimestral"
+                )
+                col_fatia, col_intervalo = st.columns(2)
+                with col_fatia:
+                    tamanho_fatia = st.number_input("Tamanho da fatia (USD)", min_value=100.0, value=500.0, step=50.0)
+                    tolerancia_hedge = st.number_input(
+                        "Tolerância de hedge (%)", min_value=0.1, max_value=20.0, value=TOLERANCIA_HEDGE * 100, step=0.5,
+                        help="Diferença máxima entre as frações executadas das duas pernas antes de completar a atrasada"
+                    )
+                    pausa_maxima = st.number_input("Pausa máxima (s)", min_value=10, value=PAUSA_MAXIMA, step=30)
+                with col_intervalo:
+                    intervalo_fatias = st.number_input("Intervalo entre fatias (s)", min_value=1, value=30, step=5)
+                    limite_basis = st.number_input(
+                        "Limite de alta do basis (%)", min_value=0.01, max_value=5.0, value=LIMITE_BASIS * 100, step=0.05,
+                        format="%.2f", help="Pausa as fatias enquanto o basis estiver acima do inicial por mais que isso"
+                    )
+                n_fatias = max(1, int(volume // tamanho_fatia))
+                st.caption(f"{n_fatias} fatias de ~${volume / n_fatias:,.2f} em ~{(n_fatias - 1) * intervalo_fatias}s")
+            
             col_submit, col_info = st.columns([1, 3])
             
             with col_submit:
@@ -859,6 +1129,15 @@ def main():
                 st.error("❌ Configure suas credenciais de API para executar ordens.")
             elif volume < 100:
                 st.error("❌ O volume mínimo permitido pela Binance é 100 USDT por lado.")
+            elif fatiar:
+                resultado = executar_arbitragem_fatiada(
+                    selected_perp, selected_fut, volume, client, st.session_state.username, tamanho_fatia,
+                    intervalo_fatias, tolerancia_hedge / 100, limite_basis / 100, pausa_maxima
+                )
+                if resultado["success"]:
+                    st.success(f"✅ Execução fatiada #{resultado['ordem_pai_id']} iniciada ({resultado['n_fatias']} fatias)")
+                else:
+                    st.error(f"❌ Erro ao iniciar execução fatiada: {resultado['error']}")
             else:
                 with st.spinner("Executando ordens..."):
                     resultado = executar_arbitragem(selected_perp, selected_fut, volume, client, st.session_state.username)
@@ -868,26 +1147,105 @@ def main():
                         st.json(resultado["ordem"])
                     else:
                         st.error(f"❌ Erro ao executar ordens: {resultado['error']}")
+        
+        # Acompanhamento das execuções fatiadas (gravadas no ledger pela thread de execução)
+        ordens_pai = get_operations_ledger(st.session_state.username).ordens_pai()
+        if ordens_pai:
+            st.markdown("#### ✂️ Execuções Fatiadas")
+            agora_ms = time.time() * 1000
+            linhas = []
+            for pai in ordens_pai:
+                frac_perp, frac_fut = progresso(pai)
+                status = pai["status"]
+                if sem_atividade(pai, agora_ms):
+                    status += " — sem atividade"
+                linhas.append({
+                    "ID": pai["id"],
+                    "Par": f"{pai['symbol_perpetuo']} / {pai['symbol_futuro']}",
+                    "Status": status,
+                    "Fatias": f"{pai['fatias_enviadas']}/{pai['n_fatias']}",
+                    "Perp (%)": frac_perp * 100,
+                    "Futuro (%)": frac_fut * 100,
+                    "Basis Δ (%)": (pai["basis_atual"] - pai["basis_inicial"]) * 100 if pai["basis_atual"] is not None else None,
+                    "Pausas": pai["pausas"],
+                    "Atualizada há (s)": (agora_ms - pai["atualizado_ts"]) / 1000,
+                    "Operação": pai.get("operacao_id"),
+                    "Motivo": pai["motivo"] or "",
+                })
+            st.dataframe(
+                pd.DataFrame(linhas).style.format(
+                    {"Perp (%)": "{:.1f}", "Futuro (%)": "{:.1f}", "Basis Δ (%)": "{:.3f}", "Atualizada há (s)": "{:.0f}"}, na_rep="—"
+                ),
+                use_container_width=True, hide_index=True
+            )
+            
+            col_sel, col_cancel, col_refresh = st.columns([2, 1, 1])
+            with col_sel:
+                pai_id = st.selectbox("Ordens-filhas da execução", [pai["id"] for pai in ordens_pai], format_func=lambda i: f"#{i}")
+            selecionada = next(pai for pai in ordens_pai if pai["id"] == pai_id)
+            parada = sem_atividade(selecionada, agora_ms)
+            ativa = selecionada["status"] in (STATUS_PAI_EXECUTANDO, STATUS_PAI_PAUSADA) and not parada
+            with col_cancel:
+                if st.button("⛔ Cancelar execução", disabled=not ativa, key="cancelar_fatiada"):
+                    # A thread de execução vê o pedido na próxima verificação e para antes da fatia seguinte
+                    if get_operations_ledger(st.session_state.username).cancelar_ordem_pai(pai_id):
+                        st.rerun()
+            with col_refresh:
+                if st.button("🔄 Atualizar", key="atualizar_fatiadas"):
+                    st.rerun()
+            
+            # Execução órfã: continua do progresso gravado ou encerra, deixando a operação provisória
+            # (pernas já executadas) como uma operação aberta comum, que pode ser fechada
+            if parada and client:
+                st.warning(f"⚠️ A execução #{pai_id} parou sem terminar (o processo que a executava caiu).")
+                col_retomar, col_encerrar = st.columns(2)
+                for coluna, rotulo, encerrar in ((col_retomar, "▶️ Retomar execução", False), (col_encerrar, "⏹️ Encerrar execução", True)):
+                    with coluna:
+                        if st.button(rotulo, disabled=not encerrar and selecionada["status"] == STATUS_PAI_CANCELANDO, key=f"retomar_{encerrar}"):
+                            if retomar_execucao(
+                                client, get_operations_ledger(st.session_state.username), selecionada,
+                                encerrar=encerrar, **callbacks_fatiada(selecionada, client)
+                            ):
+                                st.rerun()
+                            else:
+                                st.error("A execução foi retomada ou atualizada por outra sessão")
+            
+            filhas = get_operations_ledger(st.session_state.username).filhas(pai_id)
+            if filhas:
+                st.dataframe(pd.DataFrame([{
+                    "Fatia": f["fatia"] + 1,
+                    "Símbolo": f["symbol"],
+                    "Lado": f["side"],
+                    "Qtd Enviada": f["qty"],
+                    "Qtd Executada": f.get("executed_qty"),
+                    "Preço Médio": f.get("avg_price"),
+                    "Taxa": f.get("taxa"),
+                    "Ordem": f.get("order_id"),
+                    "Erro": f.get("erro", ""),
+                } for f in filhas]), use_container_width=True, hide_index=True)
     
     with tabs[1]:  # Tab Operações Abertas
         st.markdown('<div class="sub-header">📊 Operações Abertas</div>', unsafe_allow_html=True)
         
-        operacoes = carregar_operacoes(st.session_state.username)
-        abertas = [op for op in operacoes if op["status"] == "aberta"]
+        abertas = get_operations_ledger(st.session_state.username).abertas()
         
         if abertas:
-            # Resumo geral
-            total_funding = total_basis = total_taxa = total_total = 0.0
+            # Avaliação única da carteira, compartilhada pelo resumo, gráfico e detalhes
+            simbolos = {op["symbol_perpetuo"] for op in abertas} | {op["symbol_futuro"] for op in abertas}
+            try:
+                carteira = avaliar_carteira(
+                    abertas, precos_atuais(simbolos), get_funding_store(), get_realizado(client, st.session_state.username)
+                )
+            except Exception as e:
+                st.error(f"Erro ao calcular PnL: {str(e)}")
+                carteira = avaliar_carteira([], {}, get_funding_store())
             
-            for ordem in abertas:
-                try:
-                    pnl = calcular_pnl_atual(ordem, client)
-                    total_funding += pnl["pnl_funding"]
-                    total_basis += pnl["pnl_basis"]
-                    total_taxa += ordem["taxa_abertura"]
-                    total_total += pnl["pnl_total"]
-                except:
-                    pass
+            # Resumo geral
+            resumo = totais(carteira)
+            total_funding = resumo["pnl_funding"]
+            total_basis = resumo["pnl_basis"]
+            total_taxa = resumo["taxa_abertura"]
+            total_total = resumo["pnl_total"]
             
             # Cards de resumo
             st.markdown('<div class="card">', unsafe_allow_html=True)
@@ -922,7 +1280,7 @@ def main():
             st.markdown('</div>', unsafe_allow_html=True)
             
             # Gráfico de PnL
-            fig = criar_grafico_pnl(abertas, client)
+            fig = criar_grafico_pnl(carteira)
             if fig:
                 st.plotly_chart(fig, use_container_width=True)
             
@@ -930,7 +1288,9 @@ def main():
             for idx, ordem in enumerate(abertas):
                 with st.expander(f"📘 Ordem #{idx+1} — {ordem['symbol_perpetuo']} (Aberta em {ordem['data_entrada']})", expanded=idx==0):
                     try:
-                        pnl = calcular_pnl_atual(ordem, client)
+                        if idx not in carteira.index or pd.isna(carteira.at[idx, "pnl_total"]):
+                            raise ValueError(f"Preço atual indisponível para {ordem['symbol_perpetuo']}/{ordem['symbol_futuro']}")
+                        pnl = carteira.loc[idx]
                         
                         col1, col2 = st.columns([3, 2])
                         
@@ -964,7 +1324,7 @@ def main():
                             st.markdown("#### Resultado Atual")
                             
                             st.markdown(f"""
-                            <div class="metric-label">PnL Funding</div>
+                            <div class="metric-label">PnL Funding {'(realizado)' if pnl['funding_realizado'] else '(estimado)'}</div>
                             <div class="metric-value {'positive' if pnl['pnl_funding'] > 0 else 'negative'}">${pnl['pnl_funding']:.2f}</div>
                             """, unsafe_allow_html=True)
                             
@@ -985,7 +1345,7 @@ def main():
                             
                             st.markdown(f"""
                             <div class="metric-label">Taxa de Abertura</div>
-                            <div class="metric-value negative">-${ordem['taxa_abertura']:.2f}</div>
+                            <div class="metric-value negative">-${pnl['taxa_abertura']:.2f}</div>
                             """, unsafe_allow_html=True)
                             
                             st.markdown(f"""
@@ -999,9 +1359,32 @@ def main():
                             """, unsafe_allow_html=True)
                             
                             # Botão de fechamento
-                            if client and st.button(f"❌ Fechar Ordem", key=f"fechar_{idx}", type="primary"):
+                            if ordem.get("provisoria"):
+                                st.info(
+                                    f"✂️ Execução fatiada #{ordem['ordem_pai_id']} em andamento: quantidades parciais. "
+                                    "O fechamento fica disponível quando ela terminar ou for encerrada."
+                                )
+                            elif ordem["status"] == STATUS_FECHANDO:
+                                reserva = ordem.get("fechamento") or {}
+                                idade = (time.time() * 1000 - reserva.get("reservado_ts", 0)) / 1000
+                                if reserva.get("erro"):
+                                    st.error(f"⚠️ Fechamento interrompido: {reserva['erro']}")
+                                else:
+                                    st.warning(f"⏳ Fechamento em andamento ({reserva.get('dono', 'sessão desconhecida')}, há {idade:.0f}s)")
+                                # Reserva abandonada: confere as posições na corretora e conclui ou libera a ordem
+                                if client and (reserva.get("erro") or idade > TIMEOUT_FECHAMENTO) and st.button(
+                                    "🔁 Reconciliar fechamento", key=f"reconciliar_{ordem['id']}"
+                                ):
+                                    with st.spinner("Conferindo posições..."):
+                                        resultado = reconciliar_fechamento(ordem["id"], client, st.session_state.username)
+                                    if resultado["success"]:
+                                        st.success("✅ Ordem liberada (nenhuma perna foi fechada)" if resultado.get("liberada") else "✅ Fechamento concluído")
+                                        st.rerun()
+                                    else:
+                                        st.error(f"❌ Erro na reconciliação: {resultado['error']}")
+                            elif client and st.button(f"❌ Fechar Ordem", key=f"fechar_{idx}", type="primary"):
                                 with st.spinner("Fechando posição..."):
-                                    resultado = fechar_arbitragem(idx, operacoes, client, st.session_state.username)
+                                    resultado = fechar_arbitragem(ordem, client, st.session_state.username)
                                     
                                     if resultado["success"]:
                                         st.success(f"✅ Ordem #{idx+1} fechada com sucesso!")
@@ -1024,16 +1407,17 @@ def main():
     with tabs[2]:  # Tab Histórico
         st.markdown('<div class="sub-header">📜 Histórico de Operações</div>', unsafe_allow_html=True)
         
-        operacoes = carregar_operacoes(st.session_state.username)
-        fechadas = [op for op in operacoes if op["status"] == "fechada"]
+        ledger = get_operations_ledger(st.session_state.username)
+        # Agregados mantidos pelo ledger a cada fechamento (custo constante, qualquer que seja o histórico)
+        resumo = ledger.resumo()
         
-        if fechadas:
+        if resumo["n"]:
             # Resumo geral
-            total_volume = sum(op["volume_usd"] for op in fechadas)
-            total_pnl = sum(op.get("pnl_total", 0) for op in fechadas)
-            total_funding = sum(op.get("pnl_funding", 0) for op in fechadas)
-            total_basis = sum(op.get("pnl_basis", 0) for op in fechadas)
-            total_taxas = sum(op.get("taxa_abertura", 0) + op.get("taxa_fechamento", 0) for op in fechadas)
+            total_volume = resumo["volume"]
+            total_pnl = resumo["pnl"]
+            total_funding = resumo["funding"]
+            total_basis = resumo["basis"]
+            total_taxas = resumo["taxas"]
             
             # Cards de resumo
             st.markdown('<div class="card">', unsafe_allow_html=True)
@@ -1044,7 +1428,7 @@ def main():
             with col1:
                 st.markdown(f"""
                 <div class="metric-label">Total de Operações</div>
-                <div class="metric-value">{len(fechadas)}</div>
+                <div class="metric-value">{resumo['n']}</div>
                 """, unsafe_allow_html=True)
                 
                 st.markdown(f"""
@@ -1071,51 +1455,102 @@ def main():
             
             st.markdown('</div>', unsafe_allow_html=True)
             
+            with st.expander("📅 Resumo por par e por mês"):
+                colunas_resumo = {"n": "Operações", "volume": "Volume (USD)", "pnl": "PnL Total", "funding": "PnL Funding", "basis": "PnL Basis", "taxas": "Taxas"}
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.dataframe(
+                        pd.DataFrame.from_dict(ledger.resumo(ESCOPO_SYMBOL), orient="index").rename(columns=colunas_resumo),
+                        use_container_width=True
+                    )
+                with col2:
+                    st.dataframe(
+                        pd.DataFrame.from_dict(ledger.resumo(ESCOPO_MES), orient="index").rename(columns=colunas_resumo),
+                        use_container_width=True
+                    )
+            
             # Tabela de operações
             st.markdown("#### 📋 Detalhes das Operações Fechadas")
             
-            # Criar DataFrame para exibição
-            data = []
-            for op in fechadas:
-                data.append({
-                    "ID": fechadas.index(op) + 1,
-                    "Par": op["symbol_perpetuo"],
-                    "Data Entrada": op["data_entrada"],
-                    "Data Saída": op.get("data_saida", "N/A"),
-                    "Volume (USD)": op["volume_usd"],
-                    "PnL Funding": op.get("pnl_funding", 0),
-                    "PnL Basis": op.get("pnl_basis", 0),
-                    "Taxas": -(op.get("taxa_abertura", 0) + op.get("taxa_fechamento", 0)),
-                    "PnL Total": op.get("pnl_total", 0),
-                    "ROI (%)": (op.get("pnl_total", 0) / op["volume_usd"]) * 100 if op["volume_usd"] > 0 else 0
-                })
-            
-            df = pd.DataFrame(data)
+            # Filtros, ordenação e paginação aplicados na consulta ao banco
+            col1, col2, col3 = st.columns(3)
+            with col1:
+                filtro_par = st.selectbox("Par", ["Todos"] + list(ledger.resumo(ESCOPO_SYMBOL)), key="hist_par")
+                filtro_pnl = st.selectbox("PnL", ["Todos", "Positivo", "Negativo"], key="hist_pnl")
+            with col2:
+                filtro_datas = st.date_input("Período (data de saída)", value=(), key="hist_datas")
+                ordenar_por = st.selectbox("Ordenar por", list(ORDENACOES_HISTORICO), key="hist_ordem")
+            with col3:
+                por_pagina = st.selectbox("Linhas por página", [25, 50, 100, 250], index=1, key="hist_por_pagina")
+                decrescente = st.checkbox("Decrescente", value=True, key="hist_desc")
             
-            # Formatação condicional
-            def highlight_positive(val):
-                if isinstance(val, (int, float)):
-                    if val > 0:
-                        return 'color: green'
-                    elif val < 0:
-                        return 'color: red'
-                return ''
+            filtros = {
+                "symbol": None if filtro_par == "Todos" else filtro_par,
+                "sinal_pnl": {"Todos": None, "Positivo": 1, "Negativo": -1}[filtro_pnl],
+                "ordenar_por": ORDENACOES_HISTORICO[ordenar_por],
+                "decrescente": decrescente,
+            }
+            if len(filtro_datas) == 2:
+                filtros["inicio_ms"] = int(datetime.combine(filtro_datas[0], datetime.min.time(), timezone.utc).timestamp() * 1000)
+                filtros["fim_ms"] = int(datetime.combine(filtro_datas[1] + timedelta(days=1), datetime.min.time(), timezone.utc).timestamp() * 1000)
             
-            # Aplicar formatação e exibir
-            st.dataframe(
-                df.style.applymap(highlight_positive, subset=['PnL Funding', 'PnL Basis', 'Taxas', 'PnL Total', 'ROI (%)']),
-                use_container_width=True
-            )
+            _, total_filtrado = ledger.consultar_fechadas(limite=0, **filtros)
+            paginas = max((total_filtrado + por_pagina - 1) // por_pagina, 1)
+            pagina = st.number_input(f"Página (de {paginas})", min_value=1, max_value=paginas, value=1, step=1, key="hist_pagina")
+            ops_pagina, total_filtrado = ledger.consultar_fechadas(limite=por_pagina, offset=(pagina - 1) * por_pagina, **filtros)
             
-            # Opção para exportar
-            if st.button("📥 Exportar Histórico (CSV)"):
-                csv = df.to_csv(index=False)
-                st.download_button(
-                    label="Baixar CSV",
-                    data=csv,
-                    file_name=f"arbitragem_historico_{datetime.now().strftime('%Y%m%d')}.csv",
-                    mime="text/csv"
+            if ops_pagina:
+                inicio = (pagina - 1) * por_pagina
+                st.caption(f"Mostrando {inicio + 1}–{inicio + len(ops_pagina)} de {total_filtrado} operações")
+                df = tabela_historico(ops_pagina)
+                
+                # Formatação condicional
+                def highlight_positive(val):
+                    if isinstance(val, (int, float)):
+                        if val > 0:
+                            return 'color: green'
+                        elif val < 0:
+                            return 'color: red'
+                    return ''
+                
+                # Estilo aplicado só às linhas da página visível
+                st.dataframe(
+                    df.style.map(highlight_positive, subset=['PnL Funding', 'PnL Basis', 'Taxas', 'PnL Total', 'ROI (%)']),
+                    use_container_width=True,
+                    hide_index=True
                 )
+            else:
+                st.info("Nenhuma operação fechada atende aos filtros.")
+            
+            # Exportação: arquivo gerado em lotes direto do ledger, com os mesmos filtros da tabela
+            st.markdown("#### 📥 Exportar Histórico")
+            col1, col2 = st.columns([1, 2])
+            with col1:
+                formato = st.selectbox("Formato", list(FORMATOS), key="hist_formato")
+            with col2:
+                st.write("")
+                preparar = st.button("Preparar exportação")
+            if preparar:
+                extensao, _ = FORMATOS[formato]
+                pasta = os.path.join(get_user_data_path(st.session_state.username), "exportacoes")
+                os.makedirs(pasta, exist_ok=True)
+                # Um arquivo por sessão: duas abas do mesmo usuário não trocam os arquivos uma da outra
+                sessao = st.session_state.setdefault("exportacao_id", uuid.uuid4().hex[:8])
+                caminho = os.path.join(pasta, f"historico_{sessao}.{extensao}")
+                with st.spinner("Gerando arquivo..."):
+                    linhas = exportar_historico(ledger, caminho, formato, **filtros)
+                st.session_state.exportacao = {"caminho": caminho, "formato": formato, "linhas": linhas}
+            
+            exportacao = st.session_state.get("exportacao")
+            if exportacao and os.path.exists(exportacao["caminho"]):
+                extensao, mime = FORMATOS[exportacao["formato"]]
+                with open(exportacao["caminho"], "rb") as f:
+                    st.download_button(
+                        label=f"Baixar {exportacao['formato']} ({exportacao['linhas']} operações)",
+                        data=f,
+                        file_name=f"arbitragem_historico_{datetime.now().strftime('%Y%m%d')}.{extensao}",
+                        mime=mime
+                    )
         else:
             st.info("Nenhuma operação fechada no histórico.")
     
@@ -1151,20 +1586,40 @@ def main():
         # Informações do sistema
         st.markdown("#### ℹ️ Informações do Sistema")
         
+        pool_stats = get_market_client().pool_stats()
+        limiter_stats = get_rate_limiter().stats()
         st.markdown(f"""
         <div class="info-box">
             <strong>Versão:</strong> 2.0.0<br>
             <strong>Data de Atualização:</strong> {datetime.now().strftime('%d/%m/%Y')}<br>
             <strong>Status da API:</strong> {'✅ Conectado' if client else '❌ Desconectado'}<br>
             <strong>Usuário:</strong> {st.session_state.username}<br>
-            <strong>Total de Operações:</strong> {len(carregar_operacoes(st.session_state.username))}
+            <strong>Total de Operações:</strong> {get_operations_ledger(st.session_state.username).contar()}<br>
+            <strong>Pool HTTP (market data):</strong> {pool_stats['hits']} reusos / {pool_stats['misses']} conexões novas<br>
+            <strong>Stream da conta:</strong> {('✅ Conectado' if get_user_stream(client).pronto else '⏳ Conectando') + f" ({get_user_stream(client).reconnects} reconexões)" if client else '—'}<br>
+            <strong>Peso Binance (1 min):</strong> {limiter_stats['peso_usado_servidor']} usado / {limiter_stats['peso_disponivel']} disponível{f" — em backoff por {limiter_stats['bloqueado_por']:.0f}s" if limiter_stats['bloqueado_por'] else ''}
         </div>
         """, unsafe_allow_html=True)
         
+        # Distribuição do intervalo entre as pernas de cada execução
+        with st.expander("⏱️ Skew entre Pernas (Execução)"):
+            linhas_skew = relatorio_skew(get_operations_ledger(st.session_state.username).amostras_execucao())
+            if linhas_skew:
+                st.dataframe(pd.DataFrame(linhas_skew), use_container_width=True, hide_index=True)
+                st.caption("Diferença entre as execuções das pernas (quando informadas). Envio e ack não entram: as pernas vão na mesma requisição batchOrders")
+            else:
+                st.info("Nenhuma execução com medição de latência registrada.")
+        
         # Opções avançadas
         with st.expander("🛠️ Opções Avançadas"):
             if st.button("🗑️ Limpar Cache"):
-                st.cache_data.clear()
+                # Saldos desta conta são descartados; dados de mercado compartilhados só são
+                # marcados como vencidos e atualizados em background
+                if client:
+                    get_swr_cache().invalidate(REGIAO_SALDOS, client.conta_id, hard=True)
+                get_swr_cache().invalidate(REGIAO_SIMBOLOS)
+                get_swr_cache().invalidate(REGIAO_FUNDING)
+                get_price_snapshot().invalidate()
                 st.success("Cache limpo com sucesso!")
             
             if st.button("🔄 Reiniciar Aplicação"):
@@ -1172,13 +1627,17 @@ def main():
             
             if st.button("⚠️ Resetar Arquivo de Operações", type="secondary"):
                 if st.checkbox("Confirmar reset (esta ação não pode ser desfeita)"):
-                    salvar_operacoes([], st.session_state.username)
+                    get_operations_ledger(st.session_state.username).resetar()
                     st.success("Arquivo de operações resetado com sucesso!")
                     st.rerun()
 
 # Criar diretório para usuários
 os.makedirs("users", exist_ok=True)
 
+# Aquecer o pool de conexões com a Binance e iniciar o feed WebSocket na inicialização do processo
+get_market_client()
+get_market_feed()
+
 # Executar aplicação
 if __name__ == "__main__":
     main()
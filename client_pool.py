@@ -0,0 +1,101 @@
+# Pool de clientes Binance autenticados, um por par de credenciais, compartilhado pelo processo
+import hashlib
+import threading
+import time
+
+from binance.client import Client
+from requests.adapters import HTTPAdapter
+
+from market_data import CONNECT_TIMEOUT, POOL_CONNECTIONS, POOL_MAXSIZE, READ_TIMEOUT
+from rate_limiter import PRIORIDADE_ORDEM, get_rate_limiter
+
+TIME_SYNC_INTERVAL = 3600  # segundos entre recalibrações do offset de horário do servidor
+# Peso de request weight por endpoint (último trecho da URL); demais endpoints pesam 1
+PESOS = {"balance": 5, "account": 5, "income": 30, "batchOrders": 5}
+ENDPOINTS_ORDEM = ("order", "batchOrders")
+
+
+def credenciais_id(api_key, api_secret):
+    """
+    Identificador estável (hash) de um par de credenciais, seguro para usar como chave de cache
+    """
+    return hashlib.sha256(f"{api_key}:{api_secret}".encode()).hexdigest()[:16]
+
+
+class ClienteLimitado(Client):
+    """
+    Client que passa cada requisição pelo rate limiter central e alimenta-o com os
+    headers de peso e contagem de ordens devolvidos pela Binance
+    """
+    conta_id = None
+
+    def _request(self, method, uri, signed, force_params=False, **kwargs):
+        endpoint = uri.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        envia_ordem = method.lower() == "post" and endpoint in ENDPOINTS_ORDEM
+        ordens = 0
+        if envia_ordem:
+            data = kwargs.get("data") or {}
+            ordens = data.get("batchOrders", "").count("symbol") if endpoint == "batchOrders" else 1
+        get_rate_limiter().acquire(
+            PESOS.get(endpoint, 1),
+            nivel=PRIORIDADE_ORDEM if envia_ordem else None,
+            conta=self.conta_id,
+            ordens=ordens,
+        )
+        return super()._request(method, uri, signed, force_params, **kwargs)
+
+    def _handle_response(self, response):
+        # Lê os headers da própria resposta (e não de self.response), pois as pernas de uma
+        # arbitragem são enviadas em paralelo pelo mesmo client
+        get_rate_limiter().observe(response.headers, response.status_code, conta=self.conta_id)
+        return super()._handle_response(response)
+
+
+class ClientPool:
+    def __init__(self, time_sync_interval=TIME_SYNC_INTERVAL):
+        self.time_sync_interval = time_sync_interval
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _criar(self, api_key, api_secret, conta_id):
+        # ping=False: o construtor não faz round trip; a calibração de horário já valida a conexão
+        client = ClienteLimitado(api_key, api_secret, ping=False, requests_params={"timeout": (CONNECT_TIMEOUT, READ_TIMEOUT)})
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE)
+        client.session.mount("https://", adapter)
+        client.conta_id = conta_id
+        client.time_synced_at = 0.0
+        return client
+
+    def _sincronizar_horario(self, client):
+        """
+        Calcula o offset entre o relógio local e o do servidor (usado na assinatura das requisições)
+        """
+        antes = time.time() * 1000
+        server_time = client.futures_time()["serverTime"]
+        depois = time.time() * 1000
+        client.timestamp_offset = int(server_time - (antes + depois) / 2)
+        client.time_synced_at = time.time()
+
+    def get(self, api_key, api_secret):
+        conta_id = credenciais_id(api_key, api_secret)
+        with self._lock:
+            client = self._clients.get(conta_id)
+            if client is None:
+                client = self._criar(api_key, api_secret, conta_id)
+                self._clients[conta_id] = client
+        if time.time() - client.time_synced_at > self.time_sync_interval:
+            self._sincronizar_horario(client)
+        return client
+
+    def remove(self, api_key, api_secret):
+        with self._lock:
+            client = self._clients.pop(credenciais_id(api_key, api_secret), None)
+        if client:
+            client.close_connection()
+
+
+_pool = ClientPool()
+
+
+def get_client_pool():
+    return _pool
@@ -0,0 +1,226 @@
+# Gateway de ordens: envia as pernas de uma arbitragem numa única requisição /fapi/v1/batchOrders,
+# registra envio, ack e execução de cada perna e desfaz a perna executada se a outra for rejeitada
+import time
+import uuid
+
+import numpy as np
+from binance.exceptions import BinanceAPIException
+
+from rate_limiter import LimiteExcedido
+
+PERCENTIS_SKEW = (50, 90, 99)
+LADO_OPOSTO = {"BUY": "SELL", "SELL": "BUY"}
+CONSULTAS_INDEFINIDA = 3  # consultas ao status de uma perna cujo envio ficou sem resposta
+ESPERA_CONSULTA = 1.0  # segundos antes de cada consulta (a ordem pode ainda estar a caminho do motor)
+ORDEM_INEXISTENTE = -2013
+ENVIO_SEM_RESPOSTA = -1007  # o motor não respondeu a tempo: a ordem pode ter sido executada
+STATUS_FINAIS_SEM_FILL = ("EXPIRED", "EXPIRED_IN_MATCH", "CANCELED", "REJECTED")  # a ordem não executa mais nada
+
+
+class ErroExecucao(Exception):
+    """
+    Falha em uma ou mais pernas; `pernas` traz o registro de execução (inclusive das pernas
+    executadas, desfeitas, deixadas sem hedge ou com resultado desconhecido em `indefinidas`)
+    """
+    def __init__(self, mensagem, pernas):
+        super().__init__(mensagem)
+        self.pernas = pernas
+
+
+def _agora_ms():
+    return int(time.time() * 1000)
+
+
+def _quantidade(qty):
+    # batchOrders exige strings; evita notação científica em quantidades pequenas
+    return f"{qty:.8f}".rstrip("0").rstrip(".")
+
+
+def _ordem_mercado(symbol, side, quantity, reduce_only=False):
+    ordem = {
+        "symbol": symbol,
+        "side": side,
+        "type": "MARKET",
+        "quantity": _quantidade(quantity),
+        # RESULT: preço médio e quantidade executada voltam na própria resposta
+        "newOrderRespType": "RESULT",
+        # Id próprio: permite consultar a ordem quando a resposta do envio se perde
+        "newClientOrderId": f"arb-{uuid.uuid4().hex[:28]}",
+    }
+    if reduce_only:
+        ordem["reduceOnly"] = "true"
+    return ordem
+
+
+def _registrar_resposta(perna, resposta):
+    if "code" in resposta and "orderId" not in resposta:
+        perna["erro"] = f"APIError(code={resposta['code']}): {resposta.get('msg', '')}"
+        return perna
+    perna["order_id"] = resposta.get("orderId")
+    perna["status"] = resposta.get("status")
+    # Ausente (resposta sem RESULT) fica None; um 0 informado pela corretora é execução nula, não falta de dado
+    perna["avg_price"] = float(resposta["avgPrice"]) if resposta.get("avgPrice") is not None else None
+    perna["executed_qty"] = float(resposta["executedQty"]) if resposta.get("executedQty") is not None else None
+    # updateTime é o horário do servidor na última mudança da ordem; só é a execução se ela veio FILLED
+    perna["fill_ms"] = resposta.get("updateTime") if resposta.get("status") == "FILLED" else None
+    return perna
+
+
+def _incompleta(perna):
+    """
+    True se a ordem a mercado foi encerrada sem executar a quantidade toda (ex.: EXPIRED por falta de liquidez)
+    """
+    return perna.get("status") in STATUS_FINAIS_SEM_FILL and (perna["executed_qty"] or 0) < float(_quantidade(perna["qty"]))
+
+
+def _envio_recusado(erro):
+    """
+    True se o erro garante que nada foi executado: recusa da Binance (4xx) ou do rate limiter
+    local. Falhas de transporte e 5xx deixam o resultado desconhecido
+    """
+    if isinstance(erro, BinanceAPIException):
+        return erro.status_code < 500
+    return isinstance(erro, LimiteExcedido)
+
+
+def _consultar(client, ordem):
+    """
+    Status de uma ordem enviada sem resposta, pelo newClientOrderId. Devolve a resposta da
+    consulta (no formato da de envio), um erro -2013 se a ordem não existe ou None se não foi
+    possível saber
+    """
+    resposta = None
+    for _ in range(CONSULTAS_INDEFINIDA):
+        time.sleep(ESPERA_CONSULTA)
+        try:
+            return client.futures_get_order(symbol=ordem["symbol"], origClientOrderId=ordem["newClientOrderId"])
+        except BinanceAPIException as e:
+            if e.code != ORDEM_INEXISTENTE:
+                continue
+            resposta = {"code": e.code, "msg": e.message}
+        except Exception:
+            continue
+    return resposta
+
+
+def skew(pernas, campo):
+    """
+    Diferença (ms) entre a perna mais cedo e a mais tarde no campo; None se alguma não tiver o valor
+    """
+    valores = [p.get(campo) for p in pernas]
+    if any(v is None for v in valores):
+        return None
+    return max(valores) - min(valores)
+
+
+def _desfazer(client, perna, reduce_only):
+    """
+    Zera a exposição deixada por uma perna executada com uma ordem a mercado no sentido oposto
+    """
+    try:
+        resposta = client.futures_create_order(
+            **_ordem_mercado(perna["symbol"], LADO_OPOSTO[perna["side"]], perna["executed_qty"], reduce_only)
+        )
+        perna["desfeita"] = _registrar_resposta({"qty": perna["executed_qty"], "ack_ms": _agora_ms()}, resposta)
+        if _incompleta(perna["desfeita"]):
+            perna["desfeita"]["erro"] = f"ordem {perna['desfeita']['status']}: executado {perna['desfeita']['executed_qty'] or 0:g}"
+    except Exception as e:
+        perna["desfeita"] = {"erro": str(e)}
+    return "erro" not in perna["desfeita"]
+
+
+def enviar_pernas(client, pernas, abertura=True, aceitar_parciais=False):
+    """
+    Envia as pernas [(symbol, side, quantity)] como ordens a mercado numa única requisição
+    batchOrders e devolve o registro de execução: pernas com envio/ack/fill (ms), preço médio e
+    quantidade executada, e o skew entre as execuções. Se alguma perna for rejeitada, as
+    executadas são desfeitas (reduceOnly na abertura; no fechamento a posição original é
+    restaurada) e ErroExecucao é levantado. Uma perna encerrada sem executar tudo (EXPIRED,
+    CANCELED...) conta como rejeitada, a menos que `aceitar_parciais`: aí ela volta como está,
+    listada em `parciais`, para o chamador completar o hedge.
+
+    Se o envio ficar sem resposta (timeout, conexão interrompida, 5xx, -1007), a perna é consultada
+    pelo seu newClientOrderId antes de qualquer decisão. Pernas que continuam sem resultado
+    conhecido vão para `indefinidas` e nada é desfeito: ErroExecucao é levantado para que o
+    chamador confira as posições antes de liberar ou registrar a operação
+    """
+    ordens = [_ordem_mercado(*perna) for perna in pernas]
+    envio_ms = _agora_ms()
+    try:
+        respostas = client.futures_place_batch_order(batchOrders=ordens)
+        a_consultar = [i for i, resposta in enumerate(respostas) if resposta.get("code") == ENVIO_SEM_RESPOSTA]
+    except Exception as e:
+        if _envio_recusado(e):
+            # A requisição inteira foi recusada: nenhuma perna foi aceita
+            respostas = [{"code": getattr(e, "code", None), "msg": str(e)}] * len(pernas)
+            a_consultar = []
+        else:
+            respostas = [{"code": None, "msg": f"resultado desconhecido ({str(e)})"}] * len(pernas)
+            a_consultar = range(len(pernas))
+    indefinidas = []
+    for i in a_consultar:
+        resposta = _consultar(client, ordens[i])
+        if resposta is None:
+            indefinidas.append(i)
+        else:
+            respostas[i] = resposta
+    ack_ms = _agora_ms()
+
+    resultado = [
+        _registrar_resposta(
+            {"symbol": symbol, "side": side, "qty": qty, "client_order_id": ordem["newClientOrderId"],
+             "envio_ms": envio_ms, "ack_ms": ack_ms},
+            resposta
+        )
+        for (symbol, side, qty), ordem, resposta in zip(pernas, ordens, respostas)
+    ]
+    execucao = {
+        "pernas": resultado,
+        # As pernas vão na mesma requisição: envio e ack são comuns a todas, só a execução difere
+        "skew_fill_ms": skew(resultado, "fill_ms"),
+        "sem_hedge": [],
+        "indefinidas": [resultado[i]["symbol"] for i in indefinidas],
+        "parciais": [],
+    }
+    for perna in resultado:
+        if "erro" not in perna and _incompleta(perna):
+            if aceitar_parciais:
+                execucao["parciais"].append(perna["symbol"])
+            else:
+                perna["erro"] = f"ordem {perna['status']}: executado {perna['executed_qty'] or 0:g} de {perna['qty']:g}"
+    falhas = [p for p in resultado if "erro" in p]
+    if not falhas:
+        return execucao
+
+    mensagem = "; ".join(f"{p['symbol']}: {p['erro']}" for p in falhas)
+    if indefinidas:
+        # Desfazer às cegas poderia abrir uma posição nova: a decisão fica com quem confere as posições
+        raise ErroExecucao(f"{mensagem} — confira as posições na corretora", execucao)
+    for perna in resultado:
+        # Inclui pernas com erro que executaram em parte antes de expirar
+        if not perna.get("executed_qty"):
+            continue
+        if _desfazer(client, perna, reduce_only=abertura):
+            mensagem += f" — perna {perna['symbol']} desfeita"
+        else:
+            execucao["sem_hedge"].append(perna["symbol"])
+            mensagem += f" — FALHA ao desfazer {perna['symbol']} ({perna['desfeita']['erro']}): posição sem hedge"
+    raise ErroExecucao(mensagem, execucao)
+
+
+def relatorio_skew(amostras):
+    """
+    Distribuição do skew entre pernas ({fase: {métrica: [ms, ...]}}) em percentis, por fase e métrica
+    """
+    linhas = []
+    for fase, metricas in amostras.items():
+        for metrica, valores in metricas.items():
+            valores = np.asarray([v for v in valores if v is not None], dtype="float64")
+            if not len(valores):
+                continue
+            linha = {"Fase": fase, "Métrica": metrica, "Amostras": len(valores)}
+            for percentil in PERCENTIS_SKEW:
+                linha[f"p{percentil} (ms)"] = float(np.percentile(valores, percentil))
+            linha["Máx (ms)"] = float(valores.max())
+            linhas.append(linha)
+    return linhas
@@ -0,0 +1,312 @@
+# Execução fatiada (TWAP): divide o volume de uma arbitragem em ordens-filhas a intervalos fixos,
+# mantém as quantidades executadas das duas pernas dentro da tolerância de hedge e pausa quando
+# o basis se move contra a entrada além do limite
+import threading
+import time
+from datetime import datetime, timezone
+
+from execucao import ErroExecucao, enviar_pernas
+from ledger import (
+    STATUS_PAI_ATIVOS,
+    STATUS_PAI_CANCELADA,
+    STATUS_PAI_CANCELANDO,
+    STATUS_PAI_CONCLUIDA,
+    STATUS_PAI_EXECUTANDO,
+    STATUS_PAI_INTERROMPIDA,
+    STATUS_PAI_PAUSADA,
+)
+from market_data import arredondar_step
+
+VERIFICACAO = 1.0  # segundos entre verificações de cancelamento e do basis durante esperas e pausas
+TOLERANCIA_HEDGE = 0.02  # diferença máxima entre as frações executadas das pernas
+LIMITE_BASIS = 0.001  # alta máxima do basis (fração do preço) em relação ao início antes de pausar
+PAUSA_MAXIMA = 300  # segundos em pausa antes de interromper a execução
+PERNAS = (("perp", "symbol_perpetuo", "SELL"), ("fut", "symbol_futuro", "BUY"))
+
+
+def nova_ordem_pai(symbol_perp, symbol_fut, volume, qty_perp, qty_fut, preco_perp, preco_fut, filtros,
+                   tamanho_fatia, intervalo_s, tolerancia_hedge=TOLERANCIA_HEDGE, limite_basis=LIMITE_BASIS,
+                   pausa_maxima_s=PAUSA_MAXIMA):
+    """
+    Plano de uma execução fatiada: `filtros` traz {symbol: (step, notional mínimo)} das duas pernas.
+    O número de fatias arredonda para baixo, para nenhuma ficar abaixo de `tamanho_fatia`
+    """
+    return {
+        "status": STATUS_PAI_EXECUTANDO,
+        "symbol_perpetuo": symbol_perp,
+        "symbol_futuro": symbol_fut,
+        "data_inicio": datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"),
+        "volume_usd": volume,
+        "qty_perp": qty_perp,
+        "qty_fut": qty_fut,
+        "preco_referencia_perp": preco_perp,
+        "preco_referencia_futuro": preco_fut,
+        "basis_inicial": (preco_fut - preco_perp) / preco_perp,
+        "filtros": {symbol: list(filtros[symbol]) for symbol in (symbol_perp, symbol_fut)},
+        "n_fatias": max(1, int(volume // tamanho_fatia)),
+        "intervalo_s": intervalo_s,
+        "tolerancia_hedge": tolerancia_hedge,
+        "limite_basis": limite_basis,
+        "pausa_maxima_s": pausa_maxima_s,
+        # Progresso
+        "fatias_enviadas": 0,
+        "executado_perp": 0.0,
+        "executado_fut": 0.0,
+        "notional_perp": 0.0,
+        "notional_fut": 0.0,
+        "taxa": 0.0,
+        "correcoes": 0,
+        "pausas": 0,
+        "basis_atual": None,
+        "skew_fill_ms": None,
+        "sem_hedge": [],
+        "motivo": None,
+        "operacao_id": None,
+    }
+
+
+def progresso(pai):
+    """
+    Fração executada de cada perna: (perp, fut)
+    """
+    return pai["executado_perp"] / pai["qty_perp"], pai["executado_fut"] / pai["qty_fut"]
+
+
+class ExecucaoFatiada:
+    """
+    Executa uma ordem-pai já registrada no ledger. `precos()` devolve (perp, fut) atuais ou None;
+    `preencher(perna, preco_referencia, qty)` devolve (preço, qty, taxa) executados de uma perna;
+    `montar_operacao(pai)` devolve o registro da operação, gravado desde a primeira execução
+    (provisório enquanto a ordem-pai estiver ativa) para que uma queda do processo não perca as
+    pernas já executadas
+    """
+    def __init__(self, client, ledger, pai, precos, preencher, montar_operacao):
+        self.client = client
+        self.ledger = ledger
+        self.pai = pai
+        self.precos = precos
+        self.preencher = preencher
+        self.montar_operacao = montar_operacao
+
+    def _gravar(self, ordem=None, filhas=None):
+        return self.ledger.atualizar_ordem_pai(self.pai, ordem, filhas)
+
+    def _operacao(self):
+        # Registro da operação com o executado até aqui; None se nada foi executado
+        if not (self.pai["executado_perp"] or self.pai["executado_fut"]):
+            return None
+        return self.montar_operacao(self.pai)
+
+    def _parar(self, status, motivo):
+        self.pai["status"] = status
+        self.pai["motivo"] = motivo
+
+    def _cancelado(self):
+        if self.ledger.status_ordem_pai(self.pai["id"]) == STATUS_PAI_CANCELANDO:
+            self.pai["status"] = STATUS_PAI_CANCELANDO
+            return True
+        return False
+
+    def _aguardar(self, ate):
+        """
+        Espera até o instante monotônico `ate`, verificando cancelamento; False se foi cancelada
+        """
+        while True:
+            if self._cancelado():
+                return False
+            restante = ate - time.monotonic()
+            if restante <= 0:
+                return True
+            time.sleep(min(VERIFICACAO, restante))
+
+    def _basis_liberado(self):
+        """
+        Preços atuais se o basis estiver dentro do limite. Enquanto não estiver (ou sem preços),
+        a ordem fica pausada; None se for cancelada ou a pausa passar do máximo
+        """
+        pai = self.pai
+        inicio_pausa = None
+        while True:
+            precos = self.precos()
+            if precos and all(precos):
+                pai["basis_atual"] = (precos[1] - precos[0]) / precos[0]
+                # Short no perpétuo e long no trimestral: só a alta do basis piora a entrada
+                if pai["basis_atual"] - pai["basis_inicial"] <= pai["limite_basis"]:
+                    if inicio_pausa is not None:
+                        pai["status"] = STATUS_PAI_EXECUTANDO
+                        self._gravar()
+                    return precos
+            if inicio_pausa is None:
+                inicio_pausa = time.monotonic()
+                pai["status"] = STATUS_PAI_PAUSADA
+                pai["pausas"] += 1
+                self._gravar()
+            if time.monotonic() - inicio_pausa > pai["pausa_maxima_s"]:
+                self._parar(STATUS_PAI_INTERROMPIDA, f"basis fora do limite por mais de {pai['pausa_maxima_s']}s")
+                return None
+            if not self._aguardar(time.monotonic() + VERIFICACAO):
+                return None
+
+    def _quantidade(self, symbol, qty, preco):
+        # Quantidade enviável: no step e acima do notional mínimo (o que sobra vai na fatia seguinte)
+        step, minimo = self.pai["filtros"][symbol]
+        qty = arredondar_step(qty, step)
+        return qty if qty > 0 and qty * preco >= minimo else 0.0
+
+    def _minimo(self, symbol, preco):
+        # Menor quantidade enviável: o notional mínimo arredondado para cima no step
+        step, minimo = self.pai["filtros"][symbol]
+        qty = arredondar_step(minimo / preco, step)
+        return qty if qty * preco >= minimo else arredondar_step(qty + step, step)
+
+    def _enviar(self, fatia, pedidos):
+        """
+        Envia as pernas [(chave, symbol, side, qty, preço de referência)] de uma fatia, soma o
+        executado ao progresso e grava numa só transação as ordens-filhas, o progresso e a
+        operação. Levanta ErroExecucao depois de gravar
+        """
+        pai = self.pai
+        erro = None
+        try:
+            # Execução parcial de uma perna não desfaz a fatia: _equilibrar completa a perna atrasada
+            execucao = enviar_pernas(
+                self.client, [(symbol, side, qty) for _, symbol, side, qty, _ in pedidos], aceitar_parciais=True
+            )
+        except ErroExecucao as e:
+            execucao, erro = e.pernas, e
+        for (chave, _, _, qty, preco_referencia), perna in zip(pedidos, execucao["pernas"]):
+            desfeita = perna.get("desfeita")
+            if not perna.get("executed_qty"):
+                perna["taxa"] = 0.0
+                continue
+            preco, executado, perna["taxa"] = self.preencher(perna, preco_referencia, qty)
+            perna["avg_price"] = preco
+            pai["taxa"] += perna["taxa"]
+            if desfeita and "erro" not in desfeita:
+                continue
+            pai[f"executado_{chave}"] += executado
+            pai[f"notional_{chave}"] += preco * executado
+        if execucao["skew_fill_ms"] is not None:
+            pai["skew_fill_ms"] = max(pai["skew_fill_ms"] or 0, execucao["skew_fill_ms"])
+        pai["sem_hedge"].extend(execucao["sem_hedge"])
+        try:
+            ordem = self._operacao()
+        except Exception as e:
+            # Sem o registro desta vez: a próxima gravação (ou a final) tenta de novo
+            print(f"Erro ao montar a operação da execução fatiada {pai['id']}: {str(e)}")
+            ordem = None
+        self._gravar(ordem, (fatia, execucao["pernas"]))
+        if erro:
+            raise erro
+
+    def _equilibrar(self, fatia, precos):
+        """
+        Se as frações executadas das pernas se afastarem além da tolerância (execução parcial,
+        arredondamento), completa a perna atrasada até a fração da outra. Uma diferença abaixo
+        do mínimo da corretora é completada com a menor quantidade enviável, sem passar do total
+        da perna (o excedente é absorvido pela fatia seguinte da outra perna)
+        """
+        pai = self.pai
+        frac_perp, frac_fut = progresso(pai)
+        if abs(frac_perp - frac_fut) <= pai["tolerancia_hedge"]:
+            return
+        i = 0 if frac_perp < frac_fut else 1
+        chave, campo, side = PERNAS[i]
+        symbol = pai[campo]
+        restante = pai[f"qty_{chave}"] - pai[f"executado_{chave}"]
+        qty = self._quantidade(symbol, max(frac_perp, frac_fut) * pai[f"qty_{chave}"] - pai[f"executado_{chave}"], precos[i])
+        if not qty:
+            qty = self._quantidade(symbol, min(self._minimo(symbol, precos[i]), restante), precos[i])
+        if qty:
+            pai["correcoes"] += 1
+            self._enviar(fatia, [(chave, symbol, side, qty, precos[i])])
+
+    def executar(self):
+        pai = self.pai
+        proxima = time.monotonic()
+        try:
+            for fatia in range(pai["fatias_enviadas"], pai["n_fatias"]):
+                if not self._aguardar(proxima):
+                    break
+                precos = self._basis_liberado()
+                if precos is None:
+                    break
+                # Alvo acumulado por perna: o que faltou nas fatias anteriores entra nesta
+                fracao = (fatia + 1) / pai["n_fatias"]
+                pedidos = [
+                    (chave, pai[campo], side,
+                     self._quantidade(pai[campo], fracao * pai[f"qty_{chave}"] - pai[f"executado_{chave}"], precos[i]), precos[i])
+                    for i, (chave, campo, side) in enumerate(PERNAS)
+                ]
+                # As pernas vão juntas ou nenhuma vai: se uma ficar abaixo do mínimo, as duas esperam
+                # a fatia seguinte, em vez de abrir uma perna sozinha
+                if all(qty for _, _, _, qty, _ in pedidos):
+                    self._enviar(fatia, pedidos)
+                self._equilibrar(fatia, precos)
+                pai["fatias_enviadas"] = fatia + 1
+                self._gravar()
+                proxima = time.monotonic() + pai["intervalo_s"]
+        except ErroExecucao as e:
+            self._parar(STATUS_PAI_INTERROMPIDA, str(e))
+        except Exception as e:
+            self._parar(STATUS_PAI_INTERROMPIDA, f"Erro inesperado: {str(e)}")
+        finally:
+            self._finalizar()
+
+    def _finalizar(self):
+        pai = self.pai
+        if pai["status"] == STATUS_PAI_CANCELANDO:
+            self._parar(STATUS_PAI_CANCELADA, "cancelada pelo usuário")
+        elif pai["status"] in STATUS_PAI_ATIVOS:
+            pai["status"] = STATUS_PAI_CONCLUIDA
+        ordem = None
+        try:
+            ordem = self._operacao()
+        except Exception as e:
+            pai["motivo"] = f"{pai['motivo'] or ''} — falha ao registrar a operação: {str(e)}".strip(" —")
+        self._gravar(ordem)
+
+
+_execucoes = {}
+_execucoes_lock = threading.Lock()
+
+
+def _executar_em_thread(client, ledger, pai, precos, preencher, montar_operacao):
+    execucao = ExecucaoFatiada(client, ledger, pai, precos, preencher, montar_operacao)
+    thread = threading.Thread(target=execucao.executar, name=f"execucao-fatiada-{pai['id']}", daemon=True)
+    with _execucoes_lock:
+        _execucoes[pai["id"]] = thread
+    thread.start()
+
+
+def iniciar_execucao(client, ledger, pai, precos, preencher, montar_operacao):
+    """
+    Registra a ordem-pai e executa as fatias numa thread própria (a execução continua entre
+    reruns da página). Retorna o id da ordem-pai
+    """
+    ledger.criar_ordem_pai(pai)
+    _executar_em_thread(client, ledger, pai, precos, preencher, montar_operacao)
+    return pai["id"]
+
+
+def retomar_execucao(client, ledger, pai, precos, preencher, montar_operacao, encerrar=False):
+    """
+    Continua, a partir do progresso gravado, uma ordem-pai ativa (lida de `ordens_pai`) cujo
+    processo parou; com `encerrar`, só finaliza a execução e a operação provisória. False se
+    outra sessão gravou ou retomou a ordem-pai antes
+    """
+    status = STATUS_PAI_CANCELANDO if encerrar else STATUS_PAI_EXECUTANDO
+    if not ledger.retomar_ordem_pai(pai["id"], pai.pop("atualizado_ts"), status):
+        return False
+    pai["status"] = status
+    _executar_em_thread(client, ledger, pai, precos, preencher, montar_operacao)
+    return True
+
+
+def em_execucao(ordem_pai_id):
+    """
+    True se a ordem-pai está sendo executada por uma thread deste processo
+    """
+    with _execucoes_lock:
+        thread = _execucoes.get(ordem_pai_id)
+    return bool(thread and thread.is_alive())
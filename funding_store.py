@@ -0,0 +1,177 @@
+# Histórico local (append-only) de funding rate por símbolo
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+
+import numpy as np
+
+from market_data import get_market_client
+
+FUNDING_DIR = os.path.join("data", "funding")
+PAGE_LIMIT = 1000
+REFRESH_INTERVAL = 60  # segundos entre buscas de novos eventos por símbolo
+JANELA_RECENTE_MS = 3 * 86_400_000
+
+
+class _Serie:
+    def __init__(self):
+        self.times = []
+        self.rates = []
+        self.inicio = None  # a partir deste instante (ms) o histórico local está completo
+        self.sincronizado_em = 0.0
+        self.lock = threading.Lock()
+
+
+class FundingStore:
+    def __init__(self, base_dir=FUNDING_DIR, client=None, refresh_interval=REFRESH_INTERVAL):
+        self.base_dir = base_dir
+        self._client = client
+        self.refresh_interval = refresh_interval
+        self._series = {}
+        self._lock = threading.Lock()
+        os.makedirs(base_dir, exist_ok=True)
+
+    def _arquivo(self, symbol):
+        return os.path.join(self.base_dir, f"{symbol}.csv")
+
+    def _arquivo_meta(self, symbol):
+        return os.path.join(self.base_dir, f"{symbol}.meta.json")
+
+    def _serie(self, symbol):
+        with self._lock:
+            serie = self._series.get(symbol)
+            if serie is None:
+                serie = self._carregar(symbol)
+                self._series[symbol] = serie
+            return serie
+
+    def _carregar(self, symbol):
+        serie = _Serie()
+        eventos = {}
+        if os.path.exists(self._arquivo(symbol)):
+            with open(self._arquivo(symbol), "r") as f:
+                for linha in f:
+                    try:
+                        ts, rate = linha.strip().split(",")
+                        eventos[int(ts)] = float(rate)
+                    except ValueError:
+                        # Linha incompleta (escrita interrompida): ignorar
+                        continue
+        if os.path.exists(self._arquivo_meta(symbol)):
+            with open(self._arquivo_meta(symbol), "r") as f:
+                serie.inicio = json.load(f).get("inicio")
+        serie.times = sorted(eventos)
+        serie.rates = [eventos[ts] for ts in serie.times]
+        return serie
+
+    def _salvar_meta(self, symbol, serie):
+        caminho = self._arquivo_meta(symbol)
+        tmp = f"{caminho}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"inicio": serie.inicio}, f)
+        os.replace(tmp, caminho)
+
+    def _baixar(self, symbol, start_ms, end_ms=None):
+        """
+        Pagina /fapi/v1/fundingRate de start_ms em diante (até end_ms, se informado)
+        """
+        client = self._client or get_market_client()
+        eventos = []
+        cursor = start_ms
+        while True:
+            params = {"symbol": symbol, "limit": PAGE_LIMIT, "startTime": cursor}
+            if end_ms is not None:
+                params["endTime"] = end_ms
+            data = client.get("/fapi/v1/fundingRate", params=params)
+            eventos.extend((int(e["fundingTime"]), float(e["fundingRate"])) for e in data)
+            if len(data) < PAGE_LIMIT:
+                return eventos
+            cursor = int(data[-1]["fundingTime"]) + 1
+
+    def _anexar(self, symbol, serie, eventos):
+        existentes = set(serie.times)
+        novos = {ts: rate for ts, rate in eventos if ts not in existentes}
+        if not novos:
+            return
+        with open(self._arquivo(symbol), "a") as f:
+            f.writelines(f"{ts},{rate!r}\n" for ts, rate in sorted(novos.items()))
+        combinados = dict(zip(serie.times, serie.rates))
+        combinados.update(novos)
+        serie.times = sorted(combinados)
+        serie.rates = [combinados[ts] for ts in serie.times]
+
+    def sync(self, symbol, start_ms):
+        """
+        Garante que o histórico local cubra [start_ms, agora]: preenche lacunas anteriores
+        ao trecho já armazenado e busca apenas eventos mais novos que o último fundingTime
+        """
+        serie = self._serie(symbol)
+        with serie.lock:
+            agora = time.time()
+            if serie.inicio is None or start_ms < serie.inicio:
+                fim = serie.inicio - 1 if serie.inicio is not None else None
+                self._anexar(symbol, serie, self._baixar(symbol, start_ms, fim))
+                if fim is None:
+                    serie.sincronizado_em = agora
+                serie.inicio = start_ms
+                self._salvar_meta(symbol, serie)
+            if agora - serie.sincronizado_em > self.refresh_interval:
+                desde = serie.times[-1] + 1 if serie.times else serie.inicio
+                self._anexar(symbol, serie, self._baixar(symbol, desde))
+                serie.sincronizado_em = agora
+        return serie
+
+    def invalidate(self, symbol):
+        """
+        Força a busca de eventos novos do símbolo no próximo acesso
+        """
+        self._serie(symbol).sincronizado_em = 0.0
+
+    def history(self, symbol, start_ms, end_ms=None):
+        """
+        Eventos de funding em [start_ms, end_ms] como lista de {"rate", "time"}
+        """
+        serie = self.sync(symbol, start_ms)
+        with serie.lock:
+            i = bisect_left(serie.times, start_ms)
+            j = bisect_right(serie.times, end_ms) if end_ms is not None else len(serie.times)
+            return [
+                {"rate": rate, "time": datetime.fromtimestamp(ts / 1000, tz=timezone.utc)}
+                for ts, rate in zip(serie.times[i:j], serie.rates[i:j])
+            ]
+
+    def arrays(self, symbol, start_ms):
+        """
+        Sincroniza uma vez a partir de start_ms e devolve (times, rates) como arrays NumPy
+        dos eventos em [start_ms, agora], para fatiamento em lote por busca binária
+        """
+        serie = self.sync(symbol, start_ms)
+        with serie.lock:
+            i = bisect_left(serie.times, start_ms)
+            return np.array(serie.times[i:], dtype="int64"), np.array(serie.rates[i:], dtype="float64")
+
+    def recent(self, symbol, limit=3):
+        """
+        Soma dos últimos `limit` funding rates e o timestamp do mais recente
+        """
+        serie = self.sync(symbol, int(time.time() * 1000) - JANELA_RECENTE_MS)
+        with serie.lock:
+            if not serie.times:
+                return 0.0, None
+            return sum(serie.rates[-limit:]), serie.times[-1]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_funding_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = FundingStore()
+    return _store
@@ -0,0 +1,84 @@
+# Linhas do histórico de operações e exportação em lotes (CSV ou Parquet) direto do ledger
+import csv
+import os
+import tempfile
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+COLUNAS_HISTORICO = ["ID", "Par", "Data Entrada", "Data Saída", "Volume (USD)", "PnL Funding", "PnL Basis", "Taxas", "PnL Total", "ROI (%)"]
+
+SCHEMA_PARQUET = pa.schema([
+    ("ID", pa.int64()),
+    ("Par", pa.string()),
+    ("Data Entrada", pa.string()),
+    ("Data Saída", pa.string()),
+    ("Volume (USD)", pa.float64()),
+    ("PnL Funding", pa.float64()),
+    ("PnL Basis", pa.float64()),
+    ("Taxas", pa.float64()),
+    ("PnL Total", pa.float64()),
+    ("ROI (%)", pa.float64()),
+])
+
+FORMATOS = {"CSV": ("csv", "text/csv"), "Parquet": ("parquet", "application/vnd.apache.parquet")}
+
+
+def linha_historico(op):
+    """
+    Linha da tabela de histórico para uma ordem fechada
+    """
+    pnl_total = op.get("pnl_total", 0)
+    return {
+        "ID": op["id"],
+        "Par": op["symbol_perpetuo"],
+        "Data Entrada": op["data_entrada"],
+        "Data Saída": op.get("data_saida", "N/A"),
+        "Volume (USD)": float(op["volume_usd"]),
+        "PnL Funding": float(op.get("pnl_funding", 0)),
+        "PnL Basis": float(op.get("pnl_basis", 0)),
+        "Taxas": -(op.get("taxa_abertura", 0) + op.get("taxa_fechamento", 0)),
+        "PnL Total": float(pnl_total),
+        "ROI (%)": (pnl_total / op["volume_usd"]) * 100 if op["volume_usd"] > 0 else 0.0,
+    }
+
+
+def _escrever_csv(lotes, caminho):
+    total = 0
+    with open(caminho, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=COLUNAS_HISTORICO)
+        writer.writeheader()
+        for lote in lotes:
+            writer.writerows(linha_historico(op) for op in lote)
+            total += len(lote)
+    return total
+
+
+def _escrever_parquet(lotes, caminho):
+    # Um row group por lote: só um lote fica em memória de cada vez
+    total = 0
+    with pq.ParquetWriter(caminho, SCHEMA_PARQUET) as writer:
+        for lote in lotes:
+            writer.write_table(pa.Table.from_pylist([linha_historico(op) for op in lote], schema=SCHEMA_PARQUET))
+            total += len(lote)
+        if total == 0:
+            writer.write_table(SCHEMA_PARQUET.empty_table())
+    return total
+
+
+def exportar_historico(ledger, caminho, formato="CSV", **filtros):
+    """
+    Grava as ordens fechadas que atendem aos filtros em `caminho`, lendo o ledger em lotes.
+    O arquivo é escrito num temporário de nome único (várias sessões exportam no mesmo processo)
+    e trocado atomicamente. Retorna o número de linhas
+    """
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(caminho) or ".", prefix=".exportacao-", suffix=".tmp", delete=False) as f:
+        tmp = f.name
+    escrever = _escrever_parquet if formato == "Parquet" else _escrever_csv
+    try:
+        total = escrever(ledger.iterar_fechadas(**filtros), tmp)
+        os.replace(tmp, caminho)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    return total
@@ -0,0 +1,798 @@
+# Livro de operações em SQLite (modo WAL), um banco por usuário
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+BUSY_TIMEOUT = 30  # segundos que um escritor espera pelo lock de escrita de outro processo
+LOTE_EXPORTACAO = 1000  # registros lidos por vez ao percorrer o histórico
+
+STATUS_ABERTA = "aberta"
+STATUS_FECHANDO = "fechando"  # fechamento reservado por uma sessão; impede fechar a mesma ordem duas vezes
+STATUS_FECHADA = "fechada"
+STATUS_EM_CACHE = (STATUS_ABERTA, STATUS_FECHANDO)
+
+# Ordens-pai de execução fatiada (TWAP): a operação só entra em `operacoes` quando a execução termina
+STATUS_PAI_EXECUTANDO = "executando"
+STATUS_PAI_PAUSADA = "pausada"  # basis além do limite; retoma quando volta
+STATUS_PAI_CANCELANDO = "cancelando"  # cancelamento pedido pela interface; a execução para na próxima verificação
+STATUS_PAI_CONCLUIDA = "concluida"
+STATUS_PAI_INTERROMPIDA = "interrompida"
+STATUS_PAI_CANCELADA = "cancelada"
+STATUS_PAI_ATIVOS = (STATUS_PAI_EXECUTANDO, STATUS_PAI_PAUSADA, STATUS_PAI_CANCELANDO)
+
+# O tranId do /fapi/v1/income só é único dentro do incomeType: receitas e atribuições são chaveadas por (tipo, tran_id)
+SCHEMA_RECEITAS = """
+CREATE TABLE IF NOT EXISTS receitas (
+    tipo TEXT NOT NULL,
+    tran_id TEXT NOT NULL,
+    symbol TEXT NOT NULL,
+    asset TEXT,
+    valor REAL NOT NULL,
+    tempo INTEGER NOT NULL,
+    atribuida INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (tipo, tran_id)
+);
+CREATE INDEX IF NOT EXISTS idx_receitas_pendentes ON receitas (atribuida, tempo);
+CREATE TABLE IF NOT EXISTS atribuicoes (
+    tipo TEXT NOT NULL,
+    tran_id TEXT NOT NULL,
+    operacao_id INTEGER NOT NULL,
+    fase TEXT NOT NULL,
+    valor REAL NOT NULL,
+    PRIMARY KEY (tipo, tran_id, operacao_id)
+);
+CREATE INDEX IF NOT EXISTS idx_atribuicoes_operacao ON atribuicoes (operacao_id);
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS operacoes (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    symbol_perpetuo TEXT NOT NULL,
+    symbol_futuro TEXT NOT NULL,
+    data_entrada TEXT NOT NULL,
+    entrada_ts INTEGER NOT NULL,
+    data_saida TEXT,
+    saida_ts INTEGER,
+    volume_usd REAL NOT NULL,
+    pnl_total REAL,
+    dados TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_operacoes_status ON operacoes (status, entrada_ts);
+CREATE INDEX IF NOT EXISTS idx_operacoes_symbol ON operacoes (symbol_perpetuo, entrada_ts);
+CREATE INDEX IF NOT EXISTS idx_operacoes_entrada ON operacoes (entrada_ts);
+CREATE INDEX IF NOT EXISTS idx_operacoes_saida ON operacoes (status, saida_ts);
+CREATE TABLE IF NOT EXISTS meta (
+    chave TEXT PRIMARY KEY,
+    valor TEXT
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    escopo TEXT NOT NULL,
+    chave TEXT NOT NULL,
+    n INTEGER NOT NULL DEFAULT 0,
+    volume REAL NOT NULL DEFAULT 0,
+    pnl REAL NOT NULL DEFAULT 0,
+    funding REAL NOT NULL DEFAULT 0,
+    basis REAL NOT NULL DEFAULT 0,
+    taxas REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (escopo, chave)
+);
+CREATE TABLE IF NOT EXISTS ordens_pai (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    status TEXT NOT NULL,
+    symbol_perpetuo TEXT NOT NULL,
+    symbol_futuro TEXT NOT NULL,
+    inicio_ts INTEGER NOT NULL,
+    atualizado_ts INTEGER NOT NULL,
+    operacao_id INTEGER,
+    dados TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ordens_pai_inicio ON ordens_pai (inicio_ts);
+CREATE TABLE IF NOT EXISTS ordens_filhas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ordem_pai_id INTEGER NOT NULL,
+    fatia INTEGER NOT NULL,
+    symbol TEXT NOT NULL,
+    side TEXT NOT NULL,
+    order_id INTEGER,
+    qty REAL NOT NULL,
+    executed_qty REAL NOT NULL DEFAULT 0,
+    avg_price REAL,
+    taxa REAL,
+    tempo INTEGER NOT NULL,
+    dados TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ordens_filhas_pai ON ordens_filhas (ordem_pai_id, fatia);
+CREATE INDEX IF NOT EXISTS idx_ordens_filhas_symbol ON ordens_filhas (symbol, tempo);
+"""
+
+# Fases a que uma receita conciliada (/fapi/v1/income) pode ser atribuída dentro de uma ordem
+FASE_FUNDING = "funding"
+FASE_ENTRADA = "entrada"
+FASE_SAIDA = "saida"
+# Campo do registro que cada fase substitui e sinal (taxas vêm positivas, como nas estimativas)
+CAMPOS_REALIZADO = {FASE_FUNDING: ("funding", 1), FASE_ENTRADA: ("taxa_abertura", -1), FASE_SAIDA: ("taxa_fechamento", -1)}
+
+# Agregados das operações fechadas: total geral, por perpétuo e por mês de saída (AAAA-MM)
+ESCOPO_TOTAL = "total"
+ESCOPO_SYMBOL = "symbol"
+ESCOPO_MES = "mes"
+CAMPOS_ROLLUP = ("n", "volume", "pnl", "funding", "basis", "taxas")
+
+# Colunas pelas quais o histórico pode ser ordenado (nome exposto -> coluna indexada)
+ORDENACOES = {
+    "data_saida": "saida_ts",
+    "data_entrada": "entrada_ts",
+    "symbol_perpetuo": "symbol_perpetuo",
+    "volume_usd": "volume_usd",
+    "pnl_total": "pnl_total",
+}
+
+
+def _para_ms(data):
+    if not data:
+        return None
+    return int(datetime.strptime(data, FORMATO_DATA).replace(tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def _agora_ms():
+    return int(datetime.now(timezone.utc).timestamp() * 1000)
+
+
+def _colunas(ordem):
+    """
+    Colunas indexadas/filtráveis extraídas do registro; o registro completo vai em `dados`
+    """
+    dados = {k: v for k, v in ordem.items() if k != "id"}
+    return (
+        ordem["status"],
+        ordem["symbol_perpetuo"],
+        ordem["symbol_futuro"],
+        ordem["data_entrada"],
+        _para_ms(ordem["data_entrada"]),
+        ordem.get("data_saida"),
+        _para_ms(ordem.get("data_saida")),
+        float(ordem["volume_usd"]),
+        ordem.get("pnl_total"),
+        json.dumps(dados),
+    )
+
+
+def _contribuicao(ordem):
+    """
+    Quanto uma ordem soma aos rollups: só operações fechadas entram
+    """
+    if ordem is None or ordem.get("status") != STATUS_FECHADA:
+        return None
+    valores = (
+        1,
+        float(ordem["volume_usd"]),
+        float(ordem.get("pnl_total") or 0),
+        float(ordem.get("pnl_funding") or 0),
+        float(ordem.get("pnl_basis") or 0),
+        float(ordem.get("taxa_abertura") or 0) + float(ordem.get("taxa_fechamento") or 0),
+    )
+    mes = (ordem.get("data_saida") or ordem["data_entrada"])[:7]
+    return [((ESCOPO_TOTAL, ""), valores), ((ESCOPO_SYMBOL, ordem["symbol_perpetuo"]), valores), ((ESCOPO_MES, mes), valores)]
+
+
+def _aplicar_rollups(conn, antes, depois):
+    """
+    Aplica aos rollups a diferença entre a versão antiga e a nova de um registro (dentro da transação da escrita)
+    """
+    deltas = []
+    for contribuicao, sinal in ((_contribuicao(antes), -1), (_contribuicao(depois), 1)):
+        for chave, valores in contribuicao or []:
+            deltas.append(chave + tuple(sinal * v for v in valores))
+    if deltas:
+        conn.executemany(
+            "INSERT INTO rollups (escopo, chave, n, volume, pnl, funding, basis, taxas) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (escopo, chave) DO UPDATE SET n = n + excluded.n, volume = volume + excluded.volume, "
+            "pnl = pnl + excluded.pnl, funding = funding + excluded.funding, basis = basis + excluded.basis, "
+            "taxas = taxas + excluded.taxas",
+            deltas,
+        )
+
+
+def _realizado(conn, ids=None):
+    """
+    Funding recebido/pago e comissões reais por ordem (todas, ou só as `ids`), somados das atribuições
+    """
+    sql = "SELECT operacao_id, fase, SUM(valor) FROM atribuicoes"
+    if ids is not None:
+        sql += f" WHERE operacao_id IN ({', '.join('?' * len(ids))})"
+    realizado = {}
+    for operacao_id, fase, valor in conn.execute(sql + " GROUP BY operacao_id, fase", tuple(ids or ())).fetchall():
+        campo, sinal = CAMPOS_REALIZADO[fase]
+        realizado.setdefault(operacao_id, {})[campo] = sinal * valor
+    return realizado
+
+
+def _com_realizado(ordem, reais):
+    """
+    Registro de uma ordem fechada com o funding e as comissões reais no lugar das estimativas;
+    o PnL total recebe a diferença de cada campo substituído
+    """
+    if not reais or ordem.get("status") != STATUS_FECHADA:
+        return ordem
+    ordem = dict(ordem)
+    pnl_total = float(ordem.get("pnl_total") or 0)
+    if "funding" in reais:
+        pnl_total += reais["funding"] - float(ordem.get("pnl_funding") or 0)
+        ordem["pnl_funding"] = reais["funding"]
+        ordem["funding_realizado"] = True
+    for campo in ("taxa_abertura", "taxa_fechamento"):
+        if campo in reais:
+            pnl_total -= reais[campo] - float(ordem.get(campo) or 0)
+            ordem[campo] = reais[campo]
+    ordem["pnl_total"] = pnl_total
+    return ordem
+
+
+def _reconstruir_rollups(conn):
+    conn.execute("DELETE FROM rollups")
+    for (dados,) in conn.execute("SELECT dados FROM operacoes WHERE status = ?", (STATUS_FECHADA,)).fetchall():
+        _aplicar_rollups(conn, None, json.loads(dados))
+    conn.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('rollups', '1')")
+
+
+def _migrar_receitas(conn):
+    """
+    Recria receitas e atribuições de bancos chaveados só pelo tranId. Registros de tipos diferentes
+    com o mesmo tranId foram descartados na gravação: o cursor volta ao início para buscá-los de novo
+    """
+    chave = [nome for _, nome, _, _, _, pk in conn.execute("PRAGMA table_info(receitas)").fetchall() if pk]
+    if "tipo" in chave:
+        return
+    conn.execute("ALTER TABLE receitas RENAME TO receitas_antigas")
+    conn.execute("ALTER TABLE atribuicoes RENAME TO atribuicoes_antigas")
+    conn.execute("DROP INDEX idx_receitas_pendentes")
+    conn.execute("DROP INDEX idx_atribuicoes_operacao")
+    for comando in SCHEMA_RECEITAS.split(";"):
+        if comando.strip():
+            conn.execute(comando)
+    conn.execute(
+        "INSERT INTO receitas (tipo, tran_id, symbol, asset, valor, tempo, atribuida) "
+        "SELECT tipo, tran_id, symbol, asset, valor, tempo, atribuida FROM receitas_antigas"
+    )
+    conn.execute(
+        "INSERT INTO atribuicoes (tipo, tran_id, operacao_id, fase, valor) "
+        "SELECT r.tipo, a.tran_id, a.operacao_id, a.fase, a.valor FROM atribuicoes_antigas a "
+        "JOIN receitas_antigas r ON r.tran_id = a.tran_id"
+    )
+    conn.execute("DROP TABLE atribuicoes_antigas")
+    conn.execute("DROP TABLE receitas_antigas")
+    conn.execute("DELETE FROM meta WHERE chave = 'cursor_receitas'")
+
+
+def _inserir_filhas(conn, ordem_pai_id, fatia, pernas):
+    conn.executemany(
+        "INSERT INTO ordens_filhas (ordem_pai_id, fatia, symbol, side, order_id, qty, executed_qty, avg_price, "
+        "taxa, tempo, dados) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (ordem_pai_id, fatia, p["symbol"], p["side"], p.get("order_id"), p["qty"], p.get("executed_qty") or 0,
+             p.get("avg_price"), p.get("taxa"), p.get("fill_ms") or p["ack_ms"], json.dumps(p))
+            for p in pernas
+        ],
+    )
+
+
+def _filtro_fechadas(symbol=None, inicio_ms=None, fim_ms=None, sinal_pnl=None):
+    condicoes, params = ["status = ?"], [STATUS_FECHADA]
+    if symbol:
+        condicoes.append("symbol_perpetuo = ?")
+        params.append(symbol)
+    if inicio_ms is not None:
+        condicoes.append("saida_ts >= ?")
+        params.append(int(inicio_ms))
+    if fim_ms is not None:
+        condicoes.append("saida_ts < ?")
+        params.append(int(fim_ms))
+    if sinal_pnl == 1:
+        condicoes.append("pnl_total > 0")
+    elif sinal_pnl == -1:
+        condicoes.append("pnl_total < 0")
+    return " AND ".join(condicoes), params
+
+
+class Ledger:
+    def __init__(self, db_path, json_legado=None):
+        self.db_path = db_path
+        # Escritas numa conexão e leituras em outra, cada uma com seu lock: uma escrita esperando o
+        # lock do banco (BEGIN IMMEDIATE, até BUSY_TIMEOUT) não segura quem só lê
+        self._lock = threading.RLock()
+        self._lock_leitura = threading.RLock()
+        # Cache em memória das ordens abertas e em fechamento {id: ordem}, válido enquanto o
+        # data_version não mudar; o histórico de fechadas é sempre lido por consulta
+        self._ordens = None
+        self._versao = None
+        self._conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._conn.executescript(SCHEMA_RECEITAS)
+        if json_legado:
+            self.importar_json(json_legado)
+        with self._transacao() as conn:
+            _migrar_receitas(conn)
+            # Bancos criados antes dos rollups: calcula os agregados uma vez a partir do histórico
+            if not conn.execute("SELECT 1 FROM meta WHERE chave = 'rollups'").fetchone():
+                _reconstruir_rollups(conn)
+        self._leitura = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False, isolation_level=None)
+
+    @contextmanager
+    def _transacao(self):
+        """
+        Transação de escrita: BEGIN IMMEDIATE pega o lock de escrita do banco logo no início,
+        serializando escritores de todos os processos; leitores (WAL) seguem sem bloquear
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def _carregar(self):
+        """
+        Devolve o cache de ordens abertas e em fechamento, relendo-as (pelo índice de status) só
+        se houve gravação desde a última leitura. As gravações deste processo vão pela conexão de
+        escrita, então o PRAGMA data_version da conexão de leitura muda com elas e com as de outros
+        processos
+        """
+        with self._lock_leitura:
+            versao = self._leitura.execute("PRAGMA data_version").fetchone()[0]
+            if self._ordens is None or versao != self._versao:
+                self._ordens = {
+                    o["id"]: o for o in self._linhas(
+                        "SELECT id, dados FROM operacoes WHERE status IN (?, ?) ORDER BY entrada_ts, id",
+                        STATUS_EM_CACHE,
+                    )
+                }
+                self._versao = versao
+            return self._ordens
+
+    def _linhas(self, sql, params=()):
+        with self._lock_leitura:
+            linhas = self._leitura.execute(sql, params).fetchall()
+        return [dict(json.loads(dados), id=id_) for id_, dados in linhas]
+
+    def importar_json(self, caminho):
+        """
+        Importa (uma única vez) o operacoes_reais.json legado para o banco
+        """
+        if not os.path.exists(caminho):
+            return 0
+        with self._transacao() as conn:
+            # Verificado dentro da transação: dois processos abrindo o banco juntos não importam em dobro
+            if conn.execute("SELECT 1 FROM meta WHERE chave = 'json_importado'").fetchone():
+                return 0
+            with open(caminho, "r") as f:
+                ordens = json.load(f)
+            conn.executemany(
+                "INSERT INTO operacoes (status, symbol_perpetuo, symbol_futuro, data_entrada, entrada_ts, "
+                "data_saida, saida_ts, volume_usd, pnl_total, dados) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [_colunas(ordem) for ordem in ordens],
+            )
+            conn.execute("INSERT INTO meta (chave, valor) VALUES ('json_importado', ?)", (caminho,))
+            _reconstruir_rollups(conn)
+        return len(ordens)
+
+    def abertas(self):
+        """
+        Ordens abertas, incluindo as que estão em fechamento (status 'fechando')
+        """
+        with self._lock_leitura:
+            ordens = sorted(self._carregar().values(), key=lambda o: (o["data_entrada"], o["id"]))
+            # Cópias: quem chama pode alterar o registro sem corromper o cache
+            return [dict(o) for o in ordens]
+
+    def fechadas(self):
+        return self._linhas("SELECT id, dados FROM operacoes WHERE status = ? ORDER BY entrada_ts, id", (STATUS_FECHADA,))
+
+    def contar(self, status=None):
+        with self._lock_leitura:
+            if status is None:
+                return self._leitura.execute("SELECT COUNT(*) FROM operacoes").fetchone()[0]
+            return self._leitura.execute("SELECT COUNT(*) FROM operacoes WHERE status = ?", (status,)).fetchone()[0]
+
+    def inserir(self, ordem):
+        with self._transacao() as conn:
+            cursor = conn.execute(
+                "INSERT INTO operacoes (status, symbol_perpetuo, symbol_futuro, data_entrada, entrada_ts, "
+                "data_saida, saida_ts, volume_usd, pnl_total, dados) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                _colunas(ordem),
+            )
+            _aplicar_rollups(conn, None, ordem)
+        ordem["id"] = cursor.lastrowid
+        return ordem["id"]
+
+    def _mudar_status(self, id_, de, para, alterar=None):
+        """
+        Troca o status apenas se o registro ainda estiver em `de` (compare-and-set); `alterar(dados)`
+        pode ajustar o registro na mesma transação e recusar a troca devolvendo False. True se trocou
+        """
+        with self._transacao() as conn:
+            linha = conn.execute("SELECT dados FROM operacoes WHERE id = ? AND status = ?", (id_, de)).fetchone()
+            if linha is None:
+                return False
+            dados = json.loads(linha[0])
+            if alterar is not None and alterar(dados) is False:
+                return False
+            dados["status"] = para
+            conn.execute("UPDATE operacoes SET status = ?, dados = ? WHERE id = ?", (para, json.dumps(dados), id_))
+        return True
+
+    def reservar_fechamento(self, id_, dono):
+        """
+        Marca a ordem como 'fechando' se ainda estiver aberta, registrando quem reservou e quando.
+        Só a sessão que conseguir a reserva deve enviar as ordens de fechamento à corretora
+        """
+        def reservar(dados):
+            dados["fechamento"] = {"dono": dono, "reservado_ts": _agora_ms()}
+        return self._mudar_status(id_, STATUS_ABERTA, STATUS_FECHANDO, reservar)
+
+    def assumir_fechamento(self, id_, dono, timeout_s):
+        """
+        Transfere para `dono` uma reserva de fechamento abandonada: mais antiga que `timeout_s`
+        ou marcada com erro pela sessão que a fez. True se a reserva passou para `dono`
+        """
+        def assumir(dados):
+            reserva = dados.get("fechamento") or {}
+            if not reserva.get("erro") and _agora_ms() - reserva.get("reservado_ts", 0) < timeout_s * 1000:
+                return False
+            dados["fechamento"] = {"dono": dono, "reservado_ts": _agora_ms(), "assumido_de": reserva.get("dono")}
+        return self._mudar_status(id_, STATUS_FECHANDO, STATUS_FECHANDO, assumir)
+
+    def anotar_fechamento(self, id_, dono, erro=None, **campos):
+        """
+        Grava campos no registro de uma ordem em fechamento (ex.: `execucao_saida` logo após o
+        envio) enquanto a reserva for de `dono`; `erro` marca a reserva como abandonada
+        """
+        def anotar(dados):
+            if (dados.get("fechamento") or {}).get("dono") != dono:
+                return False
+            dados.update(campos)
+            if erro is not None:
+                dados["fechamento"]["erro"] = erro
+        return self._mudar_status(id_, STATUS_FECHANDO, STATUS_FECHANDO, anotar)
+
+    def liberar_fechamento(self, id_, dono):
+        """
+        Devolve a ordem para 'aberta' quando nenhuma perna de fechamento foi executada
+        """
+        def liberar(dados):
+            if (dados.get("fechamento") or {}).get("dono") != dono:
+                return False
+            dados.pop("fechamento", None)
+            dados.pop("execucao_saida", None)
+        return self._mudar_status(id_, STATUS_FECHANDO, STATUS_ABERTA, liberar)
+
+    def atualizar(self, ordem, status_esperado=None, dono=None):
+        """
+        Grava o registro completo e ajusta os rollups na mesma transação. Com `status_esperado`
+        (e `dono` da reserva de fechamento), só grava se o banco ainda estiver assim (levanta
+        RuntimeError caso outra sessão tenha alterado a ordem ou assumido o fechamento)
+        """
+        with self._transacao() as conn:
+            linha = conn.execute("SELECT status, dados FROM operacoes WHERE id = ?", (ordem["id"],)).fetchone()
+            if linha is None or (status_esperado is not None and linha[0] != status_esperado):
+                raise RuntimeError(f"Ordem {ordem['id']} foi alterada por outra sessão")
+            if dono is not None and (json.loads(linha[1]).get("fechamento") or {}).get("dono") != dono:
+                raise RuntimeError(f"Fechamento da ordem {ordem['id']} foi assumido por outra sessão")
+            # Receitas atribuídas por outra sessão até aqui entram no registro que fecha a ordem
+            ordem.update(_com_realizado(ordem, _realizado(conn, [ordem["id"]]).get(ordem["id"])))
+            conn.execute(
+                "UPDATE operacoes SET status = ?, symbol_perpetuo = ?, symbol_futuro = ?, data_entrada = ?, "
+                "entrada_ts = ?, data_saida = ?, saida_ts = ?, volume_usd = ?, pnl_total = ?, dados = ? WHERE id = ?",
+                _colunas(ordem) + (ordem["id"],),
+            )
+            _aplicar_rollups(conn, json.loads(linha[1]), ordem)
+
+    def resumo(self, escopo=ESCOPO_TOTAL):
+        """
+        Agregados das operações fechadas lidos da tabela de rollups, sem varrer o histórico.
+        Escopo total: um dict; por símbolo ou mês: {chave: dict}
+        """
+        with self._lock_leitura:
+            linhas = self._leitura.execute(
+                f"SELECT chave, {', '.join(CAMPOS_ROLLUP)} FROM rollups WHERE escopo = ? AND n > 0 ORDER BY chave",
+                (escopo,),
+            ).fetchall()
+        agregados = {linha[0]: dict(zip(CAMPOS_ROLLUP, linha[1:])) for linha in linhas}
+        if escopo == ESCOPO_TOTAL:
+            return agregados.get("", dict.fromkeys(CAMPOS_ROLLUP, 0))
+        return agregados
+
+    def consultar_fechadas(self, ordenar_por="data_saida", decrescente=True, limite=None, offset=0, **filtros):
+        """
+        Página do histórico com filtro e ordenação feitos no banco. Filtros: perpétuo (`symbol`),
+        intervalo de saída [`inicio_ms`, `fim_ms`) e sinal do PnL total (`sinal_pnl`: 1 ou -1).
+        Retorna (ordens da página, total de ordens que atendem aos filtros)
+        """
+        where, params = _filtro_fechadas(**filtros)
+        direcao = "DESC" if decrescente else "ASC"
+        sql = f"SELECT id, dados FROM operacoes WHERE {where} ORDER BY {ORDENACOES[ordenar_por]} {direcao}, id {direcao}"
+        if limite is not None:
+            sql += " LIMIT ? OFFSET ?"
+        with self._lock_leitura:
+            # Contagem e página lidas do mesmo snapshot
+            self._leitura.execute("BEGIN")
+            try:
+                total = self._leitura.execute(f"SELECT COUNT(*) FROM operacoes WHERE {where}", params).fetchone()[0]
+                linhas = self._leitura.execute(sql, params + ([int(limite), int(offset)] if limite is not None else [])).fetchall()
+            finally:
+                self._leitura.execute("COMMIT")
+        return [dict(json.loads(dados), id=id_) for id_, dados in linhas], total
+
+    def iterar_fechadas(self, tamanho_lote=LOTE_EXPORTACAO, ordenar_por="data_saida", decrescente=False, **filtros):
+        """
+        Percorre as ordens fechadas que atendem aos filtros em lotes de `tamanho_lote`, sem carregar
+        o histórico inteiro. Usa uma conexão própria de leitura (snapshot WAL, não bloqueia escritores
+        nem as outras chamadas deste ledger)
+        """
+        where, params = _filtro_fechadas(**filtros)
+        direcao = "DESC" if decrescente else "ASC"
+        conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=BUSY_TIMEOUT)
+        try:
+            cursor = conn.execute(
+                f"SELECT id, dados FROM operacoes WHERE {where} ORDER BY {ORDENACOES[ordenar_por]} {direcao}, id {direcao}",
+                params,
+            )
+            while True:
+                linhas = cursor.fetchmany(tamanho_lote)
+                if not linhas:
+                    break
+                yield [dict(json.loads(dados), id=id_) for id_, dados in linhas]
+        finally:
+            conn.close()
+
+    def cursor_receitas(self):
+        """
+        Timestamp (ms) a partir do qual a próxima conciliação de receitas deve buscar
+        """
+        with self._lock_leitura:
+            linha = self._leitura.execute("SELECT valor FROM meta WHERE chave = 'cursor_receitas'").fetchone()
+        return int(linha[0]) if linha else None
+
+    def primeira_entrada_ms(self):
+        with self._lock_leitura:
+            return self._leitura.execute("SELECT MIN(entrada_ts) FROM operacoes").fetchone()[0]
+
+    def gravar_receitas(self, registros, cursor):
+        """
+        Grava receitas da conta (ignorando as já conhecidas pelo tipo e tranId) e avança o cursor na mesma transação
+        """
+        with self._transacao() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO receitas (tipo, tran_id, symbol, asset, valor, tempo) VALUES (?, ?, ?, ?, ?, ?)",
+                [(r["incomeType"], str(r["tranId"]), r["symbol"], r.get("asset"), float(r["income"]), int(r["time"])) for r in registros],
+            )
+            conn.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('cursor_receitas', ?)", (str(int(cursor)),))
+
+    def receitas_pendentes(self):
+        with self._lock_leitura:
+            linhas = self._leitura.execute(
+                "SELECT tran_id, tipo, symbol, valor, tempo FROM receitas WHERE atribuida = 0 ORDER BY tempo"
+            ).fetchall()
+        return [dict(zip(("tran_id", "tipo", "symbol", "valor", "tempo"), linha)) for linha in linhas]
+
+    def posicoes_em(self, symbol, tempo):
+        """
+        Ordens com o perpétuo `symbol` abertas no instante `tempo` (ms): [(id, volume_usd)]
+        """
+        with self._lock_leitura:
+            return self._leitura.execute(
+                "SELECT id, volume_usd FROM operacoes WHERE symbol_perpetuo = ? AND entrada_ts <= ? "
+                "AND (saida_ts IS NULL OR saida_ts > ?)",
+                (symbol, tempo, tempo),
+            ).fetchall()
+
+    def eventos_proximos(self, symbol, tempo, janela):
+        """
+        Ordens em qualquer das pernas `symbol` com entrada ou saída a até `janela` ms de `tempo`:
+        [(id, entrada_ts, saida_ts)]. Ordens-filhas de execuções fatiadas contam como entradas
+        da operação resultante, cada uma no seu próprio horário. Em ordens ainda 'fechando' a
+        saída é o ack das pernas de saída já enviadas (saida_ts só é gravado na conclusão)
+        """
+        with self._lock_leitura:
+            return self._leitura.execute(
+                "SELECT id, entrada_ts, saida FROM (SELECT id, entrada_ts, "
+                "COALESCE(saida_ts, CASE WHEN status = ? THEN json_extract(dados, '$.execucao_saida.pernas[0].ack_ms') END) AS saida "
+                "FROM operacoes WHERE symbol_perpetuo = ? OR symbol_futuro = ?) "
+                "WHERE entrada_ts BETWEEN ? AND ? OR saida BETWEEN ? AND ? "
+                "UNION ALL SELECT p.operacao_id, f.tempo, NULL FROM ordens_filhas f JOIN ordens_pai p ON p.id = f.ordem_pai_id "
+                "WHERE p.operacao_id IS NOT NULL AND f.symbol = ? AND f.tempo BETWEEN ? AND ?",
+                (STATUS_FECHANDO, symbol, symbol, tempo - janela, tempo + janela, tempo - janela, tempo + janela,
+                 symbol, tempo - janela, tempo + janela),
+            ).fetchall()
+
+    def gravar_atribuicoes(self, atribuicoes, resolvidas):
+        """
+        Grava as partes [(tipo, tran_id, operacao_id, fase, valor)] e marca as receitas `resolvidas`
+        [(tipo, tran_id)] como atribuídas. As ordens já fechadas que receberam partes têm o PnL e os rollups refeitos na
+        mesma transação (funding e comissões de saída costumam chegar depois do fechamento)
+        """
+        ids = sorted({operacao_id for _, _, operacao_id, _, _ in atribuicoes})
+        with self._transacao() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO atribuicoes (tipo, tran_id, operacao_id, fase, valor) VALUES (?, ?, ?, ?, ?)",
+                atribuicoes,
+            )
+            conn.executemany("UPDATE receitas SET atribuida = 1 WHERE tipo = ? AND tran_id = ?", resolvidas)
+            if not ids:
+                return
+            realizado = _realizado(conn, ids)
+            linhas = conn.execute(
+                f"SELECT id, dados FROM operacoes WHERE status = ? AND id IN ({', '.join('?' * len(ids))})",
+                (STATUS_FECHADA, *ids),
+            ).fetchall()
+            for id_, dados in linhas:
+                antes = json.loads(dados)
+                depois = _com_realizado(antes, realizado.get(id_))
+                conn.execute(
+                    "UPDATE operacoes SET pnl_total = ?, dados = ? WHERE id = ?",
+                    (depois.get("pnl_total"), json.dumps(depois), id_),
+                )
+                _aplicar_rollups(conn, antes, depois)
+
+    def realizado(self):
+        """
+        Funding recebido/pago e comissões reais por ordem: {id: {"funding", "taxa_abertura", "taxa_fechamento"}}.
+        Taxas vêm positivas (custo), como nas estimativas do registro
+        """
+        with self._lock_leitura:
+            return _realizado(self._leitura)
+
+    def amostras_execucao(self):
+        """
+        Skews entre as execuções das pernas registrados em cada entrada e saída: {fase: {métrica: [ms, ...]}}.
+        Lidos com json_extract, sem decodificar os registros completos
+        """
+        metricas = ("skew_fill_ms",)
+        amostras = {}
+        with self._lock_leitura:
+            for fase in ("entrada", "saida"):
+                colunas = ", ".join(f"json_extract(dados, '$.execucao_{fase}.{m}')" for m in metricas)
+                linhas = self._leitura.execute(
+                    f"SELECT {colunas} FROM operacoes WHERE json_extract(dados, '$.execucao_{fase}') IS NOT NULL"
+                ).fetchall()
+                amostras[fase] = {m: [linha[i] for linha in linhas] for i, m in enumerate(metricas)}
+        return amostras
+
+    def criar_ordem_pai(self, pai):
+        """
+        Registra uma execução fatiada (plano e progresso em `dados`) antes da primeira ordem-filha
+        """
+        agora_ms = _agora_ms()
+        dados = {k: v for k, v in pai.items() if k != "id"}
+        with self._transacao() as conn:
+            cursor = conn.execute(
+                "INSERT INTO ordens_pai (status, symbol_perpetuo, symbol_futuro, inicio_ts, atualizado_ts, dados) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (pai["status"], pai["symbol_perpetuo"], pai["symbol_futuro"], agora_ms, agora_ms, json.dumps(dados)),
+            )
+        pai["id"] = cursor.lastrowid
+        return pai["id"]
+
+    def atualizar_ordem_pai(self, pai, ordem=None, filhas=None):
+        """
+        Grava o progresso da ordem-pai. Um cancelamento pedido pela interface nunca é sobrescrito
+        por um status não final: nesse caso `pai["status"]` volta como 'cancelando'. Na mesma
+        transação, `filhas` ((fatia, pernas) do registro de execução, já com `taxa`) grava as
+        ordens-filhas de uma fatia e `ordem` insere a operação resultante na primeira execução e
+        a atualiza nas seguintes, enquanto ela continuar aberta
+        """
+        agora_ms = _agora_ms()
+        with self._transacao() as conn:
+            (atual,) = conn.execute("SELECT status FROM ordens_pai WHERE id = ?", (pai["id"],)).fetchone()
+            if atual == STATUS_PAI_CANCELANDO and pai["status"] in (STATUS_PAI_EXECUTANDO, STATUS_PAI_PAUSADA):
+                pai["status"] = STATUS_PAI_CANCELANDO
+            if filhas is not None:
+                _inserir_filhas(conn, pai["id"], *filhas)
+            if ordem is not None and pai.get("operacao_id") is None:
+                cursor = conn.execute(
+                    "INSERT INTO operacoes (status, symbol_perpetuo, symbol_futuro, data_entrada, entrada_ts, "
+                    "data_saida, saida_ts, volume_usd, pnl_total, dados) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    _colunas(ordem),
+                )
+                _aplicar_rollups(conn, None, ordem)
+                ordem["id"] = pai["operacao_id"] = cursor.lastrowid
+            elif ordem is not None:
+                ordem["id"] = pai["operacao_id"]
+                linha = conn.execute(
+                    "SELECT dados FROM operacoes WHERE id = ? AND status = ?", (ordem["id"], STATUS_ABERTA)
+                ).fetchone()
+                if linha is not None:
+                    conn.execute(
+                        "UPDATE operacoes SET status = ?, symbol_perpetuo = ?, symbol_futuro = ?, data_entrada = ?, "
+                        "entrada_ts = ?, data_saida = ?, saida_ts = ?, volume_usd = ?, pnl_total = ?, dados = ? WHERE id = ?",
+                        _colunas(ordem) + (ordem["id"],),
+                    )
+                    _aplicar_rollups(conn, json.loads(linha[0]), ordem)
+            dados = {k: v for k, v in pai.items() if k != "id"}
+            conn.execute(
+                "UPDATE ordens_pai SET status = ?, atualizado_ts = ?, operacao_id = ?, dados = ? WHERE id = ?",
+                (pai["status"], agora_ms, pai.get("operacao_id"), json.dumps(dados), pai["id"]),
+            )
+        return pai["status"]
+
+    def retomar_ordem_pai(self, id_, atualizado_ts, status=STATUS_PAI_EXECUTANDO):
+        """
+        Assume uma execução fatiada ativa cujo processo parou, se ninguém a gravou desde
+        `atualizado_ts` (compare-and-set); `status` 'cancelando' a retoma só para encerrá-la.
+        True se esta sessão ficou com a execução
+        """
+        with self._transacao() as conn:
+            cursor = conn.execute(
+                "UPDATE ordens_pai SET status = ?, atualizado_ts = ? WHERE id = ? AND atualizado_ts = ? AND status IN (?, ?, ?)",
+                (status, _agora_ms(), id_, atualizado_ts, *STATUS_PAI_ATIVOS),
+            )
+        return cursor.rowcount == 1
+
+    def cancelar_ordem_pai(self, id_):
+        """
+        Pede o cancelamento de uma execução fatiada ainda ativa; True se o pedido foi registrado
+        """
+        with self._transacao() as conn:
+            cursor = conn.execute(
+                "UPDATE ordens_pai SET status = ? WHERE id = ? AND status IN (?, ?)",
+                (STATUS_PAI_CANCELANDO, id_, STATUS_PAI_EXECUTANDO, STATUS_PAI_PAUSADA),
+            )
+        return cursor.rowcount == 1
+
+    def status_ordem_pai(self, id_):
+        with self._lock_leitura:
+            linha = self._leitura.execute("SELECT status FROM ordens_pai WHERE id = ?", (id_,)).fetchone()
+        return linha[0] if linha else None
+
+    def ordens_pai(self, limite=20):
+        """
+        Execuções fatiadas mais recentes, com `atualizado_ts` (ms) da última gravação do progresso.
+        O status vem da coluna, que já reflete um cancelamento pedido
+        """
+        with self._lock_leitura:
+            linhas = self._leitura.execute(
+                "SELECT id, status, atualizado_ts, dados FROM ordens_pai ORDER BY inicio_ts DESC, id DESC LIMIT ?", (limite,)
+            ).fetchall()
+        return [
+            dict(json.loads(dados), id=id_, status=status, atualizado_ts=atualizado)
+            for id_, status, atualizado, dados in linhas
+        ]
+
+    def filhas(self, ordem_pai_id):
+        with self._lock_leitura:
+            linhas = self._leitura.execute(
+                "SELECT dados, fatia FROM ordens_filhas WHERE ordem_pai_id = ? ORDER BY fatia, id", (ordem_pai_id,)
+            ).fetchall()
+        return [dict(json.loads(dados), fatia=fatia) for dados, fatia in linhas]
+
+    def resetar(self):
+        with self._transacao() as conn:
+            conn.execute("DELETE FROM operacoes")
+            conn.execute("DELETE FROM rollups")
+            conn.execute("DELETE FROM atribuicoes")
+            conn.execute("DELETE FROM ordens_pai")
+            conn.execute("DELETE FROM ordens_filhas")
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+def get_ledger(user_dir):
+    """
+    Ledger do usuário (uma conexão por processo), importando o JSON legado na primeira abertura
+    """
+    with _ledgers_lock:
+        ledger = _ledgers.get(user_dir)
+        if ledger is None:
+            ledger = Ledger(os.path.join(user_dir, "operacoes.db"), json_legado=os.path.join(user_dir, "operacoes_reais.json"))
+            _ledgers[user_dir] = ledger
+        return ledger
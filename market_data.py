@@ -0,0 +1,231 @@
+# Cliente HTTP compartilhado para os endpoints públicos de fapi.binance.com
+import os
+import threading
+import time
+from decimal import ROUND_FLOOR, Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rate_limiter import get_rate_limiter
+
+BASE_URL = os.environ.get("BINANCE_FAPI_URL", "https://fapi.binance.com")
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+POOL_CONNECTIONS = 4
+POOL_MAXSIZE = 16
+PRICE_SNAPSHOT_TTL = 5  # segundos
+EXCHANGE_INFO_MAX_AGE = 24 * 3600  # segundos; o índice também é refeito quando a lista de símbolos muda
+
+
+def arredondar_step(qty, step):
+    """
+    Arredonda a quantidade para baixo no múltiplo do step (filtro LOT_SIZE) em aritmética decimal.
+    O ruído de ponto flutuante do cálculo (ex.: 0.0029999999999) é descartado antes do piso
+    """
+    passo = Decimal(repr(step))
+    return float((Decimal(repr(round(qty, 12))) / passo).to_integral_value(rounding=ROUND_FLOOR) * passo)
+
+
+class MarketDataClient:
+    def __init__(self, base_url=BASE_URL, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 pool_maxsize=POOL_MAXSIZE):
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json"})
+        self._adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=pool_maxsize, pool_block=False)
+        self.session.mount("https://", self._adapter)
+        self.session.mount("http://", self._adapter)
+
+    def get(self, path, params=None, peso=1):
+        """
+        Executa um GET reaproveitando as conexões keep-alive do pool, respeitando o
+        limite de peso por IP do rate limiter central
+        """
+        limiter = get_rate_limiter()
+        limiter.acquire(peso)
+        response = self.session.get(f"{self.base_url}{path}", params=params, timeout=self.timeout)
+        limiter.observe(response.headers, response.status_code)
+        response.raise_for_status()
+        return response.json()
+
+    def warm_up(self):
+        """
+        Abre a conexão TCP+TLS antecipadamente para que a primeira chamada real
+        já encontre uma conexão pronta no pool
+        """
+        try:
+            self.get("/fapi/v1/ping")
+            return True
+        except requests.RequestException as e:
+            print(f"Erro ao aquecer conexão com a Binance: {str(e)}")
+            return False
+
+    def pool_stats(self):
+        """
+        Retorna os contadores de reuso do pool: 'misses' são conexões novas
+        (handshake completo) e 'hits' são requisições atendidas por conexões reaproveitadas
+        """
+        requisicoes = conexoes = 0
+        pools = self._adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requisicoes += pool.num_requests
+            conexoes += pool.num_connections
+        return {
+            "requests": requisicoes,
+            "hits": max(requisicoes - conexoes, 0),
+            "misses": conexoes,
+        }
+
+    def close(self):
+        self.session.close()
+
+
+class PriceSnapshot:
+    def __init__(self, client=None, max_age=PRICE_SNAPSHOT_TTL):
+        self._client = client
+        self.max_age = max_age
+        self.prices = {}
+        self.fetched_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """
+        Baixa o preço de todos os símbolos em uma única chamada a /fapi/v1/ticker/price
+        """
+        client = self._client or get_market_client()
+        data = client.get("/fapi/v1/ticker/price", peso=2)
+        self.prices = {item["symbol"]: float(item["price"]) for item in data}
+        self.fetched_at = time.time()
+
+    def age(self):
+        return time.time() - self.fetched_at if self.fetched_at else None
+
+    def ensure_fresh(self):
+        if time.time() - self.fetched_at <= self.max_age:
+            return
+        with self._lock:
+            # Outra thread pode ter atualizado enquanto esperávamos o lock
+            if time.time() - self.fetched_at > self.max_age:
+                self.refresh()
+
+    def invalidate(self):
+        self.fetched_at = 0.0
+
+    def price(self, symbol):
+        self.ensure_fresh()
+        if symbol not in self.prices:
+            raise ValueError(f"Preço não encontrado para {symbol}")
+        return self.prices[symbol]
+
+
+class ExchangeInfoIndex:
+    def __init__(self, client=None, snapshot=None, max_age=EXCHANGE_INFO_MAX_AGE):
+        self._client = client
+        self._snapshot = snapshot
+        self.max_age = max_age
+        self.symbols = {}
+        self.built_at = 0.0
+        self._ticker_symbols = frozenset()
+        self._lock = threading.Lock()
+
+    def _simbolos_ativos(self):
+        snapshot = self._snapshot or get_price_snapshot()
+        snapshot.ensure_fresh()
+        return frozenset(snapshot.prices)
+
+    def build(self, simbolos_ativos=frozenset()):
+        """
+        Baixa /fapi/v1/exchangeInfo uma vez e monta a tabela de filtros por símbolo
+        """
+        client = self._client or get_market_client()
+        info = client.get("/fapi/v1/exchangeInfo")
+        symbols = {}
+        for s in info["symbols"]:
+            filtros = {f["filterType"]: f for f in s.get("filters", [])}
+            lot_size = filtros.get("LOT_SIZE", {})
+            price_filter = filtros.get("PRICE_FILTER", {})
+            min_notional = filtros.get("MIN_NOTIONAL", {})
+            symbols[s["symbol"]] = {
+                "symbol": s["symbol"],
+                "pair": s.get("pair"),
+                "status": s.get("status"),
+                "contract_type": s.get("contractType"),
+                "delivery_date": int(s["deliveryDate"]) if s.get("deliveryDate") else None,
+                "step_size": float(lot_size["stepSize"]) if "stepSize" in lot_size else None,
+                "min_qty": float(lot_size["minQty"]) if "minQty" in lot_size else None,
+                "max_qty": float(lot_size["maxQty"]) if "maxQty" in lot_size else None,
+                "tick_size": float(price_filter["tickSize"]) if "tickSize" in price_filter else None,
+                "min_notional": float(min_notional["notional"]) if "notional" in min_notional else None,
+            }
+        self.symbols = symbols
+        self._ticker_symbols = simbolos_ativos
+        self.built_at = time.time()
+
+    def ensure_current(self):
+        """
+        Refaz o índice só quando a lista de símbolos do snapshot de preços mudou
+        (listagem, deslistagem ou vencimento de contrato) ou quando ele ficou velho demais
+        """
+        ativos = self._simbolos_ativos()
+        if self.symbols and ativos == self._ticker_symbols and time.time() - self.built_at <= self.max_age:
+            return
+        with self._lock:
+            if not self.symbols or ativos != self._ticker_symbols or time.time() - self.built_at > self.max_age:
+                self.build(ativos)
+
+    def get(self, symbol):
+        """
+        Filtros do símbolo a partir do índice em memória, sem I/O além do snapshot compartilhado
+        """
+        if not self.symbols:
+            self.ensure_current()
+        return self.symbols.get(symbol)
+
+    def quarter_symbols(self):
+        """
+        Mapeia cada perpétuo USDT ao seu contrato CURRENT_QUARTER
+        """
+        self.ensure_current()
+        return {
+            info["pair"]: symbol
+            for symbol, info in self.symbols.items()
+            if info["contract_type"] == "CURRENT_QUARTER" and "USDT_" in symbol
+        }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_market_client():
+    """
+    Retorna o cliente de market data do processo, criando-o (e aquecendo a
+    conexão) na primeira chamada
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                client = MarketDataClient()
+                client.warm_up()
+                _client = client
+    return _client
+
+
+_snapshot = PriceSnapshot()
+
+
+def get_price_snapshot():
+    return _snapshot
+
+
+_exchange_index = ExchangeInfoIndex()
+
+
+def get_exchange_index():
+    return _exchange_index
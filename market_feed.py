@@ -0,0 +1,164 @@
+# Consumidor dos streams públicos de market data da Binance Futures via WebSocket
+import asyncio
+import json
+import os
+import threading
+import time
+
+from websockets.asyncio.client import connect
+
+WS_URL = os.environ.get("BINANCE_WS_URL", "wss://fstream.binance.com")
+STREAMS = ["!markPrice@arr@1s", "!ticker@arr"]
+RECONNECT_MIN = 1  # segundos
+RECONNECT_MAX = 60
+MAX_AGE_PADRAO = 10  # segundos sem atualização até o dado ser considerado velho
+
+
+def _float_ou_none(valor):
+    return float(valor) if valor not in (None, "") else None
+
+
+class MarketStore:
+    def __init__(self):
+        self._dados = {}
+        self._lock = threading.Lock()
+
+    def _registro(self, symbol):
+        registro = self._dados.get(symbol)
+        if registro is None:
+            registro = {
+                "symbol": symbol,
+                "last_price": None,
+                "mark_price": None,
+                "index_price": None,
+                "funding_rate": None,
+                "next_funding_time": None,
+                "updated_at": 0.0,
+                # Só o ticker atualiza last_price: o markPrice chega a cada 1s e não pode torná-lo fresco
+                "ticker_at": 0.0,
+            }
+            self._dados[symbol] = registro
+        return registro
+
+    def atualizar_mark_price(self, eventos):
+        """
+        Aplica um lote do stream !markPrice@arr
+        """
+        agora = time.time()
+        with self._lock:
+            for e in eventos:
+                registro = self._registro(e["s"])
+                registro["mark_price"] = _float_ou_none(e.get("p"))
+                registro["index_price"] = _float_ou_none(e.get("i"))
+                registro["funding_rate"] = _float_ou_none(e.get("r"))
+                registro["next_funding_time"] = int(e["T"]) if e.get("T") else None
+                registro["updated_at"] = agora
+
+    def atualizar_ticker(self, eventos):
+        """
+        Aplica um lote do stream !ticker@arr (apenas símbolos que mudaram)
+        """
+        agora = time.time()
+        with self._lock:
+            for e in eventos:
+                registro = self._registro(e["s"])
+                registro["last_price"] = _float_ou_none(e.get("c"))
+                registro["updated_at"] = registro["ticker_at"] = agora
+
+    def get(self, symbol):
+        with self._lock:
+            registro = self._dados.get(symbol)
+            return dict(registro) if registro else None
+
+    def price(self, symbol, max_age=MAX_AGE_PADRAO):
+        """
+        Retorna o último preço negociado se ele tiver no máximo `max_age` segundos, senão None
+        """
+        registro = self.get(symbol)
+        if not registro or registro["last_price"] is None:
+            return None
+        if time.time() - registro["ticker_at"] > max_age:
+            return None
+        return registro["last_price"]
+
+    def symbols(self):
+        with self._lock:
+            return list(self._dados.keys())
+
+
+class MarketFeed:
+    def __init__(self, store, url=WS_URL, streams=STREAMS):
+        self.store = store
+        self.url = f"{url}/stream?streams={'/'.join(streams)}"
+        self.connected = False
+        self.reconnects = 0
+        self.last_message_at = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._run()), name="market-feed", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _processar(self, mensagem):
+        payload = json.loads(mensagem)
+        stream = payload.get("stream", "")
+        dados = payload.get("data", [])
+        if stream.startswith("!markPrice@arr"):
+            self.store.atualizar_mark_price(dados)
+        elif stream.startswith("!ticker@arr"):
+            self.store.atualizar_ticker(dados)
+        self.last_message_at = time.time()
+
+    async def _run(self):
+        espera = RECONNECT_MIN
+        while not self._stop.is_set():
+            try:
+                async with connect(self.url, ping_interval=20, ping_timeout=20, max_size=None) as ws:
+                    self.connected = True
+                    espera = RECONNECT_MIN
+                    while not self._stop.is_set():
+                        try:
+                            mensagem = await asyncio.wait_for(ws.recv(), timeout=30)
+                        except asyncio.TimeoutError:
+                            # Nenhuma mensagem em 30s: conexão provavelmente travada
+                            break
+                        self._processar(mensagem)
+            except Exception as e:
+                print(f"Erro no feed de market data: {str(e)}")
+            self.connected = False
+            if self._stop.is_set():
+                break
+            # A Binance derruba conexões a cada 24h; reconectar com backoff exponencial
+            self.reconnects += 1
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, RECONNECT_MAX)
+
+
+_store = MarketStore()
+_feed = None
+_feed_lock = threading.Lock()
+
+
+def get_market_store():
+    return _store
+
+
+def get_market_feed():
+    """
+    Retorna o feed do processo, iniciando a thread de consumo na primeira chamada
+    """
+    global _feed
+    if _feed is None:
+        with _feed_lock:
+            if _feed is None:
+                feed = MarketFeed(_store)
+                feed.start()
+                _feed = feed
+    return _feed
@@ -0,0 +1,105 @@
+# Motor de avaliação da carteira: marca todas as ordens abertas de uma só vez
+import numpy as np
+import pandas as pd
+
+PERIODOS_FUNDING_ANO = 3 * 365
+FORMATO_DATA = "%Y-%m-%d %H:%M:%S"
+
+COLUNAS_PNL = ["pnl_funding", "pnl_basis", "pnl_futuro", "pnl_perp", "taxa_abertura", "pnl_total", "apr"]
+
+
+def entrada_ms(ordens):
+    """
+    Converte o data_entrada de todas as ordens para timestamps em ms (UTC) de uma vez
+    """
+    datas = pd.to_datetime(pd.Series([o["data_entrada"] for o in ordens], dtype="object"), format=FORMATO_DATA, utc=True)
+    return ((datas - pd.Timestamp(0, tz="UTC")) // pd.Timedelta(milliseconds=1)).to_numpy(dtype="int64")
+
+
+def resolver_funding(symbols, entradas_ms, funding_store):
+    """
+    Agrupa as ordens por perpétuo, sincroniza o histórico uma única vez por símbolo a partir
+    da entrada mais antiga e fatia os eventos de cada ordem com busca binária nos timestamps.
+    Retorna (soma_rates, n_eventos, historicos), alinhados com as ordens
+    """
+    symbols = np.asarray(symbols, dtype="object")
+    entradas_ms = np.asarray(entradas_ms, dtype="int64")
+    soma_rates = np.zeros(len(symbols), dtype="float64")
+    n_eventos = np.zeros(len(symbols), dtype="int64")
+    historicos = [None] * len(symbols)
+
+    for symbol in pd.unique(symbols):
+        posicoes = np.flatnonzero(symbols == symbol)
+        times, rates = funding_store.arrays(symbol, int(entradas_ms[posicoes].min()))
+        acumulado = np.concatenate([[0.0], np.cumsum(rates)])
+        inicio = np.searchsorted(times, entradas_ms[posicoes], side="left")
+        soma_rates[posicoes] = acumulado[-1] - acumulado[inicio]
+        n_eventos[posicoes] = len(times) - inicio
+        # Eventos convertidos uma vez por símbolo; cada ordem recebe apenas a sua fatia
+        eventos = [
+            {"rate": rate, "time": tempo}
+            for rate, tempo in zip(rates.tolist(), pd.to_datetime(times, unit="ms", utc=True).to_pydatetime())
+        ]
+        for posicao, i in zip(posicoes, inicio):
+            historicos[posicao] = eventos[i:]
+
+    return soma_rates, n_eventos, historicos
+
+
+def avaliar_carteira(ordens, precos, funding_store, realizado=None):
+    """
+    Calcula PnL de funding, basis, taxas, total e APR de todas as ordens a partir de um
+    único snapshot de preços ({symbol: preço}) e do histórico local de funding.
+    Com `realizado` ({id: {"funding", "taxa_abertura"}}, vindo da conciliação de receitas da
+    conta), o funding e a taxa de abertura reais substituem as estimativas das ordens que os têm.
+    Retorna um DataFrame alinhado com `ordens` (mesma ordem, índice 0..n-1)
+    """
+    if not ordens:
+        return pd.DataFrame(columns=COLUNAS_PNL + ["funding_history", "funding_realizado"])
+
+    df = pd.DataFrame({
+        "symbol_perpetuo": [o["symbol_perpetuo"] for o in ordens],
+        "symbol_futuro": [o["symbol_futuro"] for o in ordens],
+        "volume_usd": [float(o["volume_usd"]) for o in ordens],
+        "preco_entrada_perp": [float(o["preco_entrada_perp"]) for o in ordens],
+        "preco_entrada_futuro": [float(o["preco_entrada_futuro"]) for o in ordens],
+        "taxa_abertura": [float(o.get("taxa_abertura", 0)) for o in ordens],
+        "qty_perp": [float(o.get("qty_perp") or 0) for o in ordens],
+        "qty_fut": [float(o.get("qty_fut") or 0) for o in ordens],
+    })
+    df["entrada_ms"] = entrada_ms(ordens)
+    df["preco_atual_perp"] = df["symbol_perpetuo"].map(precos).astype("float64")
+    df["preco_atual_fut"] = df["symbol_futuro"].map(precos).astype("float64")
+
+    # Funding acumulado desde a entrada de cada ordem (uma sincronização por símbolo)
+    soma_rates, n_eventos, historicos = resolver_funding(df["symbol_perpetuo"], df["entrada_ms"], funding_store)
+
+    volume = df["volume_usd"].to_numpy()
+    df["pnl_funding"] = soma_rates * volume
+    media = np.divide(soma_rates, n_eventos, out=np.zeros_like(soma_rates), where=n_eventos > 0)
+    df["apr"] = np.where(n_eventos > 0, (1 + media) ** PERIODOS_FUNDING_ANO - 1, 0.0)
+
+    # Basis: long no trimestral, short no perpétuo, sobre as quantidades executadas
+    # (registros sem quantidade usam volume / preço de entrada)
+    qty_fut = df["qty_fut"].where(df["qty_fut"] > 0, volume / df["preco_entrada_futuro"])
+    qty_perp = df["qty_perp"].where(df["qty_perp"] > 0, volume / df["preco_entrada_perp"])
+    df["pnl_futuro"] = (df["preco_atual_fut"] - df["preco_entrada_futuro"]) * qty_fut
+    df["pnl_perp"] = (df["preco_entrada_perp"] - df["preco_atual_perp"]) * qty_perp
+    df["pnl_basis"] = df["pnl_futuro"] + df["pnl_perp"]
+
+    reais = pd.DataFrame([(realizado or {}).get(o.get("id"), {}) for o in ordens], columns=["funding", "taxa_abertura"], dtype="float64")
+    df["funding_realizado"] = reais["funding"].notna().to_numpy()
+    df["pnl_funding"] = reais["funding"].fillna(df["pnl_funding"]).to_numpy()
+    df["taxa_abertura"] = reais["taxa_abertura"].fillna(df["taxa_abertura"]).to_numpy()
+
+    df["pnl_total"] = df["pnl_funding"] + df["pnl_basis"] - df["taxa_abertura"]
+    df["funding_history"] = historicos
+    return df
+
+
+def totais(carteira):
+    """
+    Soma das colunas de PnL (ordens sem preço atual ficam de fora)
+    """
+    validas = carteira.dropna(subset=["pnl_total"])
+    return {coluna: float(validas[coluna].sum()) for coluna in ["pnl_funding", "pnl_basis", "taxa_abertura", "pnl_total"]}
@@ -0,0 +1,174 @@
+# Controle central de peso de requisições (request weight) e ordens da Binance Futures
+import heapq
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+PRIORIDADE_ORDEM = 0
+PRIORIDADE_INTERATIVA = 1
+PRIORIDADE_BACKGROUND = 2
+
+LIMITE_PESO_MINUTO = 2400  # REQUEST_WEIGHT por IP
+LIMITE_ORDENS_10S = 300  # ORDERS por conta
+LIMITE_ORDENS_MINUTO = 1200
+# Fração da capacidade de peso que cada prioridade precisa deixar livre para as mais urgentes
+RESERVA = {PRIORIDADE_ORDEM: 0.0, PRIORIDADE_INTERATIVA: 0.05, PRIORIDADE_BACKGROUND: 0.25}
+MAX_ESPERA = 30  # segundos; bloqueios mais longos falham na hora em vez de travar a página
+BACKOFF_PADRAO = 60  # segundos, quando 429/418 vier sem Retry-After
+
+_contexto = threading.local()
+
+
+@contextmanager
+def prioridade(nivel):
+    """
+    Define a prioridade padrão das requisições feitas pela thread atual dentro do bloco
+    """
+    anterior = getattr(_contexto, "prioridade", None)
+    _contexto.prioridade = nivel
+    try:
+        yield
+    finally:
+        _contexto.prioridade = anterior
+
+
+def prioridade_atual():
+    nivel = getattr(_contexto, "prioridade", None)
+    return PRIORIDADE_INTERATIVA if nivel is None else nivel
+
+
+class LimiteExcedido(RuntimeError):
+    """
+    Chamada recusada localmente, antes de ir à Binance, porque o bloqueio do limite passa de MAX_ESPERA
+    """
+
+
+class TokenBucket:
+    def __init__(self, capacidade, janela):
+        self.capacidade = capacidade
+        self.taxa = capacidade / janela
+        self.tokens = float(capacidade)
+        self.atualizado = time.monotonic()
+
+    def _repor(self):
+        agora = time.monotonic()
+        self.tokens = min(self.capacidade, self.tokens + (agora - self.atualizado) * self.taxa)
+        self.atualizado = agora
+
+    def consumir(self, custo):
+        self._repor()
+        self.tokens -= custo
+
+    def tempo_ate(self, custo, reserva=0.0):
+        self._repor()
+        # Nunca exigir mais do que o bucket cheio, senão requisições pesadas esperariam para sempre
+        falta = min(custo + self.capacidade * reserva, self.capacidade) - self.tokens
+        return max(falta / self.taxa, 0.0)
+
+    def sincronizar(self, usado):
+        """
+        Alinha o bucket ao consumo informado pelo servidor (que enxerga todos os processos do IP)
+        """
+        self._repor()
+        self.tokens = min(self.tokens, self.capacidade - usado)
+
+
+class RateLimiter:
+    def __init__(self, limite_peso=LIMITE_PESO_MINUTO):
+        self.peso_ip = TokenBucket(limite_peso, 60)
+        self._ordens = {}
+        self._fila = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self.bloqueado_ate = 0.0
+        self.usado_servidor = 0
+        self.respostas_429 = 0
+        self.respostas_418 = 0
+
+    def _buckets_conta(self, conta):
+        if conta not in self._ordens:
+            self._ordens[conta] = (TokenBucket(LIMITE_ORDENS_10S, 10), TokenBucket(LIMITE_ORDENS_MINUTO, 60))
+        return self._ordens[conta]
+
+    def _espera(self, peso, nivel, conta, ordens):
+        """
+        Segundos até a requisição poder sair (0 = pode sair agora)
+        """
+        espera = max(self.bloqueado_ate - time.monotonic(), 0.0)
+        espera = max(espera, self.peso_ip.tempo_ate(peso, RESERVA[nivel]))
+        if ordens and conta is not None:
+            for bucket in self._buckets_conta(conta):
+                espera = max(espera, bucket.tempo_ate(ordens))
+        return espera
+
+    def acquire(self, peso=1, nivel=None, conta=None, ordens=0):
+        """
+        Bloqueia até haver peso (e limite de ordens da conta) disponível, atendendo
+        primeiro ordens, depois chamadas interativas e por último atualizações em background
+        """
+        nivel = prioridade_atual() if nivel is None else nivel
+        with self._cond:
+            ticket = (nivel, next(self._seq))
+            heapq.heappush(self._fila, ticket)
+            try:
+                while True:
+                    bloqueio = self.bloqueado_ate - time.monotonic()
+                    if bloqueio > MAX_ESPERA:
+                        raise LimiteExcedido(f"Limite de requisições da Binance atingido; novas chamadas liberadas em {bloqueio:.0f}s")
+                    espera = self._espera(peso, nivel, conta, ordens) if self._fila[0] == ticket else 1.0
+                    if espera <= 0:
+                        break
+                    self._cond.wait(min(espera, 1.0))
+            finally:
+                self._fila.remove(ticket)
+                heapq.heapify(self._fila)
+                self._cond.notify_all()
+            self.peso_ip.consumir(peso)
+            if ordens and conta is not None:
+                for bucket in self._buckets_conta(conta):
+                    bucket.consumir(ordens)
+
+    def observe(self, headers, status_code=None, conta=None):
+        """
+        Atualiza o estado a partir dos headers X-MBX-* e aplica backoff em 429/418
+        """
+        with self._cond:
+            usado = headers.get("X-MBX-USED-WEIGHT-1M")
+            if usado is not None:
+                self.usado_servidor = int(usado)
+                self.peso_ip.sincronizar(self.usado_servidor)
+            if conta is not None:
+                curto, longo = self._buckets_conta(conta)
+                if headers.get("X-MBX-ORDER-COUNT-10S") is not None:
+                    curto.sincronizar(int(headers["X-MBX-ORDER-COUNT-10S"]))
+                if headers.get("X-MBX-ORDER-COUNT-1M") is not None:
+                    longo.sincronizar(int(headers["X-MBX-ORDER-COUNT-1M"]))
+            if status_code in (429, 418):
+                if status_code == 429:
+                    self.respostas_429 += 1
+                else:
+                    self.respostas_418 += 1
+                retry_after = headers.get("Retry-After")
+                espera = float(retry_after) if retry_after else BACKOFF_PADRAO
+                self.bloqueado_ate = max(self.bloqueado_ate, time.monotonic() + espera)
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            self.peso_ip._repor()
+            return {
+                "peso_usado_servidor": self.usado_servidor,
+                "peso_disponivel": int(self.peso_ip.tokens),
+                "na_fila": len(self._fila),
+                "bloqueado_por": max(self.bloqueado_ate - time.monotonic(), 0.0),
+                "respostas_429": self.respostas_429,
+                "respostas_418": self.respostas_418,
+            }
+
+
+_limiter = RateLimiter()
+
+
+def get_rate_limiter():
+    return _limiter
@@ -0,0 +1,90 @@
+# Conciliação do funding e das comissões reais da conta (/fapi/v1/income) com as ordens do ledger
+import time
+
+from ledger import FASE_ENTRADA, FASE_FUNDING, FASE_SAIDA
+
+TIPOS_RECEITA = ("FUNDING_FEE", "COMMISSION")
+LIMITE_PAGINA = 1000
+JANELA_CONSULTA = 7 * 24 * 3600 * 1000  # intervalo máximo entre startTime e endTime aceito pelo endpoint
+HISTORICO_MAXIMO = 90 * 24 * 3600 * 1000  # a Binance só devolve os últimos ~3 meses
+MARGEM_ATRASO = 10 * 60 * 1000  # a última janela é relida: receitas podem aparecer com algum atraso
+JANELA_COMISSAO = 5 * 60 * 1000  # distância máxima entre uma comissão e a entrada/saída da ordem
+JANELA_ORFA = 3600 * 1000  # receitas sem ordem correspondente após esse tempo deixam de ser reprocessadas
+
+
+def sincronizar_receitas(client, ledger, agora_ms=None):
+    """
+    Busca as receitas da conta a partir do cursor salvo, em janelas de até 7 dias e páginas de
+    até 1000 registros, e grava as de funding e comissão no ledger. Na rotina normal é uma
+    única chamada (peso 30) por conta. Retorna o número de registros recebidos
+    """
+    agora_ms = agora_ms or int(time.time() * 1000)
+    inicio = ledger.cursor_receitas()
+    if inicio is None:
+        inicio = max(ledger.primeira_entrada_ms() or agora_ms - JANELA_CONSULTA, agora_ms - HISTORICO_MAXIMO)
+
+    recebidos = 0
+    while inicio <= agora_ms:
+        fim = min(inicio + JANELA_CONSULTA, agora_ms)
+        pagina = client.futures_income_history(startTime=inicio, endTime=fim, limit=LIMITE_PAGINA)
+        recebidos += len(pagina)
+        if len(pagina) >= LIMITE_PAGINA:
+            # Página cheia: continua do último timestamp recebido (o tranId descarta repetidos)
+            proximo = max(max(int(r["time"]) for r in pagina), inicio + 1)
+        else:
+            proximo = fim + 1
+        ledger.gravar_receitas(
+            [r for r in pagina if r["incomeType"] in TIPOS_RECEITA],
+            max(min(proximo, agora_ms - MARGEM_ATRASO), inicio),
+        )
+        if fim >= agora_ms and len(pagina) < LIMITE_PAGINA:
+            break
+        inicio = proximo
+    return recebidos
+
+
+def atribuir_receitas(ledger, agora_ms=None):
+    """
+    Distribui as receitas pendentes entre as ordens: funding do perpétuo vai para as ordens
+    abertas naquele instante, na proporção do volume; cada comissão vai inteira para a ordem
+    com entrada ou saída mais próxima no tempo, na mesma perna
+    """
+    agora_ms = agora_ms or int(time.time() * 1000)
+    atribuicoes, resolvidas = [], []
+    for receita in ledger.receitas_pendentes():
+        partes = []
+        if receita["tipo"] == "FUNDING_FEE":
+            posicoes = ledger.posicoes_em(receita["symbol"], receita["tempo"])
+            volume_total = sum(volume for _, volume in posicoes)
+            if volume_total > 0:
+                partes = [
+                    (receita["tipo"], receita["tran_id"], id_, FASE_FUNDING, receita["valor"] * volume / volume_total)
+                    for id_, volume in posicoes
+                ]
+        else:
+            candidatos = [
+                (abs(ts - receita["tempo"]), id_, fase)
+                for id_, entrada, saida in ledger.eventos_proximos(receita["symbol"], receita["tempo"], JANELA_COMISSAO)
+                for fase, ts in ((FASE_ENTRADA, entrada), (FASE_SAIDA, saida))
+                if ts is not None
+            ]
+            if candidatos:
+                _, id_, fase = min(candidatos)
+                partes = [(receita["tipo"], receita["tran_id"], id_, fase, receita["valor"])]
+        # Sem ordem correspondente ainda (ex.: registro gravado logo após a execução): tenta de novo depois
+        if partes or agora_ms - receita["tempo"] > JANELA_ORFA:
+            atribuicoes.extend(partes)
+            resolvidas.append((receita["tipo"], receita["tran_id"]))
+    if resolvidas:
+        ledger.gravar_atribuicoes(atribuicoes, resolvidas)
+    return len(resolvidas)
+
+
+def reconciliar(client, ledger):
+    """
+    Sincroniza as receitas da conta, atribui as pendentes e devolve o realizado por ordem
+    """
+    agora_ms = int(time.time() * 1000)
+    sincronizar_receitas(client, ledger, agora_ms)
+    atribuir_receitas(ledger, agora_ms)
+    return ledger.realizado()
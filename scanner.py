@@ -0,0 +1,61 @@
+# Scanner de oportunidades: avalia todos os pares trimestrais de uma só vez
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from funding_store import get_funding_store
+from market_data import get_exchange_index
+from signals import adicionar_sinais, vencimento_ms
+
+MAX_WORKERS = 8
+
+
+def get_recent_funding_bulk(symbols, limit=3, store=None):
+    """
+    Lê o funding recente de vários perpétuos do histórico local, sincronizando em
+    paralelo os símbolos desatualizados. Retorna {symbol: (soma_funding, ultimo_funding_ts)}
+    """
+    store = store or get_funding_store()
+    symbols = list(symbols)
+    if not symbols:
+        return {}
+    resultado = {}
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(symbols))) as executor:
+        futures = {symbol: executor.submit(store.recent, symbol, limit) for symbol in symbols}
+        for symbol, future in futures.items():
+            try:
+                resultado[symbol] = future.result()
+            except Exception as e:
+                print(f"Erro ao obter funding de {symbol}: {str(e)}")
+    return resultado
+
+
+def escanear_oportunidades(quarter_symbols, precos, funding, funding_threshold, funding_basis_ratio, now_ms=None):
+    """
+    Calcula basis, basis diário, relação funding/basis e o gatilho de entrada para
+    todos os pares {perpétuo: trimestral} e devolve um DataFrame ordenado pelo ranking
+    """
+    linhas = [
+        {
+            "Perpétuo": perp,
+            "Trimestral": fut,
+            "preco_perp": precos.get(perp),
+            "preco_fut": precos.get(fut),
+            "funding_diario": funding.get(perp, (None, None))[0],
+        }
+        for perp, fut in quarter_symbols.items()
+    ]
+    df = pd.DataFrame(linhas, columns=["Perpétuo", "Trimestral", "preco_perp", "preco_fut", "funding_diario"])
+    df = df.dropna(subset=["preco_perp", "preco_fut", "funding_diario"])
+    if df.empty:
+        return df
+
+    # Data de entrega do exchangeInfo quando disponível; senão, a data do sufixo do símbolo
+    index = get_exchange_index()
+    entregas = [(index.get(fut) or {}).get("delivery_date") for fut in df["Trimestral"]]
+    df["vencimento_ms"] = pd.Series(entregas, index=df.index, dtype="float64").fillna(
+        pd.Series(vencimento_ms(df["Trimestral"]), index=df.index)
+    )
+    df = adicionar_sinais(df, now_ms=now_ms, funding_threshold=funding_threshold, funding_basis_ratio=funding_basis_ratio)
+
+    return df.sort_values(["gatilho", "relacao_fb"], ascending=[False, False]).reset_index(drop=True)
@@ -0,0 +1,87 @@
+# Motor de sinais de arbitragem vetorizado (NumPy/pandas)
+#
+# Recebe arrays alinhados (um elemento por símbolo ou por par símbolo-timestamp) e calcula
+# todas as colunas de sinal de uma vez. Usado pela página, pelo scanner e por backtests.
+import time
+
+import numpy as np
+import pandas as pd
+
+FUNDING_THRESHOLD = 0.0003
+FUNDING_BASIS_RATIO = 1.5
+DIAS_MINIMOS = 1.0
+DIAS_PADRAO = 90.0
+HORA_ENTREGA_UTC = 8  # contratos trimestrais da Binance vencem às 08:00 UTC
+MS_POR_DIA = 86_400_000
+
+
+def vencimento_ms(symbols):
+    """
+    Extrai o vencimento (ms, UTC) do sufixo _AAMMDD dos símbolos trimestrais.
+    Símbolos sem data válida resultam em NaN
+    """
+    datas = pd.to_datetime(
+        "20" + pd.Series(symbols, dtype="object").astype(str).str.split("_").str[-1],
+        format="%Y%m%d",
+        errors="coerce",
+        utc=True,
+    ) + pd.Timedelta(hours=HORA_ENTREGA_UTC)
+    return ((datas - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(milliseconds=1)).to_numpy(dtype="float64")
+
+
+def dias_ate_vencimento(expiry_ms, now_ms=None):
+    """
+    Dias (fracionários) até o vencimento, com piso de DIAS_MINIMOS.
+    Vencimentos desconhecidos (NaN) assumem DIAS_PADRAO
+    """
+    if now_ms is None:
+        now_ms = time.time() * 1000
+    dias = (np.asarray(expiry_ms, dtype="float64") - np.asarray(now_ms, dtype="float64")) / MS_POR_DIA
+    return np.where(np.isnan(dias), DIAS_PADRAO, np.maximum(dias, DIAS_MINIMOS))
+
+
+def calcular_sinais(preco_perp, preco_fut, funding_diario, expiry_ms, now_ms=None,
+                    funding_threshold=FUNDING_THRESHOLD, funding_basis_ratio=FUNDING_BASIS_RATIO):
+    """
+    Calcula dias_venc, basis_pct, basis_dia, relacao_fb e o gatilho de entrada para
+    arrays alinhados. `now_ms` pode ser escalar ou um array (um instante por linha)
+    """
+    preco_perp = np.asarray(preco_perp, dtype="float64")
+    preco_fut = np.asarray(preco_fut, dtype="float64")
+    funding_diario = np.asarray(funding_diario, dtype="float64")
+
+    dias_venc = dias_ate_vencimento(expiry_ms, now_ms)
+    basis_pct = (preco_fut - preco_perp) / preco_perp
+    basis_dia = basis_pct / dias_venc
+    relacao_fb = np.divide(funding_diario, basis_dia, out=np.zeros_like(basis_dia), where=basis_dia != 0)
+    gatilho_funding = funding_diario > funding_threshold
+    gatilho_ratio = funding_diario > funding_basis_ratio * basis_dia
+
+    return {
+        "dias_venc": dias_venc,
+        "basis_pct": basis_pct,
+        "basis_dia": basis_dia,
+        "relacao_fb": relacao_fb,
+        "gatilho_funding": gatilho_funding,
+        "gatilho_ratio": gatilho_ratio,
+        "gatilho": gatilho_funding | gatilho_ratio,
+    }
+
+
+def adicionar_sinais(df, now_ms=None, funding_threshold=FUNDING_THRESHOLD, funding_basis_ratio=FUNDING_BASIS_RATIO):
+    """
+    Versão para DataFrame: espera as colunas preco_perp, preco_fut, funding_diario e
+    vencimento_ms (e opcionalmente now_ms, para backtests) e devolve uma cópia com os sinais
+    """
+    if now_ms is None and "now_ms" in df:
+        now_ms = df["now_ms"].to_numpy()
+    sinais = calcular_sinais(
+        df["preco_perp"].to_numpy(),
+        df["preco_fut"].to_numpy(),
+        df["funding_diario"].to_numpy(),
+        df["vencimento_ms"].to_numpy(),
+        now_ms=now_ms,
+        funding_threshold=funding_threshold,
+        funding_basis_ratio=funding_basis_ratio,
+    )
+    return df.assign(**sinais)
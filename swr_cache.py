@@ -0,0 +1,138 @@
+# Cache stale-while-revalidate com regiões nomeadas: serve o último valor na hora e atualiza em background
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from rate_limiter import PRIORIDADE_BACKGROUND, prioridade
+
+MAX_WORKERS = 4
+MAX_ENTRADAS = 256  # por região; as menos usadas recentemente são descartadas além disso
+
+REGIAO_SIMBOLOS = "simbolos"
+REGIAO_FUNDING = "funding"  # chaves começam pelo símbolo
+REGIAO_SALDOS = "saldos"  # chave = id da conta
+REGIAO_RECEITAS = "receitas"  # chave = id da conta; funding/comissões reais conciliados por ordem
+
+
+class _Entrada:
+    def __init__(self):
+        self.valor = None
+        self.tem_valor = False
+        self.buscado_em = 0.0
+        self.atualizando = False
+        self.erro = None
+        self.carregado = threading.Event()
+
+
+class SWRCache:
+    def __init__(self, max_workers=MAX_WORKERS, max_entradas=MAX_ENTRADAS):
+        self._regioes = {}
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="swr")
+
+    def get(self, regiao, key, loader, ttl):
+        """
+        Retorna o valor de `key` na `regiao`. Sem valor ainda, a primeira chamada executa `loader`
+        e as concorrentes esperam por ela (uma única requisição upstream). Com valor vencido,
+        devolve o valor antigo imediatamente e agenda uma única atualização em background
+        """
+        with self._lock:
+            entradas = self._regioes.setdefault(regiao, OrderedDict())
+            entrada = entradas.get(key)
+            if entrada is not None:
+                entradas.move_to_end(key)
+            if entrada is not None and entrada.tem_valor:
+                if time.time() - entrada.buscado_em > ttl and not entrada.atualizando:
+                    entrada.atualizando = True
+                    self._executor.submit(self._atualizar, entrada, loader)
+                return entrada.valor
+            lider = entrada is None or (not entrada.atualizando and entrada.carregado.is_set())
+            if lider:
+                entrada = _Entrada()
+                entrada.atualizando = True
+                entradas[key] = entrada
+                entradas.move_to_end(key)
+                # LRU por região: chaves que deixaram de ser usadas não ficam para sempre no processo
+                while len(entradas) > self.max_entradas:
+                    entradas.popitem(last=False)
+
+        if not lider:
+            entrada.carregado.wait()
+            if not entrada.tem_valor:
+                raise entrada.erro
+            return entrada.valor
+
+        try:
+            valor = loader()
+            self._gravar(entrada, valor)
+            return valor
+        except Exception as e:
+            entrada.erro = e
+            raise
+        finally:
+            entrada.atualizando = False
+            entrada.carregado.set()
+
+    def _gravar(self, entrada, valor):
+        with self._lock:
+            entrada.valor = valor
+            entrada.tem_valor = True
+            entrada.buscado_em = time.time()
+            entrada.erro = None
+
+    def _atualizar(self, entrada, loader):
+        try:
+            with prioridade(PRIORIDADE_BACKGROUND):
+                self._gravar(entrada, loader())
+        except Exception as e:
+            # Mantém o valor antigo; o erro fica visível em info()
+            entrada.erro = e
+        finally:
+            entrada.atualizando = False
+
+    def info(self, regiao, key):
+        """
+        Idade (segundos) do valor em cache, se há atualização em andamento e o último erro
+        """
+        entrada = self._regioes.get(regiao, {}).get(key)
+        if entrada is None or not entrada.tem_valor:
+            return None
+        return {
+            "idade": time.time() - entrada.buscado_em,
+            "atualizando": entrada.atualizando,
+            "erro": str(entrada.erro) if entrada.erro else None,
+        }
+
+    def invalidate(self, regiao, key=None, prefixo=None, hard=False):
+        """
+        Invalida uma chave, as chaves (tuplas) que começam com `prefixo`, ou a região inteira.
+        Por padrão a entrada só é marcada como vencida: o próximo acesso ainda serve o valor
+        antigo e dispara a atualização em background. Com `hard=True` a entrada é descartada
+        mesmo com uma atualização em andamento (que termina numa entrada órfã): o próximo
+        acesso espera uma busca iniciada depois da invalidação
+        """
+        with self._lock:
+            entradas = self._regioes.get(regiao, {})
+            if key is not None:
+                alvos = [key]
+            elif prefixo is not None:
+                alvos = [k for k in entradas if isinstance(k, tuple) and k[:len(prefixo)] == prefixo]
+            else:
+                alvos = list(entradas)
+            for alvo in alvos:
+                entrada = entradas.get(alvo)
+                if entrada is None:
+                    continue
+                if hard:
+                    del entradas[alvo]
+                else:
+                    entrada.buscado_em = 0.0
+
+
+_cache = SWRCache()
+
+
+def get_swr_cache():
+    return _cache
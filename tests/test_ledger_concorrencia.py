@@ -0,0 +1,61 @@
+# Várias sessões (processos) gravando no mesmo ledger e disputando o fechamento das mesmas ordens
+import json
+import multiprocessing as mp
+import os
+
+from ledger import STATUS_FECHADA, STATUS_FECHANDO, Ledger
+
+N_PROCESSOS = 16
+N_INSERCOES = 25
+N_IMPORTADAS = 20
+
+
+def _ordem(processo, i):
+    return {
+        "status": "aberta",
+        "symbol_perpetuo": "BTCUSDT",
+        "symbol_futuro": "BTCUSDT_261225",
+        "data_entrada": "2026-10-01 00:00:00",
+        "volume_usd": 100.0,
+        "preco_entrada_perp": 100.0,
+        "preco_entrada_futuro": 101.0,
+        "processo": processo,
+        "i": i,
+    }
+
+
+def _sessao(diretorio, processo, fila):
+    ledger = Ledger(os.path.join(diretorio, "operacoes.db"), json_legado=os.path.join(diretorio, "operacoes_reais.json"))
+    for i in range(N_INSERCOES):
+        ledger.inserir(_ordem(processo, i))
+    # Todas as sessões tentam fechar as mesmas ordens importadas do JSON
+    fechadas = []
+    dono = f"sessao-{processo}"
+    for id_ in range(1, N_IMPORTADAS + 1):
+        if not ledger.reservar_fechamento(id_, dono):
+            continue
+        ordem = next(o for o in ledger.abertas() if o["id"] == id_)
+        ordem.update(status=STATUS_FECHADA, data_saida="2026-10-02 00:00:00", pnl_total=1.0)
+        ledger.atualizar(ordem, status_esperado=STATUS_FECHANDO, dono=dono)
+        fechadas.append(id_)
+    fila.put(fechadas)
+
+
+def test_fechamento_concorrente_fecha_cada_ordem_uma_vez(tmp_path):
+    with open(tmp_path / "operacoes_reais.json", "w") as f:
+        json.dump([_ordem(-1, i) for i in range(N_IMPORTADAS)], f)
+    fila = mp.Queue()
+    processos = [mp.Process(target=_sessao, args=(str(tmp_path), p, fila)) for p in range(N_PROCESSOS)]
+    for p in processos:
+        p.start()
+    fechamentos = sorted(id_ for _ in processos for id_ in fila.get(timeout=120))
+    for p in processos:
+        p.join(timeout=120)
+        assert p.exitcode == 0
+
+    ledger = Ledger(str(tmp_path / "operacoes.db"))
+    # JSON importado uma única vez, nenhuma inserção perdida e cada ordem fechada por uma só sessão
+    assert ledger.contar() == N_IMPORTADAS + N_PROCESSOS * N_INSERCOES
+    assert fechamentos == list(range(1, N_IMPORTADAS + 1))
+    assert ledger.contar(STATUS_FECHADA) == N_IMPORTADAS
+    assert ledger.resumo()["n"] == N_IMPORTADAS
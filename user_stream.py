@@ -0,0 +1,226 @@
+# User data stream da Binance Futures (listenKey): saldos, posições e ordens da conta mantidos em memória
+import asyncio
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from websockets.asyncio.client import connect
+
+from market_feed import RECONNECT_MAX, RECONNECT_MIN, WS_URL
+from rate_limiter import PRIORIDADE_BACKGROUND, prioridade
+
+KEEPALIVE_INTERVAL = 30 * 60  # a listenKey expira em 60 min sem keepalive
+RESSINC_DEBOUNCE = 1.0  # segundos; agrupa eventos de saldo antes de recalcular a margem disponível
+MAX_ORDENS = 1000  # últimas ordens mantidas no estado
+VERIFICACAO = 5  # segundos máximos de espera por mensagem antes de conferir o keepalive e o pedido de parada
+
+
+class AccountState:
+    def __init__(self):
+        self.saldos = {}
+        self.disponivel = {}
+        self.posicoes = {}
+        self.ordens = OrderedDict()
+        self.sincronizado_em = None
+        self.atualizado_em = None
+        # True entre um ACCOUNT_UPDATE e a ressincronização: a margem disponível é só uma estimativa
+        self.margem_provisoria = False
+        self._cond = threading.Condition()
+
+    def carregar_snapshot(self, account):
+        """
+        Estado completo a partir do GET /fapi/v2/account (futures_account)
+        """
+        with self._cond:
+            self.saldos = {a["asset"]: float(a["walletBalance"]) for a in account["assets"]}
+            self.disponivel = {a["asset"]: float(a["availableBalance"]) for a in account["assets"]}
+            self.posicoes = {
+                p["symbol"]: {"qty": float(p["positionAmt"]), "preco_entrada": float(p.get("entryPrice") or 0), "pnl_nao_realizado": float(p.get("unrealizedProfit") or 0)}
+                for p in account.get("positions", [])
+                if float(p["positionAmt"]) != 0
+            }
+            self.sincronizado_em = self.atualizado_em = time.time()
+            self.margem_provisoria = False
+            self._cond.notify_all()
+
+    def aplicar_conta(self, evento):
+        """
+        ACCOUNT_UPDATE: saldo em carteira e posições que mudaram
+        """
+        dados = evento["a"]
+        with self._cond:
+            for saldo in dados.get("B", []):
+                anterior = self.saldos.get(saldo["a"], 0.0)
+                self.saldos[saldo["a"]] = float(saldo["wb"])
+                # Ajuste imediato da margem disponível pela variação do saldo; o valor exato vem na ressincronização
+                self.disponivel[saldo["a"]] = self.disponivel.get(saldo["a"], 0.0) + float(saldo["wb"]) - anterior
+            for posicao in dados.get("P", []):
+                qty = float(posicao["pa"])
+                if qty == 0:
+                    self.posicoes.pop(posicao["s"], None)
+                else:
+                    self.posicoes[posicao["s"]] = {"qty": qty, "preco_entrada": float(posicao["ep"]), "pnl_nao_realizado": float(posicao["up"])}
+            self.margem_provisoria = True
+            self.atualizado_em = time.time()
+            self._cond.notify_all()
+
+    def aplicar_ordem(self, evento):
+        """
+        ORDER_TRADE_UPDATE: status, preço médio, quantidade executada e comissão acumulada por ordem
+        """
+        o = evento["o"]
+        with self._cond:
+            ordem = self.ordens.pop(o["i"], None) or {"symbol": o["s"], "comissao": 0.0}
+            ordem["status"] = o["X"]
+            ordem["avg_price"] = float(o["ap"])
+            ordem["executed_qty"] = float(o["z"])
+            if o.get("x") == "TRADE":
+                ordem["comissao"] += float(o.get("n") or 0)
+                ordem["comissao_asset"] = o.get("N")
+            ordem["update_ms"] = o.get("T")
+            self.ordens[o["i"]] = ordem
+            while len(self.ordens) > MAX_ORDENS:
+                self.ordens.popitem(last=False)
+            self.atualizado_em = time.time()
+            self._cond.notify_all()
+
+    def ordem(self, order_id, timeout=0.0, status=("FILLED", "CANCELED", "EXPIRED", "REJECTED")):
+        """
+        Última atualização da ordem; espera até `timeout` segundos o evento com status final chegar
+        """
+        limite = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                ordem = self.ordens.get(order_id)
+                if ordem is not None and ordem["status"] in status:
+                    return dict(ordem)
+                restante = limite - time.monotonic()
+                if restante <= 0:
+                    return dict(ordem) if ordem else None
+                self._cond.wait(restante)
+
+    def snapshot(self):
+        with self._cond:
+            return dict(self.saldos), dict(self.disponivel), {s: dict(p) for s, p in self.posicoes.items()}
+
+
+class UserStream:
+    def __init__(self, client, url=WS_URL):
+        self.client = client
+        self.url = url
+        self.state = AccountState()
+        self.connected = False
+        self.reconnects = 0
+        self.last_message_at = None
+        self._ressinc = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._run()), name=f"user-stream-{self.client.conta_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    @property
+    def pronto(self):
+        """
+        True quando o estado em memória está sincronizado e sendo mantido pelo stream
+        """
+        return self.connected and self.state.sincronizado_em is not None
+
+    def sincronizar(self):
+        """
+        Relê o estado da conta por REST agora, na prioridade de quem chama (ex.: antes de enviar ordens)
+        """
+        self.state.carregar_snapshot(self.client.futures_account())
+
+    def _sincronizar(self):
+        with prioridade(PRIORIDADE_BACKGROUND):
+            self.sincronizar()
+
+    async def _ressincronizar(self):
+        await asyncio.sleep(RESSINC_DEBOUNCE)
+        try:
+            await asyncio.to_thread(self._sincronizar)
+        except Exception as e:
+            print(f"Erro ao ressincronizar conta: {str(e)}")
+
+    def _processar(self, mensagem):
+        evento = json.loads(mensagem)
+        tipo = evento.get("e")
+        self.last_message_at = time.time()
+        if tipo == "ACCOUNT_UPDATE":
+            self.state.aplicar_conta(evento)
+            return "ressincronizar"
+        if tipo == "ORDER_TRADE_UPDATE":
+            self.state.aplicar_ordem(evento)
+        elif tipo == "listenKeyExpired":
+            return "reconectar"
+        return None
+
+    async def _keepalive(self, listen_key):
+        while True:
+            await asyncio.sleep(KEEPALIVE_INTERVAL)
+            await asyncio.to_thread(self.client.futures_stream_keepalive, listenKey=listen_key)
+
+    async def _run(self):
+        espera = RECONNECT_MIN
+        while not self._stop.is_set():
+            keepalive = None
+            try:
+                listen_key = await asyncio.to_thread(self.client.futures_stream_get_listen_key)
+                async with connect(f"{self.url}/ws/{listen_key}", ping_interval=20, ping_timeout=20) as ws:
+                    # Snapshot depois de conectar: eventos anteriores (ou perdidos na queda) ficam cobertos
+                    await asyncio.to_thread(self._sincronizar)
+                    self.connected = True
+                    espera = RECONNECT_MIN
+                    keepalive = asyncio.create_task(self._keepalive(listen_key))
+                    while not self._stop.is_set():
+                        # Conferido a cada volta, com ou sem mensagens: sem keepalive a listenKey expira
+                        # e o stream para em silêncio
+                        if keepalive.done():
+                            raise keepalive.exception()
+                        try:
+                            mensagem = await asyncio.wait_for(ws.recv(), timeout=VERIFICACAO)
+                        except asyncio.TimeoutError:
+                            # Stream de conta só fala quando algo muda; o ping do websocket detecta queda
+                            continue
+                        acao = self._processar(mensagem)
+                        if acao == "reconectar":
+                            break
+                        if acao == "ressincronizar" and (self._ressinc is None or self._ressinc.done()):
+                            self._ressinc = asyncio.create_task(self._ressincronizar())
+            except Exception as e:
+                print(f"Erro no user data stream: {str(e)}")
+            finally:
+                if keepalive:
+                    keepalive.cancel()
+            self.connected = False
+            if self._stop.is_set():
+                break
+            self.reconnects += 1
+            await asyncio.sleep(espera)
+            espera = min(espera * 2, RECONNECT_MAX)
+
+
+_streams = {}
+_streams_lock = threading.Lock()
+
+
+def get_user_stream(client):
+    """
+    Stream da conta do client (um por conta no processo), iniciado na primeira chamada
+    """
+    with _streams_lock:
+        stream = _streams.get(client.conta_id)
+        if stream is None:
+            stream = UserStream(client)
+            stream.start()
+            _streams[client.conta_id] = stream
+        return stream
@@ -0,0 +1,98 @@
+# Servidor WebSocket local que imita os streams !markPrice@arr@1s e !ticker@arr da Binance Futures
+#
+# Uso:
+#   python ws_stub_server.py [porta]
+#   BINANCE_WS_URL=ws://localhost:8765 streamlit run app.py
+import asyncio
+import json
+import random
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+from websockets.asyncio.server import serve
+
+PORTA_PADRAO = 8765
+INTERVALO = 1  # segundos
+FUNDING_INTERVALO_MS = 8 * 3600 * 1000
+
+
+def _proximo_trimestre():
+    # Último dia de março/junho/setembro/dezembro à frente
+    hoje = datetime.now(timezone.utc)
+    for mes in (3, 6, 9, 12):
+        fim = datetime(hoje.year + (mes == 12), 1 if mes == 12 else mes + 1, 1, tzinfo=timezone.utc) - timedelta(days=1)
+        if fim > hoje + timedelta(days=7):
+            return fim.strftime("%y%m%d")
+    return datetime(hoje.year + 1, 3, 31).strftime("%y%m%d")
+
+
+class MercadoSimulado:
+    def __init__(self):
+        vencimento = _proximo_trimestre()
+        self.precos = {
+            "BTCUSDT": 60000.0,
+            "ETHUSDT": 3000.0,
+            f"BTCUSDT_{vencimento}": 60600.0,
+            f"ETHUSDT_{vencimento}": 3030.0,
+        }
+        self.funding = {"BTCUSDT": 0.0001, "ETHUSDT": 0.0001}
+
+    def passo(self):
+        for symbol, preco in self.precos.items():
+            self.precos[symbol] = preco * (1 + random.gauss(0, 0.0005))
+        for symbol, rate in self.funding.items():
+            self.funding[symbol] = rate + random.gauss(0, 0.00001)
+
+    def mark_price(self):
+        agora = int(time.time() * 1000)
+        proximo_funding = (agora // FUNDING_INTERVALO_MS + 1) * FUNDING_INTERVALO_MS
+        return [
+            {
+                "e": "markPriceUpdate",
+                "E": agora,
+                "s": symbol,
+                "p": f"{preco:.2f}",
+                "i": f"{preco * 0.9999:.2f}",
+                "P": f"{preco:.2f}",
+                "r": f"{self.funding[symbol]:.8f}" if symbol in self.funding else "",
+                "T": proximo_funding if symbol in self.funding else 0,
+            }
+            for symbol, preco in self.precos.items()
+        ]
+
+    def ticker(self):
+        agora = int(time.time() * 1000)
+        return [{"e": "24hrTicker", "E": agora, "s": symbol, "c": f"{preco:.2f}"} for symbol, preco in self.precos.items()]
+
+
+async def main(porta):
+    mercado = MercadoSimulado()
+    clientes = set()
+
+    async def handler(ws):
+        clientes.add(ws)
+        try:
+            await ws.wait_closed()
+        finally:
+            clientes.discard(ws)
+
+    async with serve(handler, "localhost", porta):
+        print(f"Servidor WebSocket simulado em ws://localhost:{porta}")
+        while True:
+            mercado.passo()
+            mensagens = [
+                json.dumps({"stream": "!markPrice@arr@1s", "data": mercado.mark_price()}),
+                json.dumps({"stream": "!ticker@arr", "data": mercado.ticker()}),
+            ]
+            for ws in list(clientes):
+                for mensagem in mensagens:
+                    try:
+                        await ws.send(mensagem)
+                    except Exception:
+                        clientes.discard(ws)
+            await asyncio.sleep(INTERVALO)
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else PORTA_PADRAO))